@@ -0,0 +1,138 @@
+"""The order, stock and payment services in one process, without Docker.
+
+Cluster() imports the three Flask apps, each against its own Redis: an
+in-memory fakeredis server by default, or databases 0, 1 and 2 of a real
+Redis given as host:port. The order service's calls to stock and payment
+go through its usual pooled requests sessions, but a transport adapter
+mounted on the gateway URL hands them to the other apps in-process
+instead of to nginx:
+
+    from harness import Cluster
+    cluster = Cluster()
+    item_id = cluster.stock.post("/item/create/5").get_json()["item_id"]
+
+Background threads (order reaper, stock rebalancer, metrics snapshots) are
+turned off, so runs are repeatable.
+"""
+import importlib.util
+import os
+import sys
+
+import redis
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GATEWAY_URL = "http://gateway"
+SERVICES = ("order", "stock", "payment")
+# Path prefix of each service behind the gateway (see gateway_nginx.conf)
+GATEWAY_PREFIXES = {"stock": "/stock", "payment": "/payment"}
+
+SERVICE_ENV = {
+    "GATEWAY_URL": GATEWAY_URL,
+    "SERVICE_ROUTING": "gateway",
+    "CHECKOUT_MODE": "http",
+    "ORDER_REAPER_INTERVAL": "0",
+    "STOCK_REBALANCE_INTERVAL": "0",
+    "METRICS_DIR": "",
+}
+
+
+class WSGIAdapter(BaseAdapter):
+    """A requests transport adapter that calls a Flask app in-process."""
+
+    def __init__(self, app, prefix: str):
+        super().__init__()
+        self.client = app.test_client()
+        self.prefix = prefix
+
+    def send(self, request, **kwargs):
+        path = request.path_url[len(self.prefix):] if self.prefix else request.path_url
+        reply = self.client.open(path, method=request.method, data=request.body,
+                                 headers=dict(request.headers))
+        response = requests.Response()
+        response.status_code = reply.status_code
+        response.headers = CaseInsensitiveDict(reply.headers)
+        response._content = reply.get_data()
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def load_app(service: str, redis_factory):
+    """Import <service>/app.py as its own module, with redis.Redis replaced by redis_factory."""
+    service_dir = os.path.join(ROOT, service)
+    modules_before = set(sys.modules)
+    original_redis = redis.Redis
+    redis.Redis = redis_factory
+    sys.path.insert(0, service_dir)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{service}_app", os.path.join(service_dir, "app.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        redis.Redis = original_redis
+        sys.path.remove(service_dir)
+        # The services have modules of the same name, e.g. scripts; each app
+        # keeps its own, the next one imports its own again
+        for name in set(sys.modules) - modules_before:
+            if (getattr(sys.modules[name], "__file__", None) or "").startswith(service_dir + os.sep):
+                del sys.modules[name]
+    return module
+
+
+class Cluster:
+    def __init__(self, redis_address: str = None):
+        os.environ.update(SERVICE_ENV)
+        if ROOT not in sys.path:
+            sys.path.insert(0, ROOT)
+        self.redis = {}
+        self.modules = {}
+        for db_number, service in enumerate(SERVICES):
+            self.modules[service] = load_app(service, self._redis_factory(service, db_number, redis_address))
+
+        order = self.modules["order"]
+        for service, prefix in GATEWAY_PREFIXES.items():
+            client = getattr(order, f"{service}_client")
+            client.session.mount(f"{GATEWAY_URL}{prefix}", WSGIAdapter(self.modules[service].app, prefix))
+
+        self.order = order.app.test_client()
+        self.stock = self.modules["stock"].app.test_client()
+        self.payment = self.modules["payment"].app.test_client()
+
+    def _redis_factory(self, service: str, db_number: int, redis_address: str):
+        os.environ.update(REDIS_HOST="localhost", REDIS_PORT="6379", REDIS_PASSWORD="",
+                          REDIS_DB=str(db_number))
+        if redis_address:
+            host, port = redis_address.rsplit(":", 1)
+            os.environ.update(REDIS_HOST=host, REDIS_PORT=port,
+                              REDIS_PASSWORD=os.environ.get("BENCH_REDIS_PASSWORD", ""))
+            client = redis.Redis(host=host, port=int(port), db=db_number,
+                                 password=os.environ["REDIS_PASSWORD"] or None)
+            client.flushdb()
+            self.redis[service] = client
+            return redis.Redis
+
+        import fakeredis
+        server = fakeredis.FakeServer()
+        self.redis[service] = fakeredis.FakeRedis(server=server)
+        return lambda *args, **kwargs: fakeredis.FakeRedis(server=server)
+
+
+def redis_round_trips() -> int:
+    """Redis round trips of all requests the three apps have served so far.
+
+    Commands of background threads are left out. A streamed response counts
+    once it is closed.
+    """
+    from common.metrics import registry
+    return sum(
+        value
+        for name, _, value in registry.snapshot()["counters"]
+        if name == "http_request_redis_round_trips_total"
+    )
@@ -0,0 +1,280 @@
+"""Micro-benchmarks of the service endpoints on the in-process cluster.
+
+Runs each endpoint --ops times on a fresh Cluster (see harness.py) and
+reports, per endpoint, the operations per second, latency percentiles in
+milliseconds and the mean and maximum Redis round trips per operation,
+summed over all services a request reaches (a checkout counts those of
+stock and payment too). The results are printed as JSON; a summary goes to
+stderr.
+
+    pip install -r benchmark/requirements.txt
+    python benchmark/run_benchmarks.py --save-baseline   # before a change
+    python benchmark/run_benchmarks.py                   # after it
+
+The second run compares against benchmark/baseline.json and exits with
+status 1 if an endpoint got slower than --tolerance allows (ops/sec or
+p99) or needs more Redis round trips. Round trips are the same on every
+machine; timings only compare on the machine the baseline was saved on,
+so --round-trips-only skips them, e.g. in CI. Whatever the baseline, a
+run also fails if a single operation of an endpoint exceeds its budget in
+ROUND_TRIP_BUDGETS: raise the budget in the same change that needs it.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+from harness import Cluster, redis_round_trips
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+BATCH_SIZE = 10
+LOOKUP_SIZE = 100
+
+# Most Redis round trips a single operation of each endpoint may take
+ROUND_TRIP_BUDGETS = {
+    "stock.find": 1,
+    "stock.add": 1,
+    "stock.subtract": 1,
+    "stock.subtract_batch": 1,
+    "stock.find_batch": 1,
+    "stock.create": 2,
+    "payment.find_user": 1,
+    "payment.add_funds": 1,
+    "payment.pay": 1,
+    "order.create": 1,
+    "order.add_item": 2,
+    "order.find": 1,
+    "order.checkout": 8,
+}
+
+
+class Fixtures:
+    """Items and users shared by the benchmarks, with plenty of stock and credit."""
+
+    def __init__(self, cluster: Cluster):
+        self.cluster = cluster
+        batch = cluster.stock.post(f"/item/batch_create/{LOOKUP_SIZE}/1000000000/1").get_json()
+        self.item_ids = [str(i) for i in range(batch["first_id"], batch["last_id"] + 1)]
+        batch = cluster.payment.post(f"/batch_create_users/{LOOKUP_SIZE}/1000000000").get_json()
+        self.user_ids = [str(i) for i in range(batch["first_id"], batch["last_id"] + 1)]
+
+    def new_orders(self, count: int, items: int = 2) -> list:
+        order_ids = []
+        for i in range(count):
+            user_id = self.user_ids[i % len(self.user_ids)]
+            order_id = self.cluster.order.post(f"/create/{user_id}").get_json()["order_id"]
+            for j in range(items):
+                self.cluster.order.post(f"/addItem/{order_id}/{self.item_ids[(i + j) % len(self.item_ids)]}")
+            order_ids.append(order_id)
+        return order_ids
+
+    def warm_price_cache(self):
+        """Have the order service look up the price of every item once.
+
+        Otherwise the first op on each item pays a stock round trip. Those
+        misses are a fixed number, so the mean would depend on --ops.
+        """
+        order_id = self.new_orders(1, items=0)[0]
+        for item_id in self.item_ids:
+            self.cluster.order.post(f"/addItem/{order_id}/{item_id}")
+
+
+# Each benchmark prepares count operations and returns a function running the i-th
+def bench_stock_find(cluster, fixtures, count):
+    return lambda i: cluster.stock.get(f"/find/{fixtures.item_ids[i % LOOKUP_SIZE]}")
+
+
+def bench_stock_add(cluster, fixtures, count):
+    return lambda i: cluster.stock.post(f"/add/{fixtures.item_ids[i % LOOKUP_SIZE]}/1")
+
+
+def bench_stock_subtract(cluster, fixtures, count):
+    return lambda i: cluster.stock.post(f"/subtract/{fixtures.item_ids[i % LOOKUP_SIZE]}/1")
+
+
+def bench_stock_subtract_batch(cluster, fixtures, count):
+    batch = {item_id: 1 for item_id in fixtures.item_ids[:BATCH_SIZE]}
+    return lambda i: cluster.stock.post("/subtract_batch", json=batch)
+
+
+def bench_stock_find_batch(cluster, fixtures, count):
+    return lambda i: cluster.stock.post("/find_batch", json=fixtures.item_ids)
+
+
+def bench_stock_create(cluster, fixtures, count):
+    return lambda i: cluster.stock.post("/item/create/5")
+
+
+def bench_payment_find_user(cluster, fixtures, count):
+    return lambda i: cluster.payment.get(f"/find_user/{fixtures.user_ids[i % LOOKUP_SIZE]}")
+
+
+def bench_payment_add_funds(cluster, fixtures, count):
+    return lambda i: cluster.payment.post(f"/add_funds/{fixtures.user_ids[i % LOOKUP_SIZE]}/1")
+
+
+def bench_payment_pay(cluster, fixtures, count):
+    return lambda i: cluster.payment.post(
+        f"/pay/{fixtures.user_ids[i % LOOKUP_SIZE]}/{uuid.uuid4()}/1"
+    )
+
+
+def bench_order_create(cluster, fixtures, count):
+    return lambda i: cluster.order.post(f"/create/{fixtures.user_ids[i % LOOKUP_SIZE]}")
+
+
+def bench_order_add_item(cluster, fixtures, count):
+    order_ids = fixtures.new_orders(count, items=0)
+    fixtures.warm_price_cache()
+    return lambda i: cluster.order.post(f"/addItem/{order_ids[i]}/{fixtures.item_ids[i % LOOKUP_SIZE]}")
+
+
+def bench_order_find(cluster, fixtures, count):
+    order_ids = fixtures.new_orders(LOOKUP_SIZE)
+    return lambda i: cluster.order.get(f"/find/{order_ids[i % LOOKUP_SIZE]}")
+
+
+def bench_order_checkout(cluster, fixtures, count):
+    order_ids = fixtures.new_orders(count)
+    return lambda i: cluster.order.post(f"/checkout/{order_ids[i]}")
+
+
+BENCHMARKS = {
+    "stock.find": bench_stock_find,
+    "stock.add": bench_stock_add,
+    "stock.subtract": bench_stock_subtract,
+    "stock.subtract_batch": bench_stock_subtract_batch,
+    "stock.find_batch": bench_stock_find_batch,
+    "stock.create": bench_stock_create,
+    "payment.find_user": bench_payment_find_user,
+    "payment.add_funds": bench_payment_add_funds,
+    "payment.pay": bench_payment_pay,
+    "order.create": bench_order_create,
+    "order.add_item": bench_order_add_item,
+    "order.find": bench_order_find,
+    "order.checkout": bench_order_checkout,
+}
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def run_benchmark(cluster, fixtures, benchmark, count: int, warmup: int) -> dict:
+    operation = benchmark(cluster, fixtures, warmup + count)
+    for i in range(warmup):
+        operation(i)
+
+    latencies = []
+    round_trips = []
+    started = time.perf_counter()
+    for i in range(warmup, warmup + count):
+        before = redis_round_trips()
+        start = time.perf_counter()
+        response = operation(i)
+        # Streamed responses only do their work when read
+        body = response.get_data(as_text=True)
+        latencies.append(time.perf_counter() - start)
+        response.close()
+        if not 200 <= response.status_code < 300:
+            raise RuntimeError(f"{response.request.path} failed with {response.status_code}: {body}")
+        round_trips.append(redis_round_trips() - before)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "ops_per_sec": round(count / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p90_ms": round(percentile(latencies, 0.9) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "round_trips": round(sum(round_trips) / count, 2),
+        "max_round_trips": max(round_trips),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, round_trips_only: bool) -> list:
+    """Return a message for every endpoint that regressed against the baseline."""
+    regressions = []
+    for name, result in results.items():
+        budget = ROUND_TRIP_BUDGETS.get(name)
+        if budget is not None and result["max_round_trips"] > budget:
+            regressions.append(f"{name}: {result['max_round_trips']} Redis round trips in one op, "
+                               f"budget {budget}")
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["round_trips"] > base["round_trips"]:
+            regressions.append(f"{name}: {result['round_trips']} Redis round trips per op, "
+                               f"baseline {base['round_trips']}")
+        if round_trips_only:
+            continue
+        if result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['ops_per_sec']} ops/sec, baseline {base['ops_per_sec']}")
+        if result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']} ms, baseline {base['p99_ms']} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ops", type=int, default=500, help="operations per endpoint")
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--only", help="run the endpoints whose name contains this")
+    parser.add_argument("--redis", help="host:port of a real Redis instead of fakeredis; "
+                                        "databases 0-2 are flushed")
+    parser.add_argument("--out", help="also write the results to this file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="allowed relative drop of ops/sec and rise of p99")
+    parser.add_argument("--round-trips-only", action="store_true",
+                        help="only compare Redis round trips with the baseline")
+    arguments = parser.parse_args()
+
+    cluster = Cluster(arguments.redis)
+    fixtures = Fixtures(cluster)
+    results = {}
+    for name, benchmark in BENCHMARKS.items():
+        if arguments.only and arguments.only not in name:
+            continue
+        results[name] = run_benchmark(cluster, fixtures, benchmark, arguments.ops, arguments.warmup)
+        result = results[name]
+        print(f"{name:22} {result['ops_per_sec']:9.1f} ops/s  p50 {result['p50_ms']:7.3f} ms  "
+              f"p99 {result['p99_ms']:7.3f} ms  {result['round_trips']:5.2f} round trips",
+              file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+    if arguments.out:
+        with open(arguments.out, "w") as out:
+            json.dump(results, out, indent=2)
+
+    if arguments.save_baseline:
+        baseline = {}
+        if os.path.exists(arguments.baseline):
+            with open(arguments.baseline) as existing:
+                baseline = json.load(existing)
+        with open(arguments.baseline, "w") as out:
+            json.dump({**baseline, **results}, out, indent=2, sort_keys=True)
+            out.write("\n")
+        print(f"Saved the baseline to {arguments.baseline}", file=sys.stderr)
+        return
+
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as existing:
+            baseline = json.load(existing)
+    else:
+        baseline = {}
+    regressions = compare(results, baseline, arguments.tolerance, arguments.round_trips_only)
+    if regressions:
+        print("\nREGRESSIONS against the baseline or the round-trip budgets:", file=sys.stderr)
+        for regression in regressions:
+            print(f"  {regression}", file=sys.stderr)
+        sys.exit(1)
+    print("No regressions against the baseline or the round-trip budgets", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+"""Code shared by the order, stock and payment services.
+
+The service images are built from the repository root and copy this package
+next to each app.py. To run a service outside Docker, put the repository
+root on PYTHONPATH, e.g. ``PYTHONPATH=.. gunicorn app:app`` from order/.
+"""
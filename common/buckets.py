@@ -0,0 +1,112 @@
+"""Where the hash fields of items and users are stored.
+
+With the default STORAGE_LAYOUT=keys every entity is its own small hash,
+``item:<id>`` with the fields ``price`` and ``stock``, ``user:<id>`` with
+``credit``. Each of these keys costs Redis several times the memory of
+its few fields.
+
+STORAGE_LAYOUT=buckets packs BUCKET_SIZE entities into one hash instead,
+``items:{<bucket>}``, with the fields prefixed by the entity id:
+``<id>:price``, ``<id>:stock``. Counter ids fill their buckets in order
+(``<id> // BUCKET_SIZE``); other ids, like compact ones (common/ids.py),
+are hashed into BUCKET_COUNT buckets, so size that to the expected number
+of entities divided by BUCKET_SIZE. Redis keeps a hash in its compact
+listpack encoding while it has at most hash-max-listpack-entries fields,
+which must therefore be at least BUCKET_SIZE * FIELDS_PER_ENTITY, the
+fields of a full bucket (EntityLayout.fields_per_bucket()): 1536 for stock
+items and 512 for users at the default size of 512. Above it Redis
+silently converts the bucket to a hashtable, which costs more than plain
+keys. bucket_stats() reports the limit and the encodings of the buckets;
+the stock and payment services serve it at /stats/memory.
+
+Keys kept next to an entity (the stock shard counters of an item, the
+order records of a user) are named after the entity's key and field
+prefix, ``<key>:<prefix><name>``: ``item:<id>:stock:0`` or
+``items:{<bucket>}:<id>:stock:0``. The bucket number is a hash tag, so
+with a sharded Redis they live on the node of their bucket.
+
+common/migrate_buckets.py moves existing data from one layout to the
+other; common/memory_bench.py measures what each of them costs.
+"""
+import os
+import zlib
+from collections import Counter
+
+import redis
+
+from common.sharding import node_clients
+
+STORAGE_LAYOUT = os.environ.get("STORAGE_LAYOUT", "keys")
+BUCKET_SIZE = int(os.environ.get("BUCKET_SIZE", 512))
+BUCKET_COUNT = int(os.environ.get("BUCKET_COUNT", 65536))
+
+# Most fields an entity has in its bucket. An item has price and stock, or
+# price and shards once it is sharded (see stock/scripts.py); counting all
+# three leaves room for the switch. A user has credit.
+FIELDS_PER_ENTITY = {"item": 3, "user": 1}
+# Buckets whose encoding bucket_stats() samples
+ENCODING_SAMPLE = 100
+
+
+class EntityLayout:
+    def __init__(self, kind: str, layout: str = STORAGE_LAYOUT,
+                 bucket_size: int = BUCKET_SIZE, bucket_count: int = BUCKET_COUNT):
+        if layout not in ("keys", "buckets"):
+            raise ValueError(f"Unknown storage layout {layout}")
+        self.kind = kind
+        self.bucketed = layout == "buckets"
+        self.bucket_size = bucket_size
+        self.bucket_count = bucket_count
+
+    def bucket(self, entity_id) -> int:
+        entity_id = str(entity_id)
+        if entity_id.isdigit():
+            return int(entity_id) // self.bucket_size
+        return zlib.crc32(entity_id.encode()) % self.bucket_count
+
+    def ref(self, entity_id):
+        """Return the key holding an entity's fields and the prefix of their names."""
+        if not self.bucketed:
+            return f"{self.kind}:{entity_id}", ""
+        return f"{self.kind}s:{{{self.bucket(entity_id)}}}", f"{entity_id}:"
+
+    def key_of(self, entity_id, name: str) -> str:
+        """Name of a key kept next to an entity, e.g. key_of(7, "stock:0")."""
+        key, prefix = self.ref(entity_id)
+        return f"{key}:{prefix}{name}"
+
+    def fields_per_bucket(self) -> int:
+        """Fields of a full bucket; hash-max-listpack-entries must be at least this."""
+        return self.bucket_size * FIELDS_PER_ENTITY.get(self.kind, 1)
+
+
+def bucket_stats(db, layout: EntityLayout, sample: int = ENCODING_SAMPLE) -> dict:
+    """The listpack limit the buckets of a layout need and have, and their encodings.
+
+    hash_max_listpack_entries is the lowest of the nodes, or None if CONFIG
+    is not allowed. encodings counts the OBJECT ENCODING of up to sample
+    buckets; any "hashtable" there means the limit is too low.
+    """
+    stats = {
+        "layout": "buckets" if layout.bucketed else "keys",
+        "fields_per_bucket": layout.fields_per_bucket() if layout.bucketed else None,
+        "hash_max_listpack_entries": None,
+        "encodings": {},
+    }
+    if not layout.bucketed:
+        return stats
+    limits = []
+    encodings = Counter()
+    for node in node_clients(db):
+        try:
+            limits.append(int(node.config_get("hash-max-listpack-entries")["hash-max-listpack-entries"]))
+        except (redis.exceptions.ResponseError, KeyError):
+            pass
+        # Bucket keys end in their hash tag; the keys kept next to entities do not
+        for key in node.scan_iter(match=f"{layout.kind}s:{{*}}", count=sample):
+            if sum(encodings.values()) >= sample:
+                break
+            encodings[node.object("encoding", key).decode()] += 1
+    stats["hash_max_listpack_entries"] = min(limits) if limits else None
+    stats["encodings"] = dict(encodings)
+    return stats
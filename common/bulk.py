@@ -0,0 +1,34 @@
+"""Helpers for the bulk lookup endpoints of stock and payment.
+
+A lookup of many records is read from Redis in pipelines of LOOKUP_CHUNK
+keys and streamed back as one JSON object, ``{"<id>": record, ...}``, one
+chunk at a time, so that neither the service nor Redis holds the whole
+result at once. Unknown ids map to null.
+"""
+import json
+
+LOOKUP_CHUNK = 1000
+
+
+def parse_id_list(body):
+    """Return the ids of a JSON list body as strings, or None if it is not one."""
+    if not isinstance(body, list) or not all(isinstance(i, (str, int)) for i in body):
+        return None
+    return [str(i) for i in body]
+
+
+def chunks(ids, size: int = LOOKUP_CHUNK):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def stream_json_object(pairs):
+    """Yield the text of a JSON object from an iterable of lists of (key, value) pairs."""
+    yield "{"
+    separator = ""
+    for chunk in pairs:
+        if not chunk:
+            continue
+        yield separator + ",".join(f"{json.dumps(key)}:{json.dumps(value)}" for key, value in chunk)
+        separator = ","
+    yield "}"
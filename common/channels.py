@@ -0,0 +1,5 @@
+"""Redis pub/sub channels one service publishes on and another listens to."""
+
+# The stock service publishes the id of every item whose price changes; the
+# order service drops it from its price cache (order/price_cache.py)
+PRICE_CHANNEL = "item_price"
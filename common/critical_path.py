@@ -0,0 +1,136 @@
+"""Show where the time of traced requests went, along their critical path.
+
+Reads the JSON Lines files of spans written by common/tracing.py and
+rebuilds each trace whose root span matches --root (checkouts by default):
+
+    python -m common.critical_path spans.jsonl --slowest 5
+
+The critical path of a span is the chain of work its end waited on: from
+its end back to its start, the child that finished last, before that the
+child that finished last before that one started, and so on; the gaps are
+the span's own time. Calls that ran in parallel with a longer one are not
+on it. The tool prints the critical path of the slowest traces (or of
+--trace), and then, per span name, its share of the critical path over all
+traces and over those at or above the 99th percentile of duration: the
+names that grow in the slow traces are where the p99 goes.
+"""
+import argparse
+import json
+from collections import defaultdict
+
+
+def load_traces(paths) -> dict:
+    """Return {trace_id: [span, ...]} from span files."""
+    traces = defaultdict(list)
+    for path in paths:
+        with open(path) as spans:
+            for line in spans:
+                if line.strip():
+                    span = json.loads(line)
+                    traces[span["trace_id"]].append(span)
+    return traces
+
+
+def end_us(span: dict) -> int:
+    return span["start_us"] + span["duration_us"]
+
+
+def span_label(span: dict) -> str:
+    return f"{span['service']} {span['name']}"
+
+
+def critical_path(span: dict, children: dict) -> list:
+    """Return the (span, own time in us) segments of span's critical path, in time order."""
+    segments = []
+    cursor = end_us(span)
+    own = 0
+    for child in sorted(children.get(span["span_id"], ()), key=end_us, reverse=True):
+        if child["start_us"] >= cursor:
+            # Ran in parallel with a child that ended later
+            continue
+        # Clocks of different services may be slightly apart; clamp to the parent
+        own += max(cursor - min(end_us(child), cursor), 0)
+        segments = critical_path(child, children) + segments
+        cursor = child["start_us"]
+    own += max(cursor - span["start_us"], 0)
+    return [(span, own)] + segments
+
+
+def trace_root(spans: list, root_name: str):
+    span_ids = {span["span_id"] for span in spans}
+    for span in spans:
+        if span["parent_id"] not in span_ids and root_name in span["name"]:
+            return span
+    return None
+
+
+def percentile(values: list, q: float):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def analyze(traces: dict, root_name: str) -> list:
+    """Return (root span, critical path) of every trace with a matching root."""
+    analyzed = []
+    for spans in traces.values():
+        root = trace_root(spans, root_name)
+        if root is None:
+            continue
+        children = defaultdict(list)
+        for span in spans:
+            children[span["parent_id"]].append(span)
+        analyzed.append((root, critical_path(root, children)))
+    return analyzed
+
+
+def shares(paths: list) -> dict:
+    """Share of the total critical path time per span label."""
+    totals = defaultdict(int)
+    for _, path in paths:
+        for span, own in path:
+            totals[span_label(span)] += own
+    overall = sum(totals.values()) or 1
+    return {label: total / overall for label, total in totals.items()}
+
+
+def print_path(root: dict, path: list):
+    print(f"trace {root['trace_id']}: {span_label(root)} {root['duration_us'] / 1000:.2f} ms")
+    for span, own in path:
+        if own:
+            print(f"  {own / 1000:8.2f} ms  {span_label(span)}  {span.get('path', '')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="span files written with TRACE_SINK")
+    parser.add_argument("--root", default="checkout", help="text in the name of the root spans")
+    parser.add_argument("--trace", help="only show this trace id")
+    parser.add_argument("--slowest", type=int, default=3, help="slowest traces to show")
+    arguments = parser.parse_args()
+
+    analyzed = analyze(load_traces(arguments.files), arguments.root)
+    if not analyzed:
+        print(f"No traces with a root span matching {arguments.root!r}")
+        return
+    if arguments.trace:
+        analyzed = [entry for entry in analyzed if entry[0]["trace_id"] == arguments.trace]
+        for root, path in analyzed:
+            print_path(root, path)
+        return
+
+    analyzed.sort(key=lambda entry: entry[0]["duration_us"], reverse=True)
+    for root, path in analyzed[:arguments.slowest]:
+        print_path(root, path)
+
+    durations = [root["duration_us"] for root, _ in analyzed]
+    p50, p99 = percentile(durations, 0.5), percentile(durations, 0.99)
+    print(f"\n{len(analyzed)} traces, p50 {p50 / 1000:.2f} ms, p99 {p99 / 1000:.2f} ms")
+    overall = shares(analyzed)
+    slow = shares([entry for entry in analyzed if entry[0]["duration_us"] >= p99])
+    print(f"{'all':>7} {'>=p99':>7}  span")
+    for label in sorted(overall, key=lambda label: slow.get(label, 0), reverse=True):
+        print(f"{overall[label]:7.1%} {slow.get(label, 0):7.1%}  {label}")
+
+
+if __name__ == "__main__":
+    main()
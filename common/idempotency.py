@@ -0,0 +1,143 @@
+"""Idempotency keys for mutating endpoints.
+
+A client that retries a mutation sends the same ``Idempotency-Key`` header
+with every attempt. The first attempt runs the mutation and stores its
+outcome in Redis for IDEMPOTENCY_TTL seconds; replays get the stored
+outcome back without running the mutation again.
+
+Two flavours are provided:
+
+* IdempotentScript, for mutations that are a single Lua script (stock and
+  credit changes). The outcome is stored by the script itself, so the check,
+  the mutation and the bookkeeping are one atomic round trip. The record
+  carries the hash tag of the entity the script changes, so it lives and
+  moves (common/reshard.py) with the entity when the keyspace is sharded.
+* IdempotencyStore, for handlers that orchestrate several calls (checkout).
+  The first attempt claims the key, concurrent duplicates are refused while
+  it runs, and the final response is stored when it completes. The claim
+  only lasts claim_ttl seconds, so a key whose attempt died with its worker
+  can be tried again once the attempt would have finished.
+"""
+import json
+import os
+
+from common.sharding import routing_key
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+# Sent with a payment cancellation: the idempotency key of the payment to cancel
+PAYMENT_KEY_HEADER = "Payment-Idempotency-Key"
+
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 3600))
+
+# Runs a script body at most once per idempotency key. The caller appends the
+# idempotency key to KEYS and the TTL to ARGV; both are removed before the
+# body runs, so the body sees the same KEYS and ARGV as the plain script.
+IDEMPOTENT_WRAPPER = """
+local idempotency_key = table.remove(KEYS)
+local ttl = table.remove(ARGV)
+local cached = redis.call('GET', idempotency_key)
+if cached then
+    return cjson.decode(cached)
+end
+local result = (function()
+__BODY__
+end)()
+redis.call('SET', idempotency_key, cjson.encode(result), 'EX', ttl)
+return result
+"""
+
+# KEYS[1]: idempotency key, ARGV[1]: TTL
+# Claims the key for a new attempt and returns false, or returns what is
+# stored under it: "pending" or the JSON outcome of a finished attempt.
+CLAIM = """
+if redis.call('SET', KEYS[1], 'pending', 'NX', 'EX', ARGV[1]) then
+    return false
+end
+return redis.call('GET', KEYS[1])
+"""
+
+PENDING = b"pending"
+
+
+def idempotency_key(scope: str, key: str, entity: str = None) -> str:
+    if entity is None:
+        return f"idempotency:{scope}:{key}"
+    return f"idempotency:{{{entity}}}:{scope}:{key}"
+
+
+class IdempotentScript:
+    """A Lua script that runs at most once per idempotency key when given one."""
+
+    def __init__(self, db, source: str, scope: str, ttl: int = IDEMPOTENCY_TTL):
+        self.scope = scope
+        self.ttl = ttl
+        self.plain = db.register_script(source)
+        self.once = db.register_script(IDEMPOTENT_WRAPPER.replace("__BODY__", source))
+
+    @property
+    def scripts(self):
+        return self.plain, self.once
+
+    def __call__(self, keys, args=(), key=None):
+        if key is None:
+            return self.plain(keys=keys, args=args)
+        return self.once(
+            keys=[*keys, self.record_key(keys, key)],
+            args=[*args, self.ttl],
+        )
+
+    def record_key(self, keys, key: str) -> str:
+        """The key of the record of a call with these keys and idempotency key."""
+        return idempotency_key(self.scope, key, routing_key(keys[0]) if keys else None)
+
+
+def decode_outcome(stored):
+    if stored is None or stored == PENDING:
+        return stored
+    status, body = json.loads(stored)
+    return status, body
+
+
+class IdempotencyStore:
+    """Stores the (status, body) outcome of a handler under an idempotency key."""
+
+    def __init__(self, db, scope: str, ttl: int = IDEMPOTENCY_TTL, claim_ttl: int = None):
+        self.db = db
+        self.scope = scope
+        self.ttl = ttl
+        # How long an attempt may run; outcomes are kept for ttl
+        self.claim_ttl = ttl if claim_ttl is None else claim_ttl
+        self.claim_script = db.register_script(CLAIM)
+
+    def begin(self, key: str):
+        """Claim the key for a new attempt.
+
+        Returns None if the caller should run the handler, PENDING if another
+        attempt with the same key is still running, or the stored
+        (status, body) of a finished attempt.
+        """
+        return decode_outcome(self.claim_script(keys=[self._key(key)], args=[self.claim_ttl]))
+
+    def complete(self, key: str, status: int, body):
+        self.db.set(self._key(key), json.dumps([status, body]), ex=self.ttl)
+
+    def release(self, key: str):
+        """Forget an attempt whose outcome should not be replayed."""
+        self.db.delete(self._key(key))
+
+    def _key(self, key: str) -> str:
+        return idempotency_key(self.scope, key)
+
+
+class AsyncIdempotencyStore(IdempotencyStore):
+    """IdempotencyStore for a redis.asyncio client."""
+
+    async def begin(self, key: str):
+        return decode_outcome(await self.claim_script(keys=[self._key(key)], args=[self.claim_ttl]))
+
+    async def complete(self, key: str, status: int, body):
+        await self.db.set(self._key(key), json.dumps([status, body]), ex=self.ttl)
+
+    async def release(self, key: str):
+        await self.db.delete(self._key(key))
@@ -0,0 +1,149 @@
+"""Compact, time-ordered ids for orders, items and users.
+
+With ID_SCHEME=compact the services name new records with ids from an
+IdGenerator instead of a random UUID (orders) or a global INCR counter
+(items and users). An id is a 64-bit number laid out as
+
+    42 bits  milliseconds since EPOCH_MS
+     4 bits  shard, from ID_SHARD (e.g. the cluster or region)
+     8 bits  worker, unique per process
+    10 bits  sequence within the millisecond
+
+written as 11 base62 characters. They are zero padded, so ids sort by
+creation time as strings, too. Generating one needs no Redis round trip;
+each process only claims a worker number once, on first use, from the
+ids:workers counter unless WORKER_ID is set. The sharded keyspace still
+routes ids by hash (see common/sharding.py); the shard bits record where
+an id was made.
+
+The bulk create endpoints keep handing out ranges of the counters, which
+cost one INCRBY per request; counter ids are never 11 characters long, so
+the two kinds cannot collide.
+"""
+import os
+import threading
+import time
+
+ID_SCHEME = os.environ.get("ID_SCHEME", "legacy")
+
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+SHARD_BITS = 4
+WORKER_BITS = 8
+SEQUENCE_BITS = 10
+ID_LENGTH = 11
+
+ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+WORKERS_KEY = "ids:workers"
+
+
+def encode(number: int) -> str:
+    digits = []
+    while number:
+        number, digit = divmod(number, 62)
+        digits.append(ALPHABET[digit])
+    return "".join(reversed(digits)).rjust(ID_LENGTH, "0")
+
+
+def decode(compact_id: str) -> int:
+    number = 0
+    for char in compact_id:
+        number = number * 62 + ALPHABET.index(char)
+    return number
+
+
+def public_id(raw: str):
+    """Return a stored id for a JSON reply: counter ids as numbers, as before."""
+    return int(raw) if len(raw) < ID_LENGTH and raw.isdigit() else raw
+
+
+def parse_id(compact_id: str) -> dict:
+    """Split an id into its creation time and the shard, worker and sequence."""
+    number = decode(compact_id)
+    sequence = number & ((1 << SEQUENCE_BITS) - 1)
+    number >>= SEQUENCE_BITS
+    worker = number & ((1 << WORKER_BITS) - 1)
+    number >>= WORKER_BITS
+    shard = number & ((1 << SHARD_BITS) - 1)
+    return {
+        "time_ms": (number >> SHARD_BITS) + EPOCH_MS,
+        "shard": shard,
+        "worker": worker,
+        "sequence": sequence,
+    }
+
+
+class IdGenerator:
+    def __init__(self, worker, shard: int = 0):
+        """worker is the worker number, a function returning it on first use,
+        or None if set_worker() is called before the first id."""
+        if not 0 <= shard < 1 << SHARD_BITS:
+            raise ValueError(f"Shard {shard} out of range")
+        self.shard = shard
+        self.worker = worker
+        self.prefix = None
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def set_worker(self, worker: int):
+        """Fix the worker number, e.g. one claimed ahead of the first id."""
+        if not 0 <= worker < 1 << WORKER_BITS:
+            raise ValueError(f"Worker {worker} out of range")
+        self.worker = worker
+        self.prefix = (self.shard << WORKER_BITS) | worker
+
+    def next_id(self) -> str:
+        with self._lock:
+            if self.prefix is None:
+                if self.worker is None:
+                    raise RuntimeError("No worker number; call set_worker() first")
+                self.set_worker(self.worker() if callable(self.worker) else self.worker)
+            now = self._now()
+            if now <= self._last_ms:
+                # Same millisecond, or the clock went back: continue the sequence
+                # of the last millisecond and wait for the next one when it is full
+                self._sequence = (self._sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+                now = self._last_ms
+                if self._sequence == 0:
+                    while now <= self._last_ms:
+                        now = self._now()
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            number = (
+                (((now - EPOCH_MS) << (SHARD_BITS + WORKER_BITS)) | self.prefix) << SEQUENCE_BITS
+            ) | self._sequence
+        return encode(number)
+
+    @staticmethod
+    def _now() -> int:
+        return time.time_ns() // 1_000_000
+
+
+def claim_worker(db) -> int:
+    """Claim a worker number, unique among the last 256 processes that claimed one."""
+    return (db.incr(WORKERS_KEY) - 1) % (1 << WORKER_BITS)
+
+
+async def claim_worker_async(db) -> int:
+    """claim_worker() on a redis.asyncio connection."""
+    return (await db.incr(WORKERS_KEY) - 1) % (1 << WORKER_BITS)
+
+
+def make_generator(db=None):
+    """Return the IdGenerator of this process, or None unless ID_SCHEME=compact.
+
+    Unless WORKER_ID is set, the worker number is claimed from db on first
+    use, when Redis is up. Without db the caller claims it and calls
+    set_worker() before the first id.
+    """
+    if ID_SCHEME != "compact":
+        return None
+    if "WORKER_ID" in os.environ:
+        worker = int(os.environ["WORKER_ID"])
+    elif db is not None:
+        def worker():
+            return claim_worker(db)
+    else:
+        worker = None
+    return IdGenerator(worker, int(os.environ.get("ID_SHARD", 0)))
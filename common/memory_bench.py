@@ -0,0 +1,86 @@
+"""Measure the Redis memory per stock item and per user in each storage layout.
+
+Writes --count items (price and stock) and as many users (credit) in the
+keys and in the buckets layout (see common/buckets.py), reads the growth
+of used_memory after each, and deletes them again. The entities are
+written under their own key names, so the benchmark can run against the
+Redis of a service, though preferably an idle one:
+
+    REDIS_HOST=localhost REDIS_PORT=6379 REDIS_PASSWORD=redis REDIS_DB=0 \\
+        python -m common.memory_bench --count 1000000
+
+It also prints the encoding of a bucket. If that is not listpack, raise
+hash-max-listpack-entries to EntityLayout.fields_per_bucket(); the
+buckets then cost about as much as plain keys.
+"""
+import argparse
+import itertools
+
+from common.buckets import BUCKET_SIZE, EntityLayout
+from common.sharding import ShardedRedis, connect, node_clients
+
+PIPELINE_CHUNK = 1000
+
+# The fields of each kind of entity, with typical values
+ENTITY_FIELDS = {
+    "item": {"price": 25, "stock": 1000},
+    "user": {"credit": 100000},
+}
+
+
+def used_memory(db) -> int:
+    return sum(node.info("memory")["used_memory"] for node in node_clients(db))
+
+
+def write_entities(db, layout: EntityLayout, fields: dict, count: int):
+    for start in range(1, count + 1, PIPELINE_CHUNK):
+        pipe = db.pipeline(transaction=False)
+        for entity_id in range(start, min(start + PIPELINE_CHUNK, count + 1)):
+            key, prefix = layout.ref(entity_id)
+            pipe.hset(key, mapping={f"{prefix}{name}": value for name, value in fields.items()})
+        pipe.execute()
+
+
+def delete_entities(db, kind: str):
+    scan = db.scan_iter(match=f"{kind}*", count=PIPELINE_CHUNK)
+    while True:
+        keys = list(itertools.islice(scan, PIPELINE_CHUNK))
+        if not keys:
+            return
+        db.delete(*keys)
+
+
+def measure(db, kind: str, layout_name: str, count: int, bucket_size: int) -> dict:
+    # Named apart from the service's own item:/user: keys
+    layout = EntityLayout(f"bench_{kind}", layout_name, bucket_size)
+    before = used_memory(db)
+    write_entities(db, layout, ENTITY_FIELDS[kind], count)
+    used = used_memory(db) - before
+    sample_key = layout.ref(1)[0]
+    node = db.for_key(sample_key) if isinstance(db, ShardedRedis) else db
+    encoding = node.object("encoding", sample_key)
+    delete_entities(db, layout.kind)
+    return {"bytes_per_entity": used / count, "encoding": encoding.decode()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--bucket-size", type=int, default=BUCKET_SIZE)
+    arguments = parser.parse_args()
+
+    db = connect()
+    for kind in ENTITY_FIELDS:
+        results = {
+            layout_name: measure(db, kind, layout_name, arguments.count, arguments.bucket_size)
+            for layout_name in ("keys", "buckets")
+        }
+        keys, buckets = results["keys"], results["buckets"]
+        print(f"{kind}: {keys['bytes_per_entity']:.1f} bytes as keys ({keys['encoding']}), "
+              f"{buckets['bytes_per_entity']:.1f} bytes in buckets of {arguments.bucket_size} "
+              f"({buckets['encoding']}), "
+              f"{keys['bytes_per_entity'] / buckets['bytes_per_entity']:.1f}x as many per GB")
+
+
+if __name__ == "__main__":
+    main()
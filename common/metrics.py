@@ -0,0 +1,393 @@
+"""Prometheus metrics of the services, served at /metrics.
+
+Every process counts into its own in-memory Registry: request counts,
+status codes and latency histograms per route, the time of every Redis
+command and pipeline, the time of outbound HTTP calls (see
+order/clients.py) and the requests in flight. Redis commands of traced
+requests are also recorded as spans (see common/tracing.py). Recording takes a lock and a
+few dict updates, a microsecond or two per request.
+
+Gunicorn workers do not share memory, so each process also writes a
+snapshot of its registry to METRICS_DIR/<service> every
+METRICS_FLUSH_INTERVAL seconds and when it exits; the subdirectory keeps
+services that share a host from merging each other's metrics. /metrics
+returns the live numbers of the process serving it plus the latest
+snapshots of the service's other processes, in the Prometheus text format. Counters and histograms of workers that have
+exited are kept so that the totals do not go back; their in-flight gauges
+are dropped. An empty METRICS_DIR turns the snapshots off.
+
+Each request also counts its Redis round trips (a command or a whole
+pipeline), the commands in them and the bytes of their arguments and
+replies, into per-route counters. With REDIS_USAGE_HEADERS=1, or a Flask
+app in debug mode, the counts go back in X-Redis-Round-Trips,
+X-Redis-Commands, X-Redis-Bytes-Sent and X-Redis-Bytes-Received response
+headers. They include the counts that stock and payment report for the
+calls the order service makes, so the headers of a checkout cover the
+whole request. Tests and benchmarks assert round-trip budgets with them.
+The headers of a streamed response leave out the commands of its body.
+"""
+import atexit
+import bisect
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+
+import redis
+from flask import Response, g, request
+
+from common.tracing import current_span, now_us, record_span
+
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "service-metrics"))
+FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+REDIS_USAGE_HEADERS = os.environ.get("REDIS_USAGE_HEADERS", "0") == "1"
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name: (type, help)
+METRICS = {
+    "http_requests_total": ("counter", "Requests served, by route and status"),
+    "http_request_duration_seconds": ("histogram", "Time to serve a request, by route"),
+    "http_requests_in_flight": ("gauge", "Requests being served, by route"),
+    "redis_command_duration_seconds": ("histogram", "Time of a Redis command or pipeline"),
+    "redis_command_errors_total": ("counter", "Redis commands that raised an error"),
+    "http_request_redis_round_trips_total": ("counter", "Redis round trips of the requests, by route"),
+    "http_request_redis_commands_total": ("counter", "Redis commands of the requests, by route"),
+    "http_request_redis_bytes_total": ("counter", "Bytes sent to and received from Redis, by route"),
+    "http_client_requests_total": ("counter", "Calls to other services, by status"),
+    "http_client_request_duration_seconds": ("histogram", "Time of a call to another service"),
+}
+
+
+class Registry:
+    def __init__(self, directory: str = METRICS_DIR, buckets=LATENCY_BUCKETS):
+        self.root = directory
+        self.directory = directory
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # (name, labels) -> value; labels is a tuple of (label, value) pairs
+        self._counters = {}
+        self._gauges = {}
+        # (name, labels) -> [count per bucket..., count above the last one, sum]
+        self._histograms = {}
+
+    def inc(self, name: str, labels: tuple, amount: float = 1):
+        with self._lock:
+            self._counters[name, labels] = self._counters.get((name, labels), 0) + amount
+
+    def add(self, name: str, labels: tuple, amount: float):
+        with self._lock:
+            self._gauges[name, labels] = self._gauges.get((name, labels), 0) + amount
+
+    def observe(self, name: str, labels: tuple, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[name, labels] = [0] * (len(self.buckets) + 2)
+            histogram[i] += 1
+            histogram[-1] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+                "gauges": [[name, labels, value] for (name, labels), value in self._gauges.items()],
+                "histograms": [[name, labels, list(values)]
+                               for (name, labels), values in self._histograms.items()],
+            }
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def flush(self):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(os.getpid())
+        with open(f"{path}.tmp", "w") as out:
+            json.dump(self.snapshot(), out)
+        # Readers see the old snapshot or the new one, never half of one
+        os.replace(f"{path}.tmp", path)
+
+    def start(self, service: str = None) -> threading.Thread:
+        """Write snapshots periodically and at exit, with service into its own subdirectory."""
+        if service and self.root:
+            self.directory = os.path.join(self.root, service)
+
+        def work():
+            while True:
+                time.sleep(FLUSH_INTERVAL)
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+
+        atexit.register(self.flush)
+        thread = threading.Thread(target=work, name="metrics-flush", daemon=True)
+        thread.start()
+        return thread
+
+    def _snapshots(self):
+        yield self.snapshot()
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json") or file_name == f"{os.getpid()}.json":
+                continue
+            try:
+                with open(os.path.join(self.directory, file_name)) as snapshot:
+                    yield json.load(snapshot)
+            except (OSError, ValueError):
+                # Removed or replaced while reading
+                continue
+
+    def render(self) -> str:
+        """The metrics of all processes in the Prometheus text format."""
+        counters, gauges, histograms = {}, {}, {}
+        for snapshot in self._snapshots():
+            for name, labels, value in snapshot["counters"]:
+                key = name, tuple(map(tuple, labels))
+                counters[key] = counters.get(key, 0) + value
+            if process_alive(snapshot["pid"]):
+                for name, labels, value in snapshot["gauges"]:
+                    key = name, tuple(map(tuple, labels))
+                    gauges[key] = gauges.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = name, tuple(map(tuple, labels))
+                merged = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    merged[i] += value
+
+        values = {**counters, **gauges}
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "histogram":
+                for (metric, labels), buckets in sorted(histograms.items()):
+                    if metric == name:
+                        lines.extend(self._histogram_lines(name, labels, buckets))
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _histogram_lines(self, name: str, labels: tuple, values: list):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), values):
+            cumulative += count
+            yield f"{name}_bucket{format_labels((*labels, ('le', str(bound))))} {cumulative}"
+        yield f"{name}_sum{format_labels(labels)} {format_value(values[-1])}"
+        yield f"{name}_count{format_labels(labels)} {cumulative}"
+
+
+def process_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{label}="{escape(value)}"' for label, value in labels) + "}"
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+# The registry of this process
+registry = Registry()
+
+
+class RedisUsage:
+    """The Redis traffic of one request."""
+    __slots__ = ("round_trips", "commands", "bytes_sent", "bytes_received", "downstream")
+
+    # Header -> attribute
+    HEADERS = {
+        "X-Redis-Round-Trips": "round_trips",
+        "X-Redis-Commands": "commands",
+        "X-Redis-Bytes-Sent": "bytes_sent",
+        "X-Redis-Bytes-Received": "bytes_received",
+    }
+
+    def __init__(self):
+        self.round_trips = self.commands = self.bytes_sent = self.bytes_received = 0
+        # Header -> the sum of what the services this request called reported
+        self.downstream = dict.fromkeys(self.HEADERS, 0)
+
+    def add_downstream(self, headers):
+        """Add the usage another service reported in its response headers."""
+        for header in self.HEADERS:
+            value = headers.get(header)
+            if value is not None:
+                self.downstream[header] += int(value)
+
+    def headers(self) -> dict:
+        return {header: str(getattr(self, name) + self.downstream[header])
+                for header, name in self.HEADERS.items()}
+
+
+# The usage of the request being served now, in this thread or asyncio task
+current_usage = contextvars.ContextVar("current_usage", default=None)
+
+
+def payload_size(value) -> int:
+    """Roughly the bytes of a Redis argument or reply, without the protocol framing."""
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, (list, tuple, set)):
+        return sum(payload_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(payload_size(key) + payload_size(item) for key, item in value.items())
+    if value is None:
+        return 0
+    return len(str(value))
+
+
+def record_downstream_usage(headers):
+    """Count the Redis usage reported by another service into the current request."""
+    usage = current_usage.get()
+    if usage is not None:
+        usage.add_downstream(headers)
+
+
+def record_usage(labels: tuple, usage: RedisUsage):
+    # Only this service's own usage, so that sums over services count it once
+    registry.inc("http_request_redis_round_trips_total", labels, usage.round_trips)
+    registry.inc("http_request_redis_commands_total", labels, usage.commands)
+    registry.inc("http_request_redis_bytes_total", (*labels, ("direction", "sent")), usage.bytes_sent)
+    registry.inc("http_request_redis_bytes_total", (*labels, ("direction", "received")), usage.bytes_received)
+
+
+def count_streamed(usage: RedisUsage, chunks):
+    """Yield the chunks of a streamed body, counting the Redis usage of making each."""
+    chunks = iter(chunks)
+    while True:
+        token = current_usage.set(usage)
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        finally:
+            current_usage.reset(token)
+        yield chunk
+
+
+def instrument_flask(app):
+    """Time every request of a Flask app and serve /metrics from it."""
+
+    def labels():
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        return ("method", request.method), ("route", route)
+
+    @app.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+        g.redis_usage = usage = RedisUsage()
+        g.redis_usage_token = current_usage.set(usage)
+        registry.add("http_requests_in_flight", labels(), 1)
+
+    @app.after_request
+    def finish_request(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            request_labels = labels()
+            registry.add("http_requests_in_flight", request_labels, -1)
+            registry.observe("http_request_duration_seconds", request_labels,
+                             time.perf_counter() - start)
+            registry.inc("http_requests_total", (*request_labels, ("status", str(response.status_code))))
+        usage = g.pop("redis_usage", None)
+        if usage is not None:
+            current_usage.reset(g.pop("redis_usage_token"))
+            request_labels = labels()
+            if REDIS_USAGE_HEADERS or app.debug:
+                response.headers.update(usage.headers())
+            if response.is_streamed:
+                # The body runs its commands after the headers are out; they
+                # still count for the route, but not in the headers
+                response.response = count_streamed(usage, response.response)
+                response.call_on_close(lambda: record_usage(request_labels, usage))
+            else:
+                record_usage(request_labels, usage)
+        return response
+
+    @app.get("/metrics")
+    def metrics():
+        return Response(registry.render(), mimetype=CONTENT_TYPE)
+
+    registry.start(app.name)
+
+
+def observe_client_call(target: str, method: str, status: str, seconds: float):
+    """Record a call to another service; status is the HTTP status or "error"."""
+    labels = ("method", method), ("target", target)
+    registry.observe("http_client_request_duration_seconds", labels, seconds)
+    registry.inc("http_client_requests_total", (*labels, ("status", status)))
+
+
+_redis_instrumented = False
+
+
+def instrument_redis():
+    """Time every Redis command and pipeline of every client in this process."""
+    global _redis_instrumented
+    if _redis_instrumented:
+        return
+    _redis_instrumented = True
+    execute_command = redis.client.Redis.execute_command
+    execute_pipeline = redis.client.Pipeline.execute
+
+    def timed(command: str, commands: list, call, *args, **kwargs):
+        labels = (("command", command),)
+        traced = current_span.get() is not None
+        start_us = now_us() if traced else 0
+        usage = current_usage.get()
+        if usage is not None:
+            usage.round_trips += 1
+            usage.commands += len(commands)
+            usage.bytes_sent += payload_size(commands)
+        start = time.perf_counter()
+        try:
+            reply = call(*args, **kwargs)
+            if usage is not None:
+                usage.bytes_received += payload_size(reply)
+            return reply
+        except redis.exceptions.RedisError:
+            registry.inc("redis_command_errors_total", labels)
+            raise
+        finally:
+            registry.observe("redis_command_duration_seconds", labels, time.perf_counter() - start)
+            if traced:
+                record_span(f"redis {command}", start_us)
+
+    def timed_command(self, *args, **options):
+        return timed(str(args[0]).upper(), [args], execute_command, self, *args, **options)
+
+    def timed_pipeline(self, *args, **kwargs):
+        return timed("MULTI" if self.transaction else "PIPELINE",
+                     [command for command, _ in self.command_stack],
+                     execute_pipeline, self, *args, **kwargs)
+
+    redis.client.Redis.execute_command = timed_command
+    redis.client.Pipeline.execute = timed_pipeline
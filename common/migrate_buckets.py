@@ -0,0 +1,109 @@
+"""Move the items or users of a service to another storage layout.
+
+Switching STORAGE_LAYOUT (see common/buckets.py) does not move existing
+data. This script rewrites it into the layout given by --to: every entity
+hash becomes fields of its bucket, or the reverse, and the keys kept next
+to an entity (stock shard counters, payment order records) are renamed to
+match, keeping their TTL:
+
+    REDIS_HOST=stock-db REDIS_PORT=6379 REDIS_PASSWORD=redis REDIS_DB=0 \\
+        python -m common.migrate_buckets --kind item --to buckets
+
+Run it from the repository root while writes to the service are paused,
+with the BUCKET_SIZE and BUCKET_COUNT of the service, then restart the
+service with the new STORAGE_LAYOUT. Use --kind user on the payment Redis.
+REDIS_NODES instead of REDIS_HOST migrates every node of a sharded keyspace.
+"""
+import argparse
+import itertools
+
+from common.buckets import EntityLayout
+from common.sharding import connect
+
+SCAN_BATCH = 1000
+
+
+def split_key(layout: EntityLayout, key: str):
+    """Split a key into the entity id and the name of a key kept next to it.
+
+    The name is "" for the hash holding the entity's fields; the id is None
+    for a bucket hash, which holds many entities.
+    """
+    if layout.bucketed:
+        # items:{<bucket>}, or items:{<bucket>}:<id>:<name> for a key next to it
+        _, _, rest = key.partition("}")
+        if not rest:
+            return None, ""
+        entity_id, _, name = rest[1:].partition(":")
+        return entity_id, name
+    # item:<id>, or item:<id>:<name>
+    entity_id, _, name = key[len(layout.kind) + 1:].partition(":")
+    return entity_id, name
+
+
+def migrate(db, layout: EntityLayout) -> int:
+    """Move the entities of layout.kind into layout; return how many keys were rewritten."""
+    if layout.bucketed:
+        source = EntityLayout(layout.kind, "keys")
+        pattern = f"{layout.kind}:*"
+    else:
+        source = EntityLayout(layout.kind, "buckets", layout.bucket_size, layout.bucket_count)
+        pattern = f"{layout.kind}s:{{*"
+
+    rewritten = 0
+    scan = db.scan_iter(match=pattern, count=SCAN_BATCH)
+    while True:
+        keys = [key.decode() for key in itertools.islice(scan, SCAN_BATCH)]
+        if not keys:
+            return rewritten
+        parts = [split_key(source, key) for key in keys]
+
+        pipe = db.pipeline(transaction=False)
+        for (_, name), key in zip(parts, keys):
+            if name:
+                pipe.dump(key)
+                pipe.pttl(key)
+            else:
+                pipe.hgetall(key)
+        replies = iter(pipe.execute())
+
+        pipe = db.pipeline(transaction=False)
+        for (entity_id, name), key in zip(parts, keys):
+            if name:
+                dump, ttl = next(replies), next(replies)
+                if dump is None:
+                    # Expired or deleted since the scan
+                    continue
+                pipe.restore(layout.key_of(entity_id, name), max(ttl, 0), dump, replace=True)
+            else:
+                fields = next(replies)
+                if not fields:
+                    continue
+                if source.bucketed:
+                    # One bucket holds many entities; move each to its own hash
+                    for field, value in fields.items():
+                        field_id, _, field_name = field.decode().partition(":")
+                        target_key, prefix = layout.ref(field_id)
+                        pipe.hset(target_key, f"{prefix}{field_name}", value)
+                else:
+                    target_key, prefix = layout.ref(entity_id)
+                    pipe.hset(target_key, mapping={
+                        f"{prefix}{field.decode()}": value for field, value in fields.items()
+                    })
+            pipe.delete(key)
+            rewritten += 1
+        pipe.execute()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--kind", required=True, choices=("item", "user"))
+    parser.add_argument("--to", required=True, choices=("keys", "buckets"))
+    arguments = parser.parse_args()
+
+    layout = EntityLayout(arguments.kind, arguments.to)
+    print(f"Rewrote {migrate(connect(), layout)} keys into the {arguments.to} layout")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""On-demand sampling profiler for the Flask services.
+
+Off unless PROFILING=1; then no hooks are installed at all. When on, a
+request is profiled if it is the PROFILE_EVERY-th one of its worker (0
+never picks requests this way), or if it arrives during a profiling
+window. A window of N seconds is opened for all workers of a service by
+
+    curl -X POST http://<service>/admin/profile/30
+
+or by sending SIGUSR2 to any worker, which opens one of PROFILE_WINDOW
+seconds. Windows are capped at PROFILE_MAX_WINDOW seconds. The admin
+routes are meant to be called on a service directly; the gateway refuses
+them. If PROFILE_ADMIN_TOKEN is set, they also need an
+``Authorization: Bearer <token>`` header. The window end is kept in a file
+in ``PROFILE_DIR/<service>``, which workers check at most once a second;
+each service has its own subdirectory, so a window only profiles the
+service it was opened on, even if several share PROFILE_DIR.
+
+While a profiled request runs, a sampler thread reads the stack of the
+thread serving it every PROFILE_INTERVAL seconds. The samples are counted
+per handler as collapsed stacks and written every few seconds to
+``PROFILE_DIR/<service>/<handler>.<pid>.folded``, one ``frame;frame;... count``
+line per stack, the input format of flamegraph.pl and speedscope:
+
+    cat /tmp/profiles/order-service/checkout.*.folded | flamegraph.pl > checkout.svg
+
+GET /admin/profile shows the window and the samples taken per handler.
+"""
+import atexit
+import hmac
+import math
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import jsonify, request
+
+PROFILING = os.environ.get("PROFILING", "0") == "1"
+PROFILE_EVERY = int(os.environ.get("PROFILE_EVERY", 0))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.002))
+PROFILE_WINDOW = float(os.environ.get("PROFILE_WINDOW", 30))
+PROFILE_MAX_WINDOW = float(os.environ.get("PROFILE_MAX_WINDOW", 300))
+PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN", "")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "profiles"))
+FLUSH_INTERVAL = 5
+WINDOW_FILE = "window"
+
+
+def collapse(frame) -> str:
+    """The stack of a frame as "file:function;..." from the outermost frame in."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    def __init__(self, directory: str = PROFILE_DIR, every: int = PROFILE_EVERY,
+                 interval: float = PROFILE_INTERVAL):
+        self.root = directory
+        self.directory = directory
+        self.every = every
+        self.interval = interval
+        # Thread id -> handler of the profiled requests running now
+        self.active = {}
+        # Handler -> collapsed stack -> samples
+        self.stacks = defaultdict(Counter)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._requests = 0
+        self._window_end = 0.0
+        self._window_checked = 0.0
+        self._dirty = False
+
+    def set_service(self, service: str):
+        """Keep the window and the samples in the service's own subdirectory."""
+        self.directory = os.path.join(self.root, service)
+        self._window_checked = 0.0
+
+    def should_profile(self) -> bool:
+        self._requests += 1
+        if self.every and self._requests % self.every == 0:
+            return True
+        return time.time() < self.window_end()
+
+    def window_end(self) -> float:
+        now = time.time()
+        if now - self._window_checked >= 1:
+            self._window_checked = now
+            try:
+                with open(os.path.join(self.directory, WINDOW_FILE)) as window:
+                    self._window_end = float(window.read() or 0)
+            except (OSError, ValueError):
+                self._window_end = 0.0
+        return self._window_end
+
+    def open_window(self, seconds: float) -> float:
+        """Profile every request of every worker for the next seconds."""
+        end = time.time() + seconds
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, WINDOW_FILE)
+        with open(f"{path}.{os.getpid()}", "w") as window:
+            window.write(str(end))
+        os.replace(f"{path}.{os.getpid()}", path)
+        self._window_end, self._window_checked = end, time.time()
+        return end
+
+    def begin(self, handler: str):
+        with self._lock:
+            self.active[threading.get_ident()] = handler
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        self._wake.set()
+
+    def end(self):
+        with self._lock:
+            self.active.pop(threading.get_ident(), None)
+
+    def _sample(self):
+        flushed = time.monotonic()
+        while True:
+            if not self.active:
+                self._wake.clear()
+                self._wake.wait(FLUSH_INTERVAL)
+            else:
+                time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, handler in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        self.stacks[handler][collapse(frame)] += 1
+                        self._dirty = True
+            if time.monotonic() - flushed >= FLUSH_INTERVAL:
+                flushed = time.monotonic()
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+
+    def flush(self):
+        """Write the samples of each handler, replacing this worker's earlier files."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            stacks = {handler: dict(counts) for handler, counts in self.stacks.items()}
+        os.makedirs(self.directory, exist_ok=True)
+        for handler, counts in stacks.items():
+            path = os.path.join(self.directory, f"{handler}.{os.getpid()}.folded")
+            with open(f"{path}.tmp", "w") as out:
+                out.writelines(f"{stack} {count}\n" for stack, count in counts.items())
+            os.replace(f"{path}.tmp", path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            samples = {handler: sum(counts.values()) for handler, counts in self.stacks.items()}
+        return {
+            "window_end": self.window_end(),
+            "every": self.every,
+            "interval": self.interval,
+            "directory": self.directory,
+            "samples": samples,
+        }
+
+
+profiler = Profiler()
+
+
+def authorized() -> bool:
+    """Whether the request may use the admin routes: always unless PROFILE_ADMIN_TOKEN is set."""
+    if not PROFILE_ADMIN_TOKEN:
+        return True
+    header = request.headers.get("Authorization", "")
+    return hmac.compare_digest(header.encode(), f"Bearer {PROFILE_ADMIN_TOKEN}".encode())
+
+
+def instrument_flask(app):
+    """Add the profiling hooks and admin routes to a Flask app if PROFILING=1."""
+    if not PROFILING:
+        return
+    profiler.set_service(app.name)
+
+    @app.before_request
+    def start_profile():
+        if request.endpoint is not None and profiler.should_profile():
+            profiler.begin(request.endpoint)
+
+    @app.teardown_request
+    def stop_profile(_):
+        profiler.end()
+
+    @app.post("/admin/profile/<seconds>")
+    def open_profile_window(seconds: str):
+        if not authorized():
+            return jsonify({"error": "Unauthorized"}), 401
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            seconds = math.nan
+        if not 0 < seconds < math.inf:
+            return jsonify({"error": "The window must be a positive number of seconds"}), 400
+        end = profiler.open_window(min(seconds, PROFILE_MAX_WINDOW))
+        return jsonify({"window_end": end, "directory": profiler.directory}), 200
+
+    @app.get("/admin/profile")
+    def profile_stats():
+        if not authorized():
+            return jsonify({"error": "Unauthorized"}), 401
+        return jsonify(profiler.stats()), 200
+
+    try:
+        signal.signal(signal.SIGUSR2, lambda *_: profiler.open_window(PROFILE_WINDOW))
+    except ValueError:
+        # Not the main thread; only the admin route opens windows then
+        pass
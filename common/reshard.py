@@ -0,0 +1,101 @@
+"""Move keys to their nodes after the node list of a service changed.
+
+When REDIS_NODES changes, about 1/N of the entities belong to another node
+than before (see common/sharding.py). This script scans every old node and
+copies each key that belongs elsewhere under the new node list to its new
+node with DUMP/RESTORE, keeping its TTL, then deletes the old copy.
+Idempotency records carry the hash tag of their entity and move with it, so
+a retried mutation is still recognised on the entity's new node:
+
+    REDIS_PASSWORD=redis python -m common.reshard \\
+        --old order-db-1:6379,order-db-2:6379 \\
+        --new order-db-1:6379,order-db-2:6379,order-db-3:6379
+
+Run it from the repository root while writes to the service are paused,
+then restart the service with the new REDIS_NODES. The old copy is only
+deleted if the key did not change while it was copied; keys that did are
+copied again in the next pass. Use --dry-run to count the keys that would
+move.
+"""
+import argparse
+import os
+
+from common.sharding import ShardedRedis, routing_key
+
+SCAN_BATCH = 1000
+MAX_PASSES = 5
+
+# KEYS[1]: key, ARGV[1]: its dump when it was copied
+# Deletes the key if it is unchanged. Returns 1 if it was deleted.
+DELETE_IF_UNCHANGED = """
+if redis.call('DUMP', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+"""
+
+
+def target_node(old: ShardedRedis, new: ShardedRedis, key, source_name: str) -> str:
+    if routing_key(key) is not None:
+        return new.node_name_for(key)
+    # Keys of the primary follow the primary. Other unrouted keys were kept
+    # next to an entity by its scripts, e.g. idempotency records written
+    # before they carried the entity's hash tag; they stay put unless their
+    # node is removed.
+    if source_name == old.primary_name or source_name not in new.nodes:
+        return new.primary_name
+    return source_name
+
+
+def move_keys(old: ShardedRedis, new: ShardedRedis, dry_run: bool = False):
+    """Run one pass over the old nodes.
+
+    Returns the number of keys moved per target node and the number of keys
+    that changed while they were copied and are left for the next pass.
+    """
+    moved = {}
+    changed = 0
+    for source_name, source in old.nodes.items():
+        delete_if_unchanged = source.register_script(DELETE_IF_UNCHANGED)
+        for key in source.scan_iter(count=SCAN_BATCH):
+            target_name = target_node(old, new, key, source_name)
+            if target_name == source_name:
+                continue
+            if not dry_run:
+                pipe = source.pipeline(transaction=True)
+                pipe.dump(key)
+                pipe.pttl(key)
+                dump, ttl = pipe.execute()
+                if dump is None:
+                    # Expired or deleted since the scan
+                    continue
+                new.nodes[target_name].restore(key, max(ttl, 0), dump, replace=True)
+                if not delete_if_unchanged(keys=[key], args=[dump]):
+                    changed += 1
+                    continue
+            moved[target_name] = moved.get(target_name, 0) + 1
+    return moved, changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--old", required=True, help="current node list, host:port,...")
+    parser.add_argument("--new", required=True, help="new node list, host:port,...")
+    parser.add_argument("--db", type=int, default=int(os.environ.get("REDIS_DB", 0)))
+    parser.add_argument("--dry-run", action="store_true")
+    arguments = parser.parse_args()
+
+    password = os.environ.get("REDIS_PASSWORD")
+    old = ShardedRedis.from_addresses(arguments.old.split(","), password, arguments.db)
+    new = ShardedRedis.from_addresses(arguments.new.split(","), password, arguments.db)
+
+    for attempt in range(1 if arguments.dry_run else MAX_PASSES):
+        moved, changed = move_keys(old, new, arguments.dry_run)
+        print(f"Pass {attempt + 1}: moved {sum(moved.values())} keys {moved}, "
+              f"{changed} changed while copying")
+        if not changed:
+            break
+
+
+if __name__ == "__main__":
+    main()
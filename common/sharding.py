@@ -0,0 +1,248 @@
+"""Client-side sharding of a service's keyspace over several Redis nodes.
+
+By default a service talks to the single Redis at REDIS_HOST:REDIS_PORT.
+If REDIS_NODES lists several nodes instead (``host:port,host:port,...``,
+all with the REDIS_PASSWORD and REDIS_DB of the service), keys are spread
+over them with a consistent hash ring:
+
+* Entity keys route on their entity: ``order:<id>``, ``order:<id>:items``
+  and ``order:<id>:<anything>`` all live on the node of ``order:<id>``,
+  and likewise for ``item:`` and ``user:`` keys. A ``{hash tag}`` in a key
+  overrides this, like in Redis Cluster.
+* Every other key (id counters, checkout claims, saga bookkeeping,
+  streams) lives on the first node of the list, the primary.
+
+Lua scripts run on the node of their first key, so a script may only touch
+keys of that key's entity and unrouted keys that follow it. The idempotency
+records of IdempotentScript carry their entity's hash tag instead, so they
+stay with the entity. A MULTI pipeline is split into one transaction per
+node and is only atomic per node.
+
+Adding a node moves about 1/N of the entities; common/reshard.py moves
+their keys. The ring is the same in every process given the same node
+list, so all replicas of a service agree on where a key lives.
+"""
+import bisect
+import hashlib
+import os
+
+import redis
+
+# Key prefixes whose keys are spread over the nodes
+SHARDED_PREFIXES = ("order", "item", "user")
+# Points per node on the ring; more points spread the keys more evenly
+RING_REPLICAS = 160
+
+# Commands whose first argument is not a key; they run on the primary
+PRIMARY_COMMANDS = {"xreadgroup", "pubsub", "publish", "ping", "info"}
+
+
+class CrossNodeError(redis.exceptions.RedisError):
+    """A script was given keys that live on different nodes."""
+
+
+def routing_key(key):
+    """Return the entity a key belongs to, or None for primary keys."""
+    if isinstance(key, bytes):
+        key = key.decode()
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    prefix, separator, rest = key.partition(":")
+    if separator and prefix in SHARDED_PREFIXES:
+        return f"{prefix}:{rest.split(':', 1)[0]}"
+    return None
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes, replicas: int = RING_REPLICAS):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: str) -> str:
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[i]
+
+
+class ShardedRedis:
+    """A redis.Redis look-alike that sends every command to the node of its key."""
+
+    def __init__(self, nodes: dict):
+        # Insertion order matters: the first node is the primary
+        self.nodes = nodes
+        self.primary_name = next(iter(nodes))
+        self.primary = nodes[self.primary_name]
+        self.ring = HashRing(nodes)
+
+    @classmethod
+    def from_addresses(cls, addresses, password=None, db=0):
+        nodes = {}
+        for address in addresses:
+            host, _, port = address.strip().partition(":")
+            nodes[f"{host}:{port or 6379}"] = redis.Redis(
+                host=host, port=int(port or 6379), password=password, db=db
+            )
+        return cls(nodes)
+
+    def node_name_for(self, key) -> str:
+        entity = routing_key(key)
+        return self.primary_name if entity is None else self.ring.node_for(entity)
+
+    def for_key(self, key) -> redis.Redis:
+        return self.nodes[self.node_name_for(key)]
+
+    def __getattr__(self, name):
+        if name in PRIMARY_COMMANDS:
+            return getattr(self.primary, name)
+
+        def command(key, *args, **kwargs):
+            return getattr(self.for_key(key), name)(key, *args, **kwargs)
+
+        return command
+
+    def delete(self, *keys):
+        return sum(
+            self.nodes[name].delete(*node_keys)
+            for name, node_keys in self._group(keys).items()
+        )
+
+    def exists(self, *keys):
+        return sum(
+            self.nodes[name].exists(*node_keys)
+            for name, node_keys in self._group(keys).items()
+        )
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction)
+
+    def register_script(self, script):
+        return ShardedScript(self, script)
+
+    def script_load(self, script):
+        for node in self.nodes.values():
+            sha = node.script_load(script)
+        return sha
+
+    def scan_iter(self, *args, **kwargs):
+        for node in self.nodes.values():
+            yield from node.scan_iter(*args, **kwargs)
+
+    def close(self):
+        for node in self.nodes.values():
+            node.close()
+
+    def _group(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.node_name_for(key), []).append(key)
+        return groups
+
+
+class ShardedPipeline:
+    """Buffers commands and runs them as one pipeline per node."""
+
+    def __init__(self, db: ShardedRedis, transaction: bool):
+        self.db = db
+        self.transaction = transaction
+        self._commands = []
+
+    def __getattr__(self, name):
+        def command(key, *args, **kwargs):
+            self._add(
+                self.db.node_name_for(key),
+                lambda pipe: getattr(pipe, name)(key, *args, **kwargs),
+            )
+            return self
+
+        return command
+
+    def _add(self, node_name, queue):
+        self._commands.append((node_name, queue))
+
+    def execute(self):
+        positions = {}
+        pipes = {}
+        for i, (node_name, queue) in enumerate(self._commands):
+            if node_name not in pipes:
+                pipes[node_name] = self.db.nodes[node_name].pipeline(transaction=self.transaction)
+            queue(pipes[node_name])
+            positions.setdefault(node_name, []).append(i)
+        results = [None] * len(self._commands)
+        for node_name, pipe in pipes.items():
+            for i, result in zip(positions[node_name], pipe.execute()):
+                results[i] = result
+        self._commands = []
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._commands = []
+
+
+class ShardedScript:
+    """A registered script that runs on the node of its first key."""
+
+    def __init__(self, db: ShardedRedis, script):
+        self.db = db
+        self.script = script
+        self._scripts = {name: node.register_script(script) for name, node in db.nodes.items()}
+
+    def __call__(self, keys=(), args=(), client=None):
+        node_name = self.db.node_name_for(keys[0]) if keys else self.db.primary_name
+        for key in keys[1:]:
+            if routing_key(key) is not None and self.db.node_name_for(key) != node_name:
+                raise CrossNodeError(f"{keys[0]!r} and {key!r} live on different nodes")
+        script = self._scripts[node_name]
+        if isinstance(client, ShardedPipeline):
+            client._add(node_name, lambda pipe: script(keys=keys, args=args, client=pipe))
+            return client
+        return script(keys=keys, args=args)
+
+
+def connect(prefix: str = "REDIS"):
+    """Connect to the Redis named by the <prefix>_* environment variables.
+
+    Returns a plain redis.Redis for <prefix>_HOST, or a ShardedRedis if
+    <prefix>_NODES is set.
+    """
+    password = os.environ.get(f"{prefix}_PASSWORD")
+    db = int(os.environ.get(f"{prefix}_DB", 0))
+    addresses = os.environ.get(f"{prefix}_NODES")
+    if addresses:
+        return ShardedRedis.from_addresses(addresses.split(","), password, db)
+    return redis.Redis(
+        host=os.environ[f"{prefix}_HOST"],
+        port=int(os.environ.get(f"{prefix}_PORT", 6379)),
+        password=password,
+        db=db,
+    )
+
+
+def node_clients(db) -> list:
+    """The clients of the individual nodes behind a connection."""
+    if isinstance(db, ShardedRedis):
+        return list(db.nodes.values())
+    return [db]
+
+
+def group_by_node(db, keys) -> list:
+    """Split keys into lists of the indices of keys that share a node.
+
+    Returns (node name, indices) pairs; the node name is None for a plain
+    redis.Redis, which holds all keys.
+    """
+    if not isinstance(db, ShardedRedis):
+        return [(None, list(range(len(keys))))]
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(db.node_name_for(key), []).append(i)
+    return list(groups.items())
@@ -0,0 +1,129 @@
+"""Redis Streams helpers for the messaging checkout mode.
+
+Commands and replies are stream entries read by consumer groups, so every
+message is handled by exactly one consumer of a group, and messages stay
+in the stream until they are acknowledged. If a consumer dies before it
+acknowledges a message, another consumer of the group claims the message
+once it has been idle for ``claim_idle_ms`` and handles it again. Handlers
+must therefore be idempotent; all mutations reached from them carry
+idempotency keys.
+
+Stream layout (on the bus Redis, which is the order service's Redis):
+
+* ``commands:stock``  reserve / release commands for the stock workers
+* ``commands:payment``  pay / cancel commands for the payment workers
+* ``replies:order``  replies for the order service
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+import redis
+
+STOCK_COMMANDS = "commands:stock"
+PAYMENT_COMMANDS = "commands:payment"
+ORDER_REPLIES = "replies:order"
+
+# Streams are trimmed to about this many entries. Keep it well above the
+# largest backlog you expect, trimming drops the oldest entries.
+STREAM_MAXLEN = int(os.environ.get("STREAM_MAXLEN", 1000000))
+
+logger = logging.getLogger(__name__)
+
+
+def bus_connection() -> redis.Redis:
+    """Connection to the message bus for services other than order."""
+    return redis.Redis(
+        host=os.environ["BUS_REDIS_HOST"],
+        port=int(os.environ.get("BUS_REDIS_PORT", 6379)),
+        password=os.environ.get("BUS_REDIS_PASSWORD"),
+        db=int(os.environ.get("BUS_REDIS_DB", 0)),
+    )
+
+
+def consumer_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def publish(db, stream: str, fields: dict, pipe=None):
+    (pipe or db).xadd(stream, fields, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+def decode(fields: dict) -> dict:
+    return {key.decode(): value.decode() for key, value in fields.items()}
+
+
+class StreamConsumer:
+    """Feeds the entries of a stream to ``handler`` as one consumer of a group."""
+
+    def __init__(self, db, stream: str, group: str, handler, consumer: str = None,
+                 count: int = 100, block_ms: int = 1000, claim_idle_ms: int = 30000):
+        self.db = db
+        self.stream = stream
+        self.group = group
+        self.handler = handler
+        self.consumer = consumer or consumer_name()
+        self.count = count
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self._next_claim = 0
+
+    def ensure_group(self):
+        try:
+            self.db.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def run_once(self) -> int:
+        """Handle one batch of entries and return how many were handled."""
+        entries = []
+        if time.monotonic() >= self._next_claim:
+            # Take over entries of consumers that died before acknowledging them
+            claimed = self.db.xautoclaim(
+                self.stream, self.group, self.consumer,
+                min_idle_time=self.claim_idle_ms, start_id="0-0", count=self.count,
+            )
+            entries.extend(claimed[1])
+            self._next_claim = time.monotonic() + self.claim_idle_ms / 1000
+        if not entries:
+            response = self.db.xreadgroup(
+                self.group, self.consumer, {self.stream: ">"},
+                count=self.count, block=self.block_ms,
+            )
+            for _, stream_entries in response:
+                entries.extend(stream_entries)
+
+        handled = 0
+        for entry_id, fields in entries:
+            if fields is None:
+                # Trimmed from the stream while pending
+                self.db.xack(self.stream, self.group, entry_id)
+                continue
+            try:
+                self.handler(decode(fields))
+            except Exception:
+                # Left pending; claimed and retried after claim_idle_ms
+                logger.exception("Handling %s entry %s failed", self.stream, entry_id)
+                continue
+            self.db.xack(self.stream, self.group, entry_id)
+            handled += 1
+        return handled
+
+    def run_forever(self):
+        self.ensure_group()
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Reading %s failed", self.stream)
+                time.sleep(1)
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.run_forever, name=f"{self.stream}-consumer", daemon=True
+        )
+        thread.start()
+        return thread
@@ -0,0 +1,244 @@
+"""Request tracing across the order, stock and payment services.
+
+A trace is the tree of spans of one request: the handler of the request in
+each service, every Redis command it runs and every call it makes to
+another service. The order service starts a trace for an incoming request
+(a TRACE_SAMPLE_RATE fraction of them) unless the request already carries
+an X-Trace-Id header, and sends the trace id and its current span id in
+X-Trace-Id and X-Parent-Span-Id with every call to stock and payment,
+through the gateway or directly. Stock and payment continue the trace of
+a request that carries the headers and never start one of their own.
+
+Finished spans go to TRACE_SINK, buffered and written in the background
+every TRACE_FLUSH_INTERVAL seconds:
+
+* a file path: one JSON object per line, appended. Every batch is a
+  single write to a file opened in append mode, so several workers and
+  services can share one file.
+* ``udp://host:port``: one datagram per span, e.g. for a local collector.
+
+Without TRACE_SINK nothing is recorded, and each Redis command only pays
+for one context variable lookup. common/critical_path.py reads the JSON
+Lines file and shows where the time of the traced checkouts went.
+"""
+import atexit
+import contextvars
+import json
+import os
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+TRACE_SINK = os.environ.get("TRACE_SINK", "")
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+TRACE_FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", 1.0))
+
+TRACE_HEADER = "X-Trace-Id"
+PARENT_HEADER = "X-Parent-Span-Id"
+
+# The span of the code running now, in this thread or asyncio task
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def new_id() -> str:
+    return f"{random.getrandbits(64):016x}"
+
+
+def now_us() -> int:
+    return time.time_ns() // 1000
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "service", "start_us", "attrs")
+
+    def __init__(self, trace_id: str, parent_id, name: str, service: str, **attrs):
+        self.trace_id = trace_id
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.service = service
+        self.start_us = now_us()
+        self.attrs = attrs
+
+    def child(self, name: str, **attrs) -> "Span":
+        return Span(self.trace_id, self.span_id, name, self.service, **attrs)
+
+    def finish(self, **attrs):
+        self.attrs.update(attrs)
+        sink.add({
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "service": self.service,
+            "name": self.name,
+            "start_us": self.start_us,
+            "duration_us": now_us() - self.start_us,
+            **self.attrs,
+        })
+
+    def headers(self) -> dict:
+        return {TRACE_HEADER: self.trace_id, PARENT_HEADER: self.span_id}
+
+
+class SpanSink:
+    def __init__(self, target: str, flush_interval: float = TRACE_FLUSH_INTERVAL):
+        self.target = target
+        self.flush_interval = flush_interval
+        self._spans = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._socket = None
+        if target.startswith("udp://"):
+            host, port = target[len("udp://"):].rsplit(":", 1)
+            self._address = (host, int(port))
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def add(self, span: dict):
+        with self._lock:
+            self._spans.append(span)
+            if self._thread is None:
+                # Started by the first span, so in the worker process after a fork
+                self._thread = threading.Thread(target=self._work, name="span-sink", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        with self._lock:
+            spans, self._spans = self._spans, []
+        if not spans:
+            return
+        if self._socket is not None:
+            for span in spans:
+                self._socket.sendto(json.dumps(span).encode(), self._address)
+            return
+        data = "".join(json.dumps(span) + "\n" for span in spans).encode()
+        fd = os.open(self.target, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _work(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+
+sink = SpanSink(TRACE_SINK)
+
+
+def start_trace(name: str, service: str, headers, sample: bool) -> Span:
+    """Continue the trace of a request with trace headers, or start one if sample.
+
+    Returns None if the request is not traced.
+    """
+    if not TRACE_SINK:
+        return None
+    trace_id = headers.get(TRACE_HEADER)
+    if trace_id:
+        return Span(trace_id, headers.get(PARENT_HEADER), name, service)
+    if sample and random.random() < TRACE_SAMPLE_RATE:
+        return Span(new_id(), None, name, service)
+    return None
+
+
+@contextmanager
+def child_span(name: str, **attrs):
+    """Time the block as a child of the current span, if there is one."""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = parent.child(name, **attrs)
+    token = current_span.set(span)
+    try:
+        yield span
+    finally:
+        current_span.reset(token)
+        span.finish()
+
+
+def record_span(name: str, start_us: int, **attrs):
+    """Add a finished child span of the current span, which started at start_us."""
+    parent = current_span.get()
+    if parent is not None:
+        span = parent.child(name, **attrs)
+        span.start_us = start_us
+        span.finish()
+
+
+def outbound_headers(headers=None) -> dict:
+    """Headers of a call to another service, with the trace headers if traced."""
+    span = current_span.get()
+    if span is None:
+        return headers
+    return {**(headers or {}), **span.headers()}
+
+
+def instrument_flask(app, start_traces: bool = False):
+    """Record a span for each request to a Flask app that is traced.
+
+    With start_traces the app starts traces of its own; otherwise it only
+    continues the traces of requests that carry the trace headers.
+    """
+    if not TRACE_SINK:
+        return
+
+    @app.before_request
+    def start_request_span():
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        span = start_trace(f"{request.method} {route}", app.name, request.headers, start_traces)
+        if span is not None:
+            g.trace_token = current_span.set(span)
+            g.trace_span = span
+
+    @app.after_request
+    def finish_request_span(response):
+        span = g.pop("trace_span", None)
+        if span is not None:
+            current_span.reset(g.pop("trace_token"))
+            span.finish(status=response.status_code)
+        return response
+
+
+class TracingMiddleware:
+    """ASGI middleware doing what instrument_flask does for Starlette apps."""
+
+    def __init__(self, app, service: str, start_traces: bool = False):
+        self.app = app
+        self.service = service
+        self.start_traces = start_traces
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACE_SINK:
+            return await self.app(scope, receive, send)
+        headers = {key.decode().title(): value.decode() for key, value in scope["headers"]}
+        span = start_trace(f"{scope['method']} {scope['path']}", self.service, headers,
+                           self.start_traces)
+        if span is None:
+            return await self.app(scope, receive, send)
+
+        status = {}
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status["status"] = message["status"]
+            await send(message)
+
+        token = current_span.set(span)
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            current_span.reset(token)
+            endpoint = scope.get("endpoint")
+            if endpoint is not None:
+                # The route is only known after routing; the path holds ids
+                span.name = f"{scope['method']} {endpoint.__name__}"
+            span.finish(**status)
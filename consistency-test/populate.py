@@ -24,59 +24,45 @@ with open(os.path.join('..', 'urls.json')) as f:
     STOCK_URL = urls['STOCK_URL']
 
 
-async def post_and_get_status(session, url):
-    async with session.post(url) as resp:
-        return resp.status
+# Most items or users the bulk create endpoints make per request
+BATCH_CREATE_LIMIT = 100000
 
 
-async def post_and_get_field(session, url, field):
+async def post_and_get_id_range(session, url) -> List[int]:
     async with session.post(url) as resp:
         jsn = await resp.json()
-        return jsn[field]
+        return list(range(jsn['first_id'], jsn['last_id'] + 1))
 
 
 async def create_items(session, number_of_items: int, stock: int, price: int) -> List[str]:
-    tasks = []
-    # Create items
-    for _ in range(number_of_items):
-        create_item_url = f"{STOCK_URL}/stock/item/create/{price}"
-        tasks.append(asyncio.ensure_future(post_and_get_field(session, create_item_url, 'item_id')))
-    item_ids : List[str] = await asyncio.gather(*tasks)
-    tasks = []
-    # Add stock
-    for item_id in item_ids:
-        create_item_url = f"{STOCK_URL}/stock/add/{item_id}/{stock}"
-        tasks.append(asyncio.ensure_future(post_and_get_status(session, create_item_url)))
-    await asyncio.gather(*tasks)
+    item_ids = []
+    # Create items with their stock, a range of ids per request
+    for start in range(0, number_of_items, BATCH_CREATE_LIMIT):
+        count = min(BATCH_CREATE_LIMIT, number_of_items - start)
+        create_items_url = f"{STOCK_URL}/stock/item/batch_create/{count}/{stock}/{price}"
+        item_ids.extend(await post_and_get_id_range(session, create_items_url))
     return item_ids
 
 
 async def create_users(session, number_of_users: int, credit: int) -> List[str]:
-    tasks = []
-    # Create users
-    for _ in range(number_of_users):
-        create_user_url = f"{PAYMENT_URL}/payment/create_user"
-        tasks.append(asyncio.ensure_future(post_and_get_field(session, create_user_url, 'user_id')))
-    user_ids: List[str] = await asyncio.gather(*tasks)
-    tasks = []
-    # Add funds
-    for user_id in user_ids:
-        add_funds_url = f"{PAYMENT_URL}/payment/add_funds/{user_id}/{credit}"
-        tasks.append(asyncio.ensure_future(post_and_get_status(session, add_funds_url)))
-    await asyncio.gather(*tasks)
+    user_ids = []
+    # Create users with their credit, a range of ids per request
+    for start in range(0, number_of_users, BATCH_CREATE_LIMIT):
+        count = min(BATCH_CREATE_LIMIT, number_of_users - start)
+        create_users_url = f"{PAYMENT_URL}/payment/batch_create_users/{count}/{credit}"
+        user_ids.extend(await post_and_get_id_range(session, create_users_url))
     return user_ids
 
 
-async def populate_databases():
+async def populate_databases(number_of_items: int = NUMBER_0F_ITEMS, stock: int = ITEM_STARTING_STOCK,
+                             price: int = ITEM_PRICE, number_of_users: int = NUMBER_OF_USERS,
+                             credit: int = USER_STARTING_CREDIT):
     async with aiohttp.ClientSession() as session:
-        logger.info("Creating items ...")
-        # create item with 100 stock
-        item_ids: List[str] = await create_items(session, NUMBER_0F_ITEMS,
-                                                 ITEM_STARTING_STOCK, ITEM_PRICE)
+        logger.info(f"Creating {number_of_items} items ...")
+        item_ids: List[str] = await create_items(session, number_of_items, stock, price)
         logger.info("Items created")
 
-        logger.info("Creating users ...")
-        # create 1000 users
-        user_ids: List[str] = await create_users(session, NUMBER_OF_USERS, USER_STARTING_CREDIT)
+        logger.info(f"Creating {number_of_users} users ...")
+        user_ids: List[str] = await create_users(session, number_of_users, credit)
         logger.info("Users created")
     return item_ids, user_ids
@@ -1,18 +1,38 @@
+import argparse
 import asyncio
+import json
 import os
 import shutil
 import logging
 from tempfile import gettempdir
 
 from verify import verify_systems_consistency
-from populate import populate_databases
-from stress import stress
+from populate import (populate_databases, NUMBER_0F_ITEMS, ITEM_STARTING_STOCK, ITEM_PRICE,
+                      NUMBER_OF_USERS, USER_STARTING_CREDIT)
+from stress import stress, NUMBER_OF_ORDERS, CONCURRENCY
+# stress puts ../stress-test on the path
+import workload as workloads
 
 logging.basicConfig(level=logging.INFO,
                     format='%(levelname)s - %(asctime)s - %(name)s - %(message)s',
                     datefmt='%I:%M:%S')
 logger = logging.getLogger("Consistency test")
 
+parser = argparse.ArgumentParser(description="Check out concurrently and verify that stock and payment agree.")
+parser.add_argument("--items", type=int, default=NUMBER_0F_ITEMS, help="items to create")
+parser.add_argument("--stock", type=int, default=ITEM_STARTING_STOCK, help="starting stock of each item")
+parser.add_argument("--price", type=int, default=ITEM_PRICE, help="price of each item")
+parser.add_argument("--users", type=int, default=NUMBER_OF_USERS, help="users to create")
+parser.add_argument("--credit", type=int, default=USER_STARTING_CREDIT, help="starting credit of each user")
+parser.add_argument("--orders", type=int, default=NUMBER_OF_ORDERS, help="orders to create and check out")
+parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="most requests in flight at once")
+parser.add_argument("--keep-logs", action="store_true", help="keep the checkout log in the tmp folder")
+workloads.add_arguments(parser)
+arguments = parser.parse_args()
+workload = workloads.from_arguments(arguments)
+
+if arguments.orders * workload.mean_basket_size < arguments.items * arguments.stock:
+    logger.warning("There are fewer orders than items in stock; the checks assume that the stock sells out")
 
 # Create the tmp folder to store the logs, the users and the stock
 logger.info("Creating tmp folder...")
@@ -26,18 +46,25 @@ logger.info("tmp folder created")
 
 # Populate the payment and stock databases
 logger.info("Populating the databases...")
-item_ids, user_ids = asyncio.run(populate_databases())
+item_ids, user_ids = asyncio.run(populate_databases(arguments.items, arguments.stock, arguments.price,
+                                                    arguments.users, arguments.credit))
 logger.info("Databases populated")
 
 # Run the load test
 logger.info("Starting the load test...")
-asyncio.run(stress(item_ids, user_ids))
+stats = asyncio.run(stress(item_ids, user_ids, arguments.orders, arguments.concurrency, tmp_folder_path, workload))
 logger.info("Load test completed")
 
 # Verify the systems' consistency
 logger.info("Starting the consistency evaluation...")
-asyncio.run(verify_systems_consistency(tmp_folder_path, item_ids, user_ids))
+inconsistencies = asyncio.run(verify_systems_consistency(tmp_folder_path, item_ids, user_ids,
+                                                         arguments.stock, arguments.price, arguments.credit))
 logger.info("Consistency evaluation completed")
 
-if os.path.isdir(tmp_folder_path):
+# Throughput and latency of each kind of request, next to the inconsistencies
+for name, request_stats in stats.items():
+    logger.info(f"{name}: {json.dumps(request_stats.summary())}")
+logger.info(f"Inconsistencies: {json.dumps(inconsistencies)}")
+
+if os.path.isdir(tmp_folder_path) and not arguments.keep_logs:
     shutil.rmtree(tmp_folder_path)
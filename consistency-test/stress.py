@@ -2,11 +2,18 @@ import asyncio
 import json
 import logging
 import os
-import random
+import sys
+import time
+from array import array
+from collections import Counter
 from tempfile import gettempdir
 
 import aiohttp
 
+# The workload model is shared with the load tests
+sys.path.insert(0, os.path.join('..', 'stress-test'))
+from workload import Workload
+
 logging.basicConfig(level=logging.INFO,
                     format='%(levelname)s - %(asctime)s - %(name)s - %(message)s',
                     datefmt='%I:%M:%S')
@@ -15,6 +22,8 @@ logger = logging.getLogger(__name__)
 tmp_folder_path: str = os.path.join(gettempdir(), 'wdm_consistency_test')
 
 NUMBER_OF_ORDERS = 1000
+# Most requests in flight at once
+CONCURRENCY = 100
 
 with open(os.path.join('..', 'urls.json')) as f:
     urls = json.load(f)
@@ -23,60 +32,154 @@ with open(os.path.join('..', 'urls.json')) as f:
     STOCK_URL = urls['STOCK_URL']
 
 
-async def create_order(session, url):
-    async with session.post(url) as resp:
-        jsn = await resp.json()
-        return jsn['order_id']
+class RequestStats:
+    """Latency and status of every request of one kind, 8 bytes a request."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = array('d')
+        self.statuses = Counter()
+        self.started = None
+        self.finished = None
+
+    def record(self, status, seconds: float):
+        now = time.perf_counter()
+        if self.started is None:
+            self.started = now - seconds
+        self.finished = now
+        self.latencies.append(seconds)
+        self.statuses[str(status)] += 1
+
+    def summary(self) -> dict:
+        if not self.latencies:
+            return {'requests': 0}
+        latencies = sorted(self.latencies)
+        elapsed = self.finished - self.started
+
+        def percentile(q: float) -> float:
+            return round(latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000, 2)
+
+        return {
+            'requests': len(latencies),
+            'throughput': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(latencies[-1] * 1000, 2),
+            'statuses': dict(self.statuses),
+        }
+
+
+async def timed_request(session, method, url, stats: RequestStats):
+    """Request url and record its latency; returns (status, JSON body or None, seconds)."""
+    start = time.perf_counter()
+    try:
+        async with session.request(method, url) as resp:
+            body = await resp.json() if resp.status == 200 else None
+            status = resp.status
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        body, status = None, 'error'
+    seconds = time.perf_counter() - start
+    stats.record(status, seconds)
+    return status, body, seconds
+
+
+async def run_bounded(jobs, concurrency: int, work):
+    """Await work(job) for every job of an iterable, at most concurrency at a time.
+
+    The jobs are pulled as the workers get to them, so a generator of a
+    million jobs never has more than concurrency of them in memory.
+    """
+    jobs = iter(jobs)
+
+    async def worker():
+        for job in jobs:
+            await work(job)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
 
 
-async def post_and_get_status(session, url, checkout=None):
-    async with session.post(url) as resp:
-        if checkout:
-            if 400 <= resp.status < 500:
-                log = f"CHECKOUT | ORDER: {checkout[0]} USER: {checkout[1]} FAIL __OUR_LOG__\n"
-                checkout[2].write(log)
+def checkout_outcome(status) -> str:
+    if status == 'error' or status >= 500:
+        # The checkout may or may not have happened
+        return 'ERROR'
+    if 400 <= status < 500:
+        return 'FAIL'
+    return 'SUCCESS'
+
+
+async def create_orders(session, item_ids, user_ids, number_of_orders, concurrency, orders_path, stats, workload):
+    # Create the orders with a basket of items each, writing "order_id user_id items" lines
+    with open(orders_path, 'w') as orders_file:
+        async def create(_):
+            user_id = workload.user(user_ids)
+            _, body, _ = await timed_request(session, "POST", f"{ORDER_URL}/orders/create/{user_id}",
+                                             stats['create'])
+            if body is None:
+                return
+            order_id = body['order_id']
+            items = 0
+            for item_id in workload.basket(item_ids):
+                status, _, _ = await timed_request(session, "POST", f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}",
+                                                   stats['addItem'])
+                items += status == 200
+            orders_file.write(f"{order_id} {user_id} {items}\n")
+
+        await run_bounded(range(number_of_orders), concurrency, create)
+
+
+def read_orders(orders_path):
+    with open(orders_path) as orders_file:
+        for line in orders_file:
+            order_id, user_id, items = line.split()
+            yield order_id, user_id, int(items)
+
+
+def with_reads(orders, workload):
+    """Put workload.read_ratio of lookups (None) between the orders."""
+    for order in orders:
+        while workload.is_read():
+            yield None
+        yield order
+
+
+async def perform_checkouts(session, item_ids, user_ids, orders_path, concurrency, log_file, stats, workload):
+    async def checkout(order):
+        if order is None:
+            if workload.rng.random() < 0.5:
+                url = f"{STOCK_URL}/stock/find/{workload.item(item_ids)}"
             else:
-                log = f"CHECKOUT | ORDER: {checkout[0]} USER: {checkout[1]} SUCCESS __OUR_LOG__\n"
-                checkout[2].write(log)
-        return resp.status
-
-
-async def create_orders(session, item_ids, user_ids, number_of_orders):
-    tasks = []
-    # Create orders
-    orders_user_id = []
-    for _ in range(number_of_orders):
-        user_id = random.choice(user_ids)
-        orders_user_id.append(user_id)
-        create_order_url = f"{ORDER_URL}/orders/create/{user_id}"
-        tasks.append(asyncio.ensure_future(create_order(session, create_order_url)))
-    order_ids = await asyncio.gather(*tasks)
-    tasks = []
-    # Add items
-    for order_id in order_ids:
-        item_id = random.choice(item_ids)
-        create_item_url = f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}"
-        tasks.append(asyncio.ensure_future(post_and_get_status(session, create_item_url)))
-    await asyncio.gather(*tasks)
-    return order_ids, orders_user_id
-
-
-async def perform_checkouts(session, order_ids, orders_user_id, log_file):
-    tasks = []
-    for i, order_id in enumerate(order_ids):
-        url = f"{ORDER_URL}/orders/checkout/{order_id}"
-        tasks.append(asyncio.ensure_future(post_and_get_status(session, url,
-                                                               checkout=(order_id, orders_user_id[i], log_file))))
-    order_responses = await asyncio.gather(*tasks)
-    return order_responses
-
-
-async def stress(item_ids, user_ids):
-    async with aiohttp.ClientSession() as session:
-        logger.info("Creating orders...")
-        order_ids, orders_user_id = await create_orders(session, item_ids, user_ids, NUMBER_OF_ORDERS)
+                url = f"{PAYMENT_URL}/payment/find_user/{workload.user(user_ids)}"
+            await timed_request(session, "GET", url, stats['read'])
+            return
+        order_id, user_id, items = order
+        status, _, seconds = await timed_request(session, "POST", f"{ORDER_URL}/orders/checkout/{order_id}",
+                                                 stats['checkout'])
+        log_file.write(f"CHECKOUT | ORDER: {order_id} USER: {user_id} {checkout_outcome(status)} "
+                       f"ITEMS: {items} STATUS: {status} LATENCY_MS: {seconds * 1000:.2f} __OUR_LOG__\n")
+
+    await run_bounded(with_reads(read_orders(orders_path), workload), concurrency, checkout)
+
+
+async def stress(item_ids, user_ids, number_of_orders: int = NUMBER_OF_ORDERS,
+                 concurrency: int = CONCURRENCY, log_dir: str = tmp_folder_path, workload: Workload = None) -> dict:
+    """Create the orders, then check them all out; returns RequestStats by request kind.
+
+    workload picks the users and items of the orders and mixes lookups into
+    the checkouts; by default one uniformly picked item per order, no lookups.
+    """
+    workload = workload or Workload()
+    stats = {name: RequestStats(name) for name in ('create', 'addItem', 'checkout', 'read')}
+    orders_path = os.path.join(log_dir, 'orders.txt')
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        logger.info(f"Creating {number_of_orders} orders, {workload}...")
+        await create_orders(session, item_ids, user_ids, number_of_orders, concurrency, orders_path, stats,
+                            workload)
         logger.info("Orders created ...")
-        logger.info("Running concurrent checkouts...")
-        with open(f"{tmp_folder_path}/consistency-test.log", "w") as log_file:
-            await perform_checkouts(session, order_ids, orders_user_id, log_file)
+        logger.info(f"Running concurrent checkouts, {concurrency} at a time...")
+        with open(os.path.join(log_dir, 'consistency-test.log'), "w") as log_file:
+            await perform_checkouts(session, item_ids, user_ids, orders_path, concurrency, log_file, stats,
+                                    workload)
         logger.info("Concurrent checkouts finished...")
+    return stats
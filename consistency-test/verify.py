@@ -1,16 +1,16 @@
-import asyncio
 import re
 import os
 import json
 import logging
-from typing import Union, List, Dict, Tuple
+from collections import Counter
+from typing import Union, List
 
 import aiohttp
 
-from populate import NUMBER_0F_ITEMS, ITEM_STARTING_STOCK, ITEM_PRICE, NUMBER_OF_USERS, USER_STARTING_CREDIT
+from populate import ITEM_STARTING_STOCK, ITEM_PRICE, USER_STARTING_CREDIT
 
-
-CORRECT_USER_STATE = (NUMBER_OF_USERS * USER_STARTING_CREDIT) - (NUMBER_0F_ITEMS * ITEM_STARTING_STOCK * ITEM_PRICE)
+# Most ids per bulk lookup, so that no response holds a million records
+LOOKUP_BATCH = 10000
 
 logging.basicConfig(level=logging.INFO,
                     format='%(levelname)s - %(asctime)s - %(name)s - %(message)s',
@@ -24,64 +24,72 @@ with open(os.path.join('..', 'urls.json')) as f:
     STOCK_URL = urls['STOCK_URL']
 
 
-async def get_and_get_field(session, url, field, key):
-    async with session.get(url) as resp:
-        jsn = await resp.json()
-        return key, jsn[field]
+async def post_and_sum_field(session, url, ids, field) -> int:
+    # Bulk lookups of LOOKUP_BATCH ids; the service streams the records back in chunks
+    total = 0
+    for start in range(0, len(ids), LOOKUP_BATCH):
+        async with session.post(url, json=list(ids[start:start + LOOKUP_BATCH])) as resp:
+            jsn = await resp.json()
+            total += sum(record[field] for record in jsn.values() if record is not None)
+    return total
 
 
-async def get_user_credit_dict(session, user_id_list: List[str]) -> Dict[str, int]:
-    tasks = []
+async def get_total_user_credit(session, user_id_list: List[str]) -> int:
     # Get credit
-    for user_id in user_id_list:
-        create_item_url = f"{PAYMENT_URL}/payment/find_user/{user_id}"
-        tasks.append(asyncio.ensure_future(get_and_get_field(session, create_item_url, 'credit', user_id)))
-    user_id_credit: List[Tuple[str, int]] = await asyncio.gather(*tasks)
-    return dict(user_id_credit)
+    return await post_and_sum_field(session, f"{PAYMENT_URL}/payment/find_user_batch",
+                                    user_id_list, 'credit')
 
 
-async def get_item_stock_dict(session, item_id_list: Union[List[str], str]) -> Dict[str, int]:
-    tasks = []
+async def get_total_item_stock(session, item_id_list: Union[List[str], str]) -> int:
     # Get stock
-    for item_id in item_id_list:
-        create_item_url = f"{STOCK_URL}/stock/find/{item_id}"
-        tasks.append(asyncio.ensure_future(get_and_get_field(session, create_item_url, 'stock', item_id)))
-    item_id_stock: List[Tuple[str, int]] = await asyncio.gather(*tasks)
-    return dict(item_id_stock)
-
+    return await post_and_sum_field(session, f"{STOCK_URL}/stock/find_batch",
+                                    item_id_list, 'stock')
 
-def get_prior_user_state(user_ids):
-    user_state = dict()
-    for user_id in user_ids:
-        user_state[str(user_id)] = USER_STARTING_CREDIT
-    return user_state
 
+def parse_log(tmp_dir) -> Counter:
+    """Count the checkouts per outcome (SUCCESS, FAIL or ERROR) and the items of the successful ones.
 
-def parse_log(tmp_dir, prior_user_state: Dict[str, int]):
-    i = 0
+    Reads the log a line at a time; the items are counted as "SUCCESS items".
+    """
+    outcomes = Counter()
     with open(f'{tmp_dir}/consistency-test.log', 'r') as log_file:
-        log_file = log_file.readlines()
         for log in log_file:
             if log.endswith('__OUR_LOG__\n'):
-                m = re.search('ORDER: (.*) USER: (.*) (.*) __OUR_LOG__', log)
-                user_id = str(m.group(2))
-                status = m.group(3)
-                if status == 'SUCCESS':
-                    i += 1
-                    prior_user_state[user_id] = prior_user_state[user_id] - ITEM_PRICE
-    logger.info(f"Stock service inconsistencies in the logs: {i - (NUMBER_0F_ITEMS * ITEM_STARTING_STOCK)}")
-    return prior_user_state
-
-
-async def verify_systems_consistency(tmp_dir: str, item_ids, user_ids):
-    pus: dict = parse_log(tmp_dir, get_prior_user_state(user_ids))
+                m = re.search('ORDER: (.*) USER: (.*) (SUCCESS|FAIL|ERROR) ITEMS: ([0-9]+) ', log)
+                outcomes[m.group(3)] += 1
+                if m.group(3) == 'SUCCESS':
+                    outcomes['SUCCESS items'] += int(m.group(4))
+    return outcomes
+
+
+async def verify_systems_consistency(tmp_dir: str, item_ids, user_ids, stock: int = ITEM_STARTING_STOCK,
+                                     price: int = ITEM_PRICE, credit: int = USER_STARTING_CREDIT) -> dict:
+    """Return the inconsistencies of the logs and the databases.
+
+    Every check assumes the checkouts sell out all stock, i.e. that there
+    are more orders than items in stock and the users can pay for them.
+    """
+    total_stock = len(item_ids) * stock
+    total_credit = len(user_ids) * credit
+    correct_user_state = total_credit - total_stock * price
+
+    outcomes = parse_log(tmp_dir)
+    if outcomes['ERROR']:
+        logger.info(f"Checkouts with an unknown outcome (5xx or no response): {outcomes['ERROR']}")
     async with aiohttp.ClientSession() as session:
-        uic: dict = await get_user_credit_dict(session, user_ids)
-        iis: dict = await get_item_stock_dict(session, item_ids)
-    server_side_items_bought: int = (NUMBER_0F_ITEMS * ITEM_STARTING_STOCK) - list(iis.values())[0]
-    logger.info(f"Stock service inconsistencies in the database: "
-                f"{server_side_items_bought - (NUMBER_0F_ITEMS * ITEM_STARTING_STOCK)}")
-    logged_user_credit: int = sum(pus.values())
-    logger.info(f"Payment service inconsistencies in the logs: {abs(CORRECT_USER_STATE - logged_user_credit)}")
-    server_side_user_credit: int = sum(list(uic.values()))
-    logger.info(f"Payment service inconsistencies in the database: {abs(CORRECT_USER_STATE - server_side_user_credit)}")
+        server_side_user_credit = await get_total_user_credit(session, user_ids)
+        server_side_stock = await get_total_item_stock(session, item_ids)
+
+    server_side_items_bought = total_stock - server_side_stock
+    logged_user_credit = total_credit - outcomes['SUCCESS items'] * price
+    inconsistencies = {
+        'stock_logs': outcomes['SUCCESS items'] - total_stock,
+        'stock_database': server_side_items_bought - total_stock,
+        'payment_logs': abs(correct_user_state - logged_user_credit),
+        'payment_database': abs(correct_user_state - server_side_user_credit),
+    }
+    logger.info(f"Stock service inconsistencies in the logs: {inconsistencies['stock_logs']}")
+    logger.info(f"Stock service inconsistencies in the database: {inconsistencies['stock_database']}")
+    logger.info(f"Payment service inconsistencies in the logs: {inconsistencies['payment_logs']}")
+    logger.info(f"Payment service inconsistencies in the database: {inconsistencies['payment_database']}")
+    return inconsistencies
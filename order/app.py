@@ -1,141 +1,325 @@
 import os
 import atexit
+import time
 import uuid
-import requests
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 import redis
 
-app = Flask("order-service")
+import scripts
+from clients import make_stock_client, make_payment_client
+from orders import (
+    ORDER_TTL, order_keys, user_orders_key, new_order, decode_order, order_to_json, parse_page,
+    order_page, decode_entries,
+)
+from price_cache import PriceCache
+from reaper import REAPER_INTERVAL, OrderReaper, memory_stats
+from saga import CheckoutSaga, claim_ttl
+from messaging import MessagingCheckoutSaga
+from common.idempotency import (
+    IDEMPOTENCY_HEADER, REPLAYED_HEADER, PENDING, IdempotencyStore
+)
+from common.ids import make_generator
+from common import profiling, tracing
+from common.metrics import instrument_flask, instrument_redis
+from common.sharding import connect, node_clients
 
-db: redis.Redis = redis.Redis(
-    host=os.environ["REDIS_HOST"],
-    port=int(os.environ["REDIS_PORT"]),
-    password=os.environ["REDIS_PASSWORD"],
-    db=int(os.environ["REDIS_DB"]),
+app = Flask("order-service")
+# Request, Redis and outbound call timings, served at /metrics
+instrument_flask(app)
+instrument_redis()
+# Spans of a sample of requests and of the calls they make, with TRACE_SINK
+tracing.instrument_flask(app, start_traces=True)
+# Collapsed-stack profiles of sampled requests, with PROFILING=1 (see /admin/profile)
+profiling.instrument_flask(app)
+
+# A plain redis.Redis, or a ShardedRedis if REDIS_NODES lists several nodes
+db = connect()
+
+# Compact, time-ordered order ids with ID_SCHEME=compact, else UUIDs
+id_generator = make_generator(db)
+
+stock_client = make_stock_client()
+payment_client = make_payment_client()
+
+price_cache = PriceCache(
+    max_size=int(os.environ.get("PRICE_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("PRICE_CACHE_TTL", 60)),
 )
 
-gateway_url = os.environ["GATEWAY_URL"]
+# Price changes are published on the stock service's Redis, on the node of
+# the item if it is sharded; without it the cache falls back to its TTL alone.
+if "STOCK_REDIS_HOST" in os.environ or "STOCK_REDIS_NODES" in os.environ:
+    for stock_node in node_clients(connect("STOCK_REDIS")):
+        price_cache.subscribe(stock_node)
 
 
 def close_db_connection():
     db.close()
+    stock_client.close()
+    payment_client.close()
 
 
 atexit.register(close_db_connection)
 
+# http: checkout calls stock and payment directly (saga.py)
+# messaging: checkout sends commands to their workers over streams (messaging.py)
+CHECKOUT_MODE = os.environ.get("CHECKOUT_MODE", "http")
+# How long a messaging checkout waits for its outcome before answering 202
+CHECKOUT_DEADLINE = float(os.environ.get("CHECKOUT_DEADLINE", 5))
+
+# A checkout's claim on its key expires after CHECKOUT_CLAIM_TTL seconds, by
+# default once its saga would have been recovered (see saga.claim_ttl)
+checkout_store = IdempotencyStore(
+    db, "checkout",
+    claim_ttl=int(os.environ.get("CHECKOUT_CLAIM_TTL", 0)) or claim_ttl(stock_client, payment_client),
+)
+if CHECKOUT_MODE == "messaging":
+    checkout_saga = MessagingCheckoutSaga(db, stock_client, payment_client, checkout_store)
+    checkout_saga.start_reply_consumer()
+else:
+    checkout_saga = CheckoutSaga(db, stock_client, payment_client)
+if os.environ.get("SAGA_WORKER", "true") == "true":
+    # Compensates failed checkouts and recovers sagas of crashed workers
+    checkout_saga.start_worker()
+
+if REAPER_INTERVAL > 0 and ORDER_TTL > 0:
+    # Drops expired orders from the user indexes
+    OrderReaper(db).start()
+
+add_item_script = db.register_script(scripts.ADD_ITEM)
+remove_item_script = db.register_script(scripts.REMOVE_ITEM)
+list_orders_script = db.register_script(scripts.LIST_ORDERS)
+
+
+def preload_scripts():
+    # Scripts are called with EVALSHA; loading them up front saves the
+    # NOSCRIPT retry on the first call of each one.
+    try:
+        for script in (add_item_script, remove_item_script, list_orders_script,
+                       checkout_store.claim_script, checkout_saga.recover_script):
+            db.script_load(script.script)
+    except redis.exceptions.ConnectionError:
+        # Redis is not up yet; redis-py loads each script on first use instead
+        pass
+
+
+preload_scripts()
+
+
+def get_order(order_id, refresh_ttl=False):
+    """Return (order fields, {item_id: quantity}) or (None, None) if missing.
+
+    With refresh_ttl, the expiry of an unpaid order is restarted in the same
+    round trip. Only keys that already expire are touched, so paid orders
+    stay persistent.
+    """
+    pipe = db.pipeline(transaction=False)
+    for key in order_keys(order_id):
+        pipe.hgetall(key)
+    if refresh_ttl and ORDER_TTL > 0:
+        for key in order_keys(order_id):
+            pipe.expire(key, ORDER_TTL, xx=True)
+    return decode_order(*pipe.execute()[:2])
+
 
 def get_item_price(item_id):
-    response = requests.get(f"{gateway_url}/stock/find/{item_id}")
+    price = price_cache.get(item_id)
+    if price is not None:
+        return price
+    response = stock_client.get(f"/find/{item_id}")
     if response.status_code == 200:
-        return response.json()["price"]
+        price = response.json()["price"]
+        price_cache.put(item_id, price)
+        return price
     else:
         return None
 
 
+def missing_price_error(order_id):
+    """The error of an addItem or removeItem whose item has no price.
+
+    A missing order is reported before a missing item, as the handlers did
+    before the order check moved into the scripts. Only this failure path
+    pays the extra round trip.
+    """
+    if not db.exists(f"order:{order_id}"):
+        return "Order not found"
+    return "Item not found"
+
+
 def subtract_stock_quantity(item_id, quantity):
-    response = requests.post(f"{gateway_url}/stock/subtract/{item_id}/{quantity}")
+    response = stock_client.post(f"/subtract/{item_id}/{quantity}")
     return response.status_code == 200
 
 
 def add_stock_quantity(item_id, quantity):
-    response = requests.post(f"{gateway_url}/stock/add/{item_id}/{quantity}")
+    response = stock_client.post(f"/add/{item_id}/{quantity}")
     return response.status_code == 200
 
 
+@app.get("/stats/price_cache")
+def price_cache_stats():
+    return jsonify(price_cache.stats()), 200
+
+
+@app.get("/stats/memory")
+def order_memory_stats():
+    return jsonify(memory_stats(db)), 200
+
+
 @app.post("/create/<user_id>")
 def create_order(user_id):
-    order_id = str(uuid.uuid4())
-    order_data = {
-        "order_id": order_id,
-        "paid": "False",
-        "items": "[]",
-        "user_id": user_id,
-        "total_cost": 0,
-    }
-    db.hmset(f"order:{order_id}", order_data)
+    order_id = id_generator.next_id() if id_generator else str(uuid.uuid4())
+    created_at = int(time.time() * 1000)
+    pipe = db.pipeline(transaction=True)
+    pipe.hset(f"order:{order_id}", mapping=new_order(order_id, user_id, created_at))
+    if ORDER_TTL > 0:
+        pipe.expire(f"order:{order_id}", ORDER_TTL)
+    pipe.zadd(user_orders_key(user_id), {order_id: created_at})
+    pipe.execute()
     return jsonify({"order_id": order_id}), 200
 
 
 @app.delete("/remove/<order_id>")
 def remove_order(order_id):
-    db.delete(f"order:{order_id}")
+    user_id = db.hget(f"order:{order_id}", "user_id")
+    pipe = db.pipeline(transaction=True)
+    pipe.delete(*order_keys(order_id))
+    if user_id is not None:
+        pipe.zrem(user_orders_key(user_id.decode()), order_id)
+    pipe.execute()
     return jsonify({"status": "success"}), 200
 
 
+@app.get("/user/<user_id>")
+def list_user_orders(user_id):
+    """List a user's orders, newest first; pass next_cursor back for the next page."""
+    page = parse_page(request.args.get("cursor"), request.args.get("limit"))
+    if page is None:
+        return jsonify({"error": "Invalid cursor or limit"}), 400
+    max_score, after_id, limit = page
+    entries = decode_entries(
+        list_orders_script(keys=[user_orders_key(user_id)], args=[max_score, after_id, limit])
+    )
+    pipe = db.pipeline(transaction=False)
+    for order_id, _ in entries[:limit]:
+        pipe.hmget(f"order:{order_id}", "paid", "total_cost")
+    summaries = pipe.execute()
+    expired = [order_id for (order_id, _), (paid, _) in zip(entries, summaries) if paid is None]
+    if expired:
+        # Expired or archived; the reaper would remove them later
+        db.zrem(user_orders_key(user_id), *expired)
+    return jsonify(order_page(entries, summaries, limit)), 200
+
+
 @app.post("/addItem/<order_id>/<item_id>")
 def add_item(order_id, item_id):
-    order_key = f"order:{order_id}"
-    order_data = db.hgetall(order_key)
-    if not order_data:
-        return jsonify({"error": "Order not found"}), 400
-
     item_price = get_item_price(item_id)
     if item_price is None:
-        return jsonify({"error": "Item not found"}), 400
+        return jsonify({"error": missing_price_error(order_id)}), 400
 
     # if not subtract_stock_quantity(item_id, 1):
     #     return jsonify({"error": "Not enough stock"}), 400
 
-    items = eval(order_data[b"items"].decode())
-    items.append(item_id)
-    total_cost = int(order_data[b"total_cost"]) + item_price
-    db.hmset(order_key, {"items": str(items), "total_cost": total_cost})
+    if add_item_script(keys=order_keys(order_id), args=[item_id, 1, item_price, ORDER_TTL]) == -1:
+        return jsonify({"error": "Order not found"}), 400
     return jsonify({"status": "success"}), 200
 
 
 @app.delete("/removeItem/<order_id>/<item_id>")
 def remove_item(order_id, item_id):
-    order_key = f"order:{order_id}"
-    order_data = db.hgetall(order_key)
-    if not order_data:
-        return jsonify({"error": "Order not found"}), 400
-
     item_price = get_item_price(item_id)
     if item_price is None:
-        return jsonify({"error": "Item not found"}), 400
+        return jsonify({"error": missing_price_error(order_id)}), 400
 
-    items = eval(order_data[b"items"].decode())
-    if item_id not in items:
+    result = remove_item_script(keys=order_keys(order_id), args=[item_id, item_price, ORDER_TTL])
+    if result == -1:
+        return jsonify({"error": "Order not found"}), 400
+    if result == -2:
         return jsonify({"error": "Item not in order"}), 400
-
-    items.remove(item_id)
-    total_cost = int(order_data[b"total_cost"]) - item_price
     # add_stock_quantity(item_id, 1)
-    db.hmset(order_key, {"items": str(items), "total_cost": total_cost})
     return jsonify({"status": "success"}), 200
 
 
 @app.get("/find/<order_id>")
 def find_order(order_id):
-    order_key = f"order:{order_id}"
-    order_data = db.hgetall(order_key)
-    if not order_data:
+    order_data, quantities = get_order(order_id)
+    if order_data is None:
         return jsonify({"error": "Order not found"}), 400
-    order = {
-        key.decode(): (value.decode() if key != b"items" else eval(value.decode()))
-        for key, value in order_data.items()
-    }
-
-    return jsonify(order), 200
+    return jsonify(order_to_json(order_data, quantities)), 200
+
+
+def run_checkout(order_id, attempt_key, checkout_key, replay_failures):
+    """Return the (body, status) outcome, or None if the checkout was sent to
+    the workers in messaging mode."""
+    # Restarting the expiry keeps the order from expiring during the checkout
+    order_data, quantities = get_order(order_id, refresh_ttl=True)
+    if order_data is None:
+        return {"error": "Order not found"}, 400
+    if order_data[b"paid"] == b"True":
+        return {"error": "Order already paid"}, 400
+    user_id = order_data[b"user_id"].decode()
+    total_cost = int(order_data[b"total_cost"])
+    if b"created_at" not in order_data:
+        # Created before the user index existed; backfill_user_orders.py
+        # indexes the others
+        db.zadd(user_orders_key(user_id), {order_id: 0}, nx=True)
+    if CHECKOUT_MODE == "messaging":
+        checkout_saga.start(attempt_key, order_id, user_id, total_cost, quantities,
+                            checkout_key, replay_failures)
+        return None
+    return checkout_saga.run(attempt_key, order_id, user_id, total_cost, quantities)
 
 
 @app.post("/checkout/<order_id>")
 def checkout(order_id):
-    order_key = f"order:{order_id}"
-    order_data = db.hgetall(order_key)
-    if not order_data:
-        return jsonify({"error": "Order not found"}), 400
-    user_id = order_data[b"user_id"].decode()
-    total_cost = int(order_data[b"total_cost"])
-    payment_response = requests.post(
-        f"{gateway_url}/payment/pay/{user_id}/{order_id}/{total_cost}"
-    )
-
-    if payment_response.status_code == 200:
-        items = eval(order_data[b"items"].decode())
-        for item_id in items:
-            subtract_stock_quantity(item_id, 1)
-        db.hmset(order_key, {"items": str(items), "paid": "True"})
-        return jsonify({"status": "success"}), 200
+    # Without an Idempotency-Key header the key is derived from the order id.
+    # Then only a success is replayed: a failed checkout may succeed when it
+    # is tried again after the user adds credit or stock is replenished.
+    client_key = request.headers.get(IDEMPOTENCY_HEADER)
+    key = client_key or order_id
+    outcome = checkout_store.begin(key)
+    if outcome == PENDING:
+        return jsonify({"error": "Checkout already in progress"}), 409
+    if outcome is not None:
+        status, body = outcome
+        response = jsonify(body)
+        response.headers[REPLAYED_HEADER] = "true"
+        return response, status
+
+    # The attempt key is also the saga id. Downstream calls of the saga carry
+    # keys derived from it, so a retry with the same client key does not
+    # reserve stock or charge credit twice.
+    attempt_key = f"{order_id}:{client_key or uuid.uuid4().hex}"
+    try:
+        outcome = run_checkout(order_id, attempt_key, key, bool(client_key))
+    except Exception:
+        checkout_store.release(key)
+        raise
+
+    if outcome is None:
+        # Messaging mode; the reply consumer stores the outcome under the key
+        outcome = checkout_saga.wait(attempt_key, CHECKOUT_DEADLINE)
+        if outcome is None:
+            return jsonify({
+                "status": "pending",
+                "saga_id": attempt_key,
+                "status_url": f"/orders/checkout_status/{attempt_key}",
+            }), 202
+        body, status = outcome
+        return jsonify(body), status
+
+    body, status = outcome
+    if client_key or status == 200:
+        checkout_store.complete(key, status, body)
     else:
-        return jsonify({"error": "Payment failed"}), 400
\ No newline at end of file
+        checkout_store.release(key)
+    return jsonify(body), status
+
+
+@app.get("/checkout_status/<saga_id>")
+def checkout_status(saga_id):
+    status = checkout_saga.status(saga_id)
+    if status is None:
+        return jsonify({"error": "Checkout not found"}), 400
+    return jsonify(status), 200
@@ -0,0 +1,82 @@
+"""Move paid orders out of Redis into compressed JSON Lines files.
+
+Paid orders do not expire, so that their users can still look them up.
+Once they are old enough to no longer be needed hot, this job writes them
+to a gzip file, one JSON object per order, and removes them from Redis
+and from the user indexes. Run it periodically, e.g. as a cron job, and
+ship the files to cold storage:
+
+    REDIS_HOST=... REDIS_PORT=... REDIS_PASSWORD=... REDIS_DB=0 \\
+        python archive_orders.py --older-than 2592000 --out orders-2024-01.jsonl.gz
+
+An order is only removed after the file holding it has been written.
+The memory the removed keys used is added to the archived_bytes counter
+shown by /stats/memory.
+"""
+import argparse
+import gzip
+import json
+import time
+
+import redis
+
+from common.sharding import connect
+from orders import (
+    ORDER_STATS_KEY, PAID_ORDERS_KEY, decode_order, order_keys, order_to_json, user_orders_key,
+)
+
+BATCH = 1000
+
+
+def archive(db: redis.Redis, older_than: float, out) -> int:
+    """Archive orders paid more than older_than seconds ago to the text file out."""
+    cutoff = time.time() - older_than
+    archived = 0
+    while True:
+        order_ids = [
+            order_id.decode()
+            for order_id in db.zrangebyscore(PAID_ORDERS_KEY, "-inf", cutoff, start=0, num=BATCH)
+        ]
+        if not order_ids:
+            return archived
+
+        pipe = db.pipeline(transaction=False)
+        for order_id in order_ids:
+            for key in order_keys(order_id):
+                pipe.hgetall(key)
+                pipe.memory_usage(key)
+        replies = pipe.execute()
+
+        orders = []
+        freed = 0
+        for i, order_id in enumerate(order_ids):
+            order_data, order_size, items_data, items_size = replies[4 * i:4 * i + 4]
+            freed += (order_size or 0) + (items_size or 0)
+            order_data, quantities = decode_order(order_data, items_data)
+            if order_data is not None:
+                orders.append(order_to_json(order_data, quantities))
+        for order in orders:
+            out.write(json.dumps(order) + "\n")
+        out.flush()
+
+        pipe = db.pipeline(transaction=False)
+        for order in orders:
+            pipe.delete(*order_keys(order["order_id"]))
+            pipe.zrem(user_orders_key(order["user_id"]), order["order_id"])
+        pipe.zrem(PAID_ORDERS_KEY, *order_ids)
+        pipe.hincrby(ORDER_STATS_KEY, "archived_orders", len(orders))
+        pipe.hincrby(ORDER_STATS_KEY, "archived_bytes", freed)
+        pipe.execute()
+        archived += len(orders)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--older-than", type=float, default=30 * 24 * 3600,
+                        help="archive orders paid at least this many seconds ago")
+    parser.add_argument("--out", required=True, help="gzip file to append the orders to")
+    arguments = parser.parse_args()
+
+    # REDIS_NODES instead of REDIS_HOST archives every node of a sharded keyspace
+    with gzip.open(arguments.out, "at") as out:
+        print(f"Archived {archive(connect(), arguments.older_than, out)} orders")
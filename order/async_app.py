@@ -0,0 +1,319 @@
+"""ASGI variant of the order service.
+
+Serves the routes of app.py on asyncio: Redis is reached with
+redis.asyncio and the stock and payment services with pooled httpx
+clients, so a worker keeps serving other requests while one waits on a
+downstream call. Run it with:
+
+    uvicorn async_app:app --host 0.0.0.0 --port 5000
+
+Checkout runs the saga of saga.py with the same durable records, but
+reserves the stock and makes the payment at the same time. A CheckoutSaga
+worker thread on a blocking connection compensates failed checkouts and
+recovers stalled ones, like in app.py.
+
+Only a single order Redis (REDIS_HOST) and CHECKOUT_MODE=http are
+supported; the service refuses to start with REDIS_NODES or
+CHECKOUT_MODE=messaging, use app.py for those.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+import redis
+import redis.asyncio as aioredis
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import scripts
+from clients import AsyncServiceClient, make_stock_client, make_payment_client
+from orders import (
+    ORDER_TTL, order_keys, user_orders_key, new_order, decode_order,
+    order_to_json, parse_page, order_page, decode_entries,
+)
+from price_cache import PriceCache
+from reaper import memory_stats
+from saga import AsyncCheckoutSaga, CheckoutSaga, claim_ttl
+from common.idempotency import IDEMPOTENCY_HEADER, REPLAYED_HEADER, PENDING, AsyncIdempotencyStore
+from common.ids import claim_worker_async, make_generator
+from common.metrics import CONTENT_TYPE, registry
+from common.tracing import TracingMiddleware
+from common.sharding import connect, node_clients
+
+logger = logging.getLogger("order-service")
+
+if "REDIS_NODES" in os.environ:
+    raise RuntimeError("async_app.py does not shard the order Redis; unset REDIS_NODES or run app.py")
+if os.environ.get("CHECKOUT_MODE", "http") != "http":
+    raise RuntimeError("async_app.py only supports CHECKOUT_MODE=http; run app.py")
+
+db: aioredis.Redis = aioredis.Redis(
+    host=os.environ["REDIS_HOST"],
+    port=int(os.environ["REDIS_PORT"]),
+    password=os.environ["REDIS_PASSWORD"],
+    db=int(os.environ["REDIS_DB"]),
+)
+
+stock_client = make_stock_client(AsyncServiceClient)
+payment_client = make_payment_client(AsyncServiceClient)
+
+price_cache = PriceCache(
+    max_size=int(os.environ.get("PRICE_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("PRICE_CACHE_TTL", 60)),
+)
+
+checkout_store = AsyncIdempotencyStore(
+    db, "checkout",
+    claim_ttl=int(os.environ.get("CHECKOUT_CLAIM_TTL", 0)) or claim_ttl(stock_client, payment_client),
+)
+checkout_saga = AsyncCheckoutSaga(db, stock_client, payment_client)
+
+# The saga worker and /stats/memory run blocking calls in threads, on their
+# own connection and clients
+blocking_db = connect()
+saga_worker = CheckoutSaga(blocking_db, make_stock_client(), make_payment_client())
+
+# Compact order ids with ID_SCHEME=compact, else UUIDs. The worker number is
+# claimed on the first order, see next_order_id().
+id_generator = make_generator()
+
+add_item_script = db.register_script(scripts.ADD_ITEM)
+remove_item_script = db.register_script(scripts.REMOVE_ITEM)
+list_orders_script = db.register_script(scripts.LIST_ORDERS)
+
+
+async def startup():
+    if os.environ.get("SAGA_WORKER", "true") == "true":
+        # Compensates failed checkouts and recovers sagas of crashed workers
+        saga_worker.start_worker()
+    # Price changes are published on the stock service's Redis; without it
+    # the cache falls back to its TTL alone. The subscriber runs in its own
+    # thread, like in app.py.
+    if "STOCK_REDIS_HOST" in os.environ or "STOCK_REDIS_NODES" in os.environ:
+        for stock_node in node_clients(connect("STOCK_REDIS")):
+            price_cache.subscribe(stock_node)
+    # Only the calls to stock and payment are timed here (see clients.py)
+    registry.start("order-service")
+    try:
+        for script in (add_item_script, remove_item_script, list_orders_script,
+                       checkout_store.claim_script, saga_worker.recover_script):
+            await db.script_load(script.script)
+    except redis.exceptions.ConnectionError:
+        # Redis is not up yet; redis-py loads each script on first use instead
+        pass
+
+
+async def shutdown():
+    await stock_client.close()
+    await payment_client.close()
+    await db.close()
+    blocking_db.close()
+
+
+def error(message):
+    return JSONResponse({"error": message}, status_code=400)
+
+
+async def get_order(order_id, refresh_ttl=False):
+    """Return (order fields, {item_id: quantity}) or (None, None) if missing.
+
+    With refresh_ttl, the expiry of an unpaid order is restarted, see app.get_order.
+    """
+    async with db.pipeline(transaction=False) as pipe:
+        for key in order_keys(order_id):
+            pipe.hgetall(key)
+        if refresh_ttl and ORDER_TTL > 0:
+            for key in order_keys(order_id):
+                pipe.expire(key, ORDER_TTL, xx=True)
+        return decode_order(*(await pipe.execute())[:2])
+
+
+async def get_item_price(item_id):
+    price = price_cache.get(item_id)
+    if price is not None:
+        return price
+    response = await stock_client.get(f"/find/{item_id}")
+    if response.status_code == 200:
+        price = response.json()["price"]
+        price_cache.put(item_id, price)
+        return price
+    else:
+        return None
+
+
+async def next_order_id():
+    if id_generator is None:
+        return str(uuid.uuid4())
+    if id_generator.worker is None:
+        # Concurrent first orders may each claim one; either number is ours
+        id_generator.set_worker(await claim_worker_async(db))
+    return id_generator.next_id()
+
+
+async def missing_price_error(order_id):
+    """See app.missing_price_error."""
+    if not await db.exists(f"order:{order_id}"):
+        return "Order not found"
+    return "Item not found"
+
+
+async def metrics(request):
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+
+async def price_cache_stats(request):
+    return JSONResponse(price_cache.stats())
+
+
+async def order_memory_stats(request):
+    return JSONResponse(await asyncio.to_thread(memory_stats, blocking_db))
+
+
+async def create_order(request):
+    user_id = request.path_params["user_id"]
+    order_id = await next_order_id()
+    created_at = int(time.time() * 1000)
+    async with db.pipeline(transaction=True) as pipe:
+        pipe.hset(f"order:{order_id}", mapping=new_order(order_id, user_id, created_at))
+        if ORDER_TTL > 0:
+            pipe.expire(f"order:{order_id}", ORDER_TTL)
+        pipe.zadd(user_orders_key(user_id), {order_id: created_at})
+        await pipe.execute()
+    return JSONResponse({"order_id": order_id})
+
+
+async def remove_order(request):
+    order_id = request.path_params["order_id"]
+    user_id = await db.hget(f"order:{order_id}", "user_id")
+    async with db.pipeline(transaction=True) as pipe:
+        pipe.delete(*order_keys(order_id))
+        if user_id is not None:
+            pipe.zrem(user_orders_key(user_id.decode()), order_id)
+        await pipe.execute()
+    return JSONResponse({"status": "success"})
+
+
+async def list_user_orders(request):
+    page = parse_page(request.query_params.get("cursor"), request.query_params.get("limit"))
+    if page is None:
+        return error("Invalid cursor or limit")
+    max_score, after_id, limit = page
+    entries = decode_entries(await list_orders_script(
+        keys=[user_orders_key(request.path_params["user_id"])], args=[max_score, after_id, limit]
+    ))
+    async with db.pipeline(transaction=False) as pipe:
+        for order_id, _ in entries[:limit]:
+            pipe.hmget(f"order:{order_id}", "paid", "total_cost")
+        summaries = await pipe.execute()
+    return JSONResponse(order_page(entries, summaries, limit))
+
+
+async def add_item(request):
+    order_id = request.path_params["order_id"]
+    item_id = request.path_params["item_id"]
+    item_price = await get_item_price(item_id)
+    if item_price is None:
+        return error(await missing_price_error(order_id))
+
+    result = await add_item_script(
+        keys=order_keys(order_id), args=[item_id, 1, item_price, ORDER_TTL]
+    )
+    if result == -1:
+        return error("Order not found")
+    return JSONResponse({"status": "success"})
+
+
+async def remove_item(request):
+    order_id = request.path_params["order_id"]
+    item_id = request.path_params["item_id"]
+    item_price = await get_item_price(item_id)
+    if item_price is None:
+        return error(await missing_price_error(order_id))
+
+    result = await remove_item_script(
+        keys=order_keys(order_id), args=[item_id, item_price, ORDER_TTL]
+    )
+    if result == -1:
+        return error("Order not found")
+    if result == -2:
+        return error("Item not in order")
+    return JSONResponse({"status": "success"})
+
+
+async def find_order(request):
+    order_data, quantities = await get_order(request.path_params["order_id"])
+    if order_data is None:
+        return error("Order not found")
+    return JSONResponse(order_to_json(order_data, quantities))
+
+
+async def run_checkout(order_id, attempt_key):
+    order_data, quantities = await get_order(order_id, refresh_ttl=True)
+    if order_data is None:
+        return {"error": "Order not found"}, 400
+    if order_data[b"paid"] == b"True":
+        return {"error": "Order already paid"}, 400
+    user_id = order_data[b"user_id"].decode()
+    total_cost = int(order_data[b"total_cost"])
+    if b"created_at" not in order_data:
+        # Created before the user index existed, see app.run_checkout
+        await db.zadd(user_orders_key(user_id), {order_id: 0}, nx=True)
+
+    return await checkout_saga.run(attempt_key, order_id, user_id, total_cost, quantities)
+
+
+async def checkout(request):
+    # Same idempotency rules as app.py: without an Idempotency-Key header the
+    # key is the order id and only a success is replayed.
+    order_id = request.path_params["order_id"]
+    client_key = request.headers.get(IDEMPOTENCY_HEADER)
+    key = client_key or order_id
+    outcome = await checkout_store.begin(key)
+    if outcome == PENDING:
+        return JSONResponse({"error": "Checkout already in progress"}, status_code=409)
+    if outcome is not None:
+        status, body = outcome
+        return JSONResponse(body, status_code=status, headers={REPLAYED_HEADER: "true"})
+
+    attempt_key = f"{order_id}:{client_key or uuid.uuid4().hex}"
+    try:
+        body, status = await run_checkout(order_id, attempt_key)
+    except Exception:
+        await checkout_store.release(key)
+        raise
+    if client_key or status == 200:
+        await checkout_store.complete(key, status, body)
+    else:
+        await checkout_store.release(key)
+    return JSONResponse(body, status_code=status)
+
+
+async def checkout_status(request):
+    status = await checkout_saga.status(request.path_params["saga_id"])
+    if status is None:
+        return error("Checkout not found")
+    return JSONResponse(status)
+
+
+app = Starlette(
+    routes=[
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/stats/price_cache", price_cache_stats, methods=["GET"]),
+        Route("/stats/memory", order_memory_stats, methods=["GET"]),
+        Route("/create/{user_id}", create_order, methods=["POST"]),
+        Route("/remove/{order_id}", remove_order, methods=["DELETE"]),
+        Route("/addItem/{order_id}/{item_id}", add_item, methods=["POST"]),
+        Route("/removeItem/{order_id}/{item_id}", remove_item, methods=["DELETE"]),
+        Route("/find/{order_id}", find_order, methods=["GET"]),
+        Route("/user/{user_id}", list_user_orders, methods=["GET"]),
+        Route("/checkout/{order_id}", checkout, methods=["POST"]),
+        Route("/checkout_status/{saga_id}", checkout_status, methods=["GET"]),
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown],
+)
+# Spans of a sample of requests and of the calls they make, with TRACE_SINK
+app.add_middleware(TracingMiddleware, service="order-service", start_traces=True)
@@ -0,0 +1,57 @@
+"""Add existing orders to the per-user order index.
+
+New orders are added to ``user:<user_id>:orders`` when they are created;
+orders created before the index existed are only added when they are
+checked out. This script adds all of them up front, e.g. right after a
+deploy:
+
+    REDIS_HOST=... REDIS_PORT=... REDIS_PASSWORD=... REDIS_DB=0 python backfill_user_orders.py
+
+Orders without a creation time are scored 0, so they are listed after all
+newer orders. It only uses SCAN and pipelines, so it can run against a live
+database.
+"""
+import redis
+
+from common.sharding import connect
+from orders import user_orders_key
+
+SCAN_BATCH = 1000
+
+
+def backfill(db: redis.Redis) -> int:
+    indexed = 0
+    order_keys = []
+    for order_key in db.scan_iter(match="order:*", count=SCAN_BATCH):
+        if order_key.count(b":") != 1:
+            # Not an order hash, e.g. an order:<id>:items key
+            continue
+        order_keys.append(order_key)
+        if len(order_keys) == SCAN_BATCH:
+            indexed += index_orders(db, order_keys)
+            order_keys = []
+    if order_keys:
+        indexed += index_orders(db, order_keys)
+    return indexed
+
+
+def index_orders(db: redis.Redis, order_keys) -> int:
+    pipe = db.pipeline(transaction=False)
+    for order_key in order_keys:
+        pipe.hmget(order_key, "user_id", "created_at")
+    orders = pipe.execute()
+
+    pipe = db.pipeline(transaction=False)
+    for order_key, (user_id, created_at) in zip(order_keys, orders):
+        if user_id is None:
+            # Removed since the scan
+            continue
+        order_id = order_key.decode().split(":", 1)[1]
+        pipe.zadd(user_orders_key(user_id.decode()), {order_id: int(created_at or 0)}, nx=True)
+    return sum(pipe.execute())
+
+
+if __name__ == "__main__":
+    # REDIS_NODES instead of REDIS_HOST backfills every node of a sharded keyspace
+    connection = connect()
+    print(f"Indexed {backfill(connection)} orders")
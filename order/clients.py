@@ -0,0 +1,133 @@
+"""HTTP clients for the services the order service calls.
+
+Every client keeps a pool of keep-alive connections to its target, so a
+call does not pay for a new TCP connection. With SERVICE_ROUTING=gateway
+(the default) calls go through the gateway at GATEWAY_URL. With
+SERVICE_ROUTING=direct they go straight to STOCK_SERVICE_URL and
+USER_SERVICE_URL (the payment service), skipping the extra nginx hop.
+
+Per-target settings come from the environment:
+    STOCK_POOL_SIZE, STOCK_TIMEOUT, PAYMENT_POOL_SIZE, PAYMENT_TIMEOUT
+
+ServiceClient is used by the Flask app, AsyncServiceClient by the ASGI one.
+Both record the time and status of every call in the process's metrics
+(common/metrics.py), labelled with the target, "stock" or "payment", add
+the Redis usage the target reports to that of the request being served,
+and pass the trace headers of a traced request on (common/tracing.py).
+"""
+import os
+import time
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.metrics import observe_client_call, record_downstream_usage
+from common.tracing import child_span, outbound_headers
+
+DEFAULT_SERVICE_PORT = 5000
+
+
+def service_base_url(url: str) -> str:
+    """Accept the bare service names the k8s manifests use, e.g. "stock-service"."""
+    if "://" not in url:
+        url = f"http://{url}"
+    host = url.split("://", 1)[1]
+    if ":" not in host:
+        url = f"{url}:{DEFAULT_SERVICE_PORT}"
+    return url.rstrip("/")
+
+
+class ServiceClient:
+    def __init__(self, base_url: str, pool_size: int, timeout: float, name: str = "service"):
+        self.base_url = base_url
+        self.name = name
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        start = time.perf_counter()
+        status = "error"
+        with child_span(f"{self.name} {method}", path=path) as span:
+            try:
+                response = self.session.request(
+                    method, f"{self.base_url}{path}", timeout=self.timeout,
+                    headers=outbound_headers(kwargs.pop("headers", None)), **kwargs
+                )
+                status = str(response.status_code)
+                record_downstream_usage(response.headers)
+                return response
+            finally:
+                observe_client_call(self.name, method, status, time.perf_counter() - start)
+                if span is not None:
+                    span.attrs["status"] = status
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncServiceClient:
+    def __init__(self, base_url: str, pool_size: int, timeout: float, name: str = "service"):
+        self.base_url = base_url
+        self.name = name
+        self.timeout = timeout
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, **kwargs)
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        status = "error"
+        with child_span(f"{self.name} {method}", path=path) as span:
+            try:
+                response = await self.client.request(
+                    method, path, headers=outbound_headers(kwargs.pop("headers", None)), **kwargs
+                )
+                status = str(response.status_code)
+                record_downstream_usage(response.headers)
+                return response
+            finally:
+                observe_client_call(self.name, method, status, time.perf_counter() - start)
+                if span is not None:
+                    span.attrs["status"] = status
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def make_client(client_class, name: str, gateway_prefix: str, service_url_env: str):
+    if os.environ.get("SERVICE_ROUTING", "gateway") == "direct":
+        base_url = service_base_url(os.environ[service_url_env])
+    else:
+        base_url = f"{os.environ['GATEWAY_URL'].rstrip('/')}{gateway_prefix}"
+    return client_class(
+        base_url,
+        pool_size=int(os.environ.get(f"{name}_POOL_SIZE", 10)),
+        timeout=float(os.environ.get(f"{name}_TIMEOUT", 5)),
+        name=name.lower(),
+    )
+
+
+def make_stock_client(client_class=ServiceClient):
+    return make_client(client_class, "STOCK", "/stock", "STOCK_SERVICE_URL")
+
+
+def make_payment_client(client_class=ServiceClient):
+    return make_client(client_class, "PAYMENT", "/payment", "USER_SERVICE_URL")
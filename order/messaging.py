@@ -0,0 +1,155 @@
+"""Checkout over Redis Streams (CHECKOUT_MODE=messaging).
+
+Instead of calling stock and payment over HTTP, the checkout saga sends
+commands to the stock and payment workers through streams on the order
+Redis and advances when their replies arrive (see common/streams.py):
+
+    checkout -> reserve (stock) -> pay (payment) -> completed
+                                       \\-> release (stock) -> aborted
+
+The HTTP request only records the saga and publishes the first command.
+It then waits up to CHECKOUT_DEADLINE seconds for the outcome; if the
+workers are behind, it returns 202 and the outcome can be fetched from
+/checkout_status/<saga_id>. A backlog therefore queues up in the streams
+instead of holding HTTP connections open along the whole call chain.
+
+Replies are handled by a consumer thread in every order process. The saga
+records are the same as in HTTP mode, so stalled sagas are recovered by
+the saga worker of saga.py.
+"""
+import json
+import logging
+
+from common.idempotency import IdempotencyStore
+from common.streams import (
+    ORDER_REPLIES, PAYMENT_COMMANDS, STOCK_COMMANDS, StreamConsumer, publish
+)
+from saga import (
+    ABORTED, COMPENSATING, COMPLETED, DONE, FAILED, STARTED, STOCK_RESERVED,
+    CheckoutSaga, result_key, saga_key,
+)
+
+logger = logging.getLogger(__name__)
+
+# Outcomes are kept for the waiting request and the status endpoint
+RESULT_TTL = 3600
+
+
+class MessagingCheckoutSaga(CheckoutSaga):
+    def __init__(self, db, stock_client, payment_client, checkout_store: IdempotencyStore,
+                 **kwargs):
+        super().__init__(db, stock_client, payment_client, **kwargs)
+        self.checkout_store = checkout_store
+
+    def start(self, saga_id, order_id, user_id, total_cost, quantities,
+              checkout_key, replay_failures):
+        """Record the saga and send its first command."""
+        self._record(saga_id, STARTED, {
+            "order_id": order_id,
+            "user_id": user_id,
+            "total_cost": total_cost,
+            "items": json.dumps(quantities),
+            "checkout_key": checkout_key,
+            "replay_failures": int(replay_failures),
+        })
+        if quantities:
+            self._send_stock(saga_id, "reserve", quantities)
+        else:
+            self._send_payment(saga_id, "pay", user_id, order_id, total_cost)
+
+    def wait(self, saga_id, timeout: float):
+        """Return the (body, status) outcome of the saga, or None on timeout."""
+        # Moving the outcome onto its own list leaves it there for the status
+        # endpoint and other waiters
+        outcome = self.db.blmove(result_key(saga_id), result_key(saga_id), timeout)
+        if outcome is None:
+            return None
+        body, status = json.loads(outcome)
+        return body, status
+
+    def resolve(self, saga_id):
+        super().resolve(saga_id)
+        # A saga finished by the saga worker still owes its waiters an outcome
+        saga_data = self.db.hgetall(saga_key(saga_id))
+        saga = {key.decode(): value.decode() for key, value in saga_data.items()}
+        if "checkout_key" in saga and not self.db.exists(result_key(saga_id)):
+            if saga["state"] == COMPLETED:
+                self._set_result(saga, saga_id, {"status": "success"}, 200)
+            elif saga["state"] == ABORTED:
+                self._set_result(saga, saga_id, {"error": "Checkout failed"}, 400)
+
+    def handle_reply(self, reply):
+        saga_id = reply["saga_id"]
+        saga_data = self.db.hgetall(saga_key(saga_id))
+        if not saga_data:
+            return
+        saga = {key.decode(): value.decode() for key, value in saga_data.items()}
+        state = saga["state"]
+        ok = reply["ok"] == "1"
+        quantities = json.loads(saga["items"])
+
+        if reply["step"] == "reserve" and state == STARTED:
+            if ok:
+                self._record(saga_id, STOCK_RESERVED, {"stock": DONE})
+                self._send_payment(saga_id, "pay", saga["user_id"], saga["order_id"],
+                                   saga["total_cost"])
+            else:
+                self._finish(saga_id, ABORTED, {"stock": FAILED})
+                self._set_result(saga, saga_id, {"error": "Not enough stock"}, 400)
+
+        elif reply["step"] == "pay" and state in (STARTED, STOCK_RESERVED):
+            if ok:
+                self._finish(saga_id, COMPLETED, {"payment": DONE}, order_id=saga["order_id"])
+                self._set_result(saga, saga_id, {"status": "success"}, 200)
+            else:
+                if quantities:
+                    self._record(saga_id, COMPENSATING, {"payment": FAILED})
+                    self._send_stock(saga_id, "release", quantities)
+                else:
+                    self._finish(saga_id, ABORTED, {"payment": FAILED})
+                self._set_result(saga, saga_id, {"error": "Payment failed"}, 400)
+
+        elif reply["step"] == "pay" and ok and state in (COMPENSATING, ABORTED):
+            # The saga was given up (e.g. recovered after a timeout) while the
+            # pay command was still queued; refund the late payment
+            self._send_payment(saga_id, "cancel", saga["user_id"], saga["order_id"],
+                               saga["total_cost"])
+
+        elif reply["step"] == "release" and state == COMPENSATING:
+            if not ok:
+                raise RuntimeError(f"Releasing stock of saga {saga_id} failed: {reply['error']}")
+            self._finish(saga_id, ABORTED, {"compensated": "True"})
+
+    def start_reply_consumer(self):
+        return StreamConsumer(self.db, ORDER_REPLIES, "order", self.handle_reply).start()
+
+    def _send_stock(self, saga_id, command, quantities):
+        publish(self.db, STOCK_COMMANDS, {
+            "type": command,
+            "saga_id": saga_id,
+            "key": f"{saga_id}:{command}",
+            "items": json.dumps(quantities),
+        })
+
+    def _send_payment(self, saga_id, command, user_id, order_id, amount):
+        publish(self.db, PAYMENT_COMMANDS, {
+            "type": command,
+            "saga_id": saga_id,
+            # A cancel names the payment it cancels
+            "key": f"{saga_id}:pay",
+            "user_id": user_id,
+            "order_id": order_id,
+            "amount": amount,
+        })
+
+    def _set_result(self, saga, saga_id, body, status):
+        outcome = json.dumps([body, status])
+        pipe = self.db.pipeline(transaction=True)
+        pipe.rpush(result_key(saga_id), outcome)
+        pipe.expire(result_key(saga_id), RESULT_TTL)
+        pipe.execute()
+        # Same replay rules as a synchronous checkout, see app.checkout
+        if status == 200 or saga["replay_failures"] == "1":
+            self.checkout_store.complete(saga["checkout_key"], status, body)
+        else:
+            self.checkout_store.release(saga["checkout_key"])
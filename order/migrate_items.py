@@ -0,0 +1,38 @@
+"""Move the order lines of existing orders into per-order item hashes.
+
+Orders created before the items hash was introduced store their lines in
+the ``items`` field of ``order:<id>`` as a Python list literal. The order
+service migrates such an order lazily the first time it is mutated; this
+script migrates all of them up front, e.g. right after a deploy:
+
+    REDIS_HOST=... REDIS_PORT=... REDIS_PASSWORD=... REDIS_DB=0 python migrate_items.py
+
+It only uses SCAN, so it can run against a live database.
+"""
+import redis
+
+import scripts
+from common.sharding import connect
+
+SCAN_BATCH = 1000
+
+
+def items_key(order_key: bytes) -> bytes:
+    return order_key + b":items"
+
+
+def migrate(db: redis.Redis) -> int:
+    migrate_script = db.register_script(scripts.MIGRATE_ITEMS)
+    migrated = 0
+    for order_key in db.scan_iter(match="order:*", count=SCAN_BATCH):
+        if order_key.count(b":") != 1:
+            # Not an order hash, e.g. an order:<id>:items key
+            continue
+        migrated += migrate_script(keys=[order_key, items_key(order_key)])
+    return migrated
+
+
+if __name__ == "__main__":
+    # REDIS_NODES instead of REDIS_HOST migrates every node of a sharded keyspace
+    connection = connect()
+    print(f"Migrated {migrate(connection)} orders")
@@ -0,0 +1,98 @@
+"""Order key layout and decoding shared by the sync and async order services."""
+import ast
+import os
+
+# Unpaid orders expire this many seconds after their last change; 0, the
+# default, keeps them forever. Paid orders do not expire, archive_orders.py
+# moves them to cold storage.
+ORDER_TTL = int(os.environ.get("ORDER_TTL", 0))
+# Sorted set of paid order ids, scored by the time they were paid
+PAID_ORDERS_KEY = "orders:paid"
+# Hash of counters on reclaimed orders, see reaper.py and archive_orders.py
+ORDER_STATS_KEY = "stats:orders"
+
+# Orders listed per page of /user/<user_id> by default and at most
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def order_keys(order_id):
+    return f"order:{order_id}", f"order:{order_id}:items"
+
+
+def user_orders_key(user_id):
+    """Sorted set of a user's order ids, scored by creation time in milliseconds."""
+    return f"user:{user_id}:orders"
+
+
+def new_order(order_id, user_id, created_at):
+    return {
+        "order_id": order_id,
+        "paid": "False",
+        "user_id": user_id,
+        "total_cost": 0,
+        "created_at": created_at,
+    }
+
+
+def decode_order(order_data, items_data):
+    """Return (order fields, {item_id: quantity}) or (None, None) if missing."""
+    if not order_data:
+        return None, None
+    quantities = {item_id.decode(): int(quantity) for item_id, quantity in items_data.items()}
+    legacy_items = order_data.pop(b"items", None)
+    if legacy_items is not None:
+        # Not migrated yet, see migrate_items.py
+        for item_id in ast.literal_eval(legacy_items.decode()):
+            quantities[item_id] = quantities.get(item_id, 0) + 1
+    return order_data, quantities
+
+
+def order_to_json(order_data, quantities):
+    order = {key.decode(): value.decode() for key, value in order_data.items()}
+    order["items"] = [
+        item_id for item_id, quantity in quantities.items() for _ in range(quantity)
+    ]
+    return order
+
+
+def parse_page(cursor, limit):
+    """Return (max score, order id to continue after, limit) or None if invalid.
+
+    A cursor is "<score>:<order_id>" of the last order of the previous page.
+    """
+    try:
+        limit = int(limit) if limit else DEFAULT_PAGE_SIZE
+        if not cursor:
+            return "+inf", "", min(max(limit, 1), MAX_PAGE_SIZE)
+        score, _, order_id = cursor.partition(":")
+        return int(score), order_id, min(max(limit, 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return None
+
+
+def order_page(entries, summaries, limit):
+    """Build the response of a listing from the (order_id, score) entries
+    of LIST_ORDERS and the paid, total_cost fields of their orders."""
+    orders = []
+    for (order_id, _), (paid, total_cost) in zip(entries[:limit], summaries):
+        if paid is None:
+            # Removed while the page was read
+            continue
+        orders.append({
+            "order_id": order_id,
+            "paid": paid.decode() == "True",
+            "total_cost": int(total_cost),
+        })
+    next_cursor = None
+    if len(entries) > limit:
+        order_id, score = entries[limit - 1]
+        next_cursor = f"{score}:{order_id}"
+    return {"orders": orders, "next_cursor": next_cursor}
+
+
+def decode_entries(result):
+    """Pair up the flat [order_id, score, ...] reply of LIST_ORDERS."""
+    return [
+        (result[i].decode(), int(float(result[i + 1]))) for i in range(0, len(result), 2)
+    ]
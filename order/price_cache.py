@@ -0,0 +1,108 @@
+"""In-process cache of item prices for the order service.
+
+Prices almost never change, but add_item and remove_item need one on every
+call. The cache is a bounded LRU with a TTL per entry. The stock service
+publishes the id of every item whose price changes on PRICE_CHANNEL, and
+``subscribe`` drops those entries as soon as the message arrives. The TTL
+bounds staleness if a message is missed, e.g. while the subscriber is
+reconnecting or the stock Redis is not up yet.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+from common.channels import PRICE_CHANNEL
+
+# Seconds between attempts to (re)subscribe, doubling up to the maximum
+SUBSCRIBE_BACKOFF = 0.5
+SUBSCRIBE_MAX_BACKOFF = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+class PriceCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, item_id: str):
+        """Return the cached price of the item, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(item_id)
+            if entry is not None:
+                price, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(item_id)
+                    self.hits += 1
+                    return price
+                del self._entries[item_id]
+            self.misses += 1
+            return None
+
+    def put(self, item_id: str, price: int):
+        with self._lock:
+            self._entries[item_id] = (price, time.monotonic() + self.ttl)
+            self._entries.move_to_end(item_id)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, item_id: str):
+        with self._lock:
+            if self._entries.pop(item_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+    def subscribe(self, stock_db: redis.Redis) -> threading.Thread:
+        """Invalidate entries on price changes published by the stock service.
+
+        The subscription is made in a daemon thread, which retries with
+        backoff while the stock Redis is unreachable, so the order service
+        starts without it; until then only the TTL bounds staleness.
+        """
+
+        def listen():
+            backoff = SUBSCRIBE_BACKOFF
+            while True:
+                pubsub = stock_db.pubsub(ignore_subscribe_messages=True)
+                try:
+                    pubsub.subscribe(**{PRICE_CHANNEL: self._on_price_change})
+                    # Invalidations may have been lost while disconnected
+                    self.clear()
+                    backoff = SUBSCRIBE_BACKOFF
+                    while True:
+                        pubsub.get_message(timeout=1.0)
+                except Exception as ex:
+                    logger.warning("Price channel subscriber failed, retrying in %.1fs: %s", backoff, ex)
+                finally:
+                    pubsub.close()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, SUBSCRIBE_MAX_BACKOFF)
+
+        thread = threading.Thread(target=listen, name="price-subscriber", daemon=True)
+        thread.start()
+        return thread
+
+    def _on_price_change(self, message):
+        self.invalidate(message["data"].decode())
@@ -0,0 +1,87 @@
+"""Reclaiming memory of abandoned and archived orders.
+
+Unpaid orders expire on their own (orders.ORDER_TTL), but their ids stay
+in the per-user order indexes. The reaper sweeps the indexes in the
+background and drops ids whose order no longer exists. Only one process
+sweeps per interval; the others skip while the sweep lock is held.
+
+memory_stats() reports the Redis memory use together with the counters
+of reclaimed orders, kept in orders.ORDER_STATS_KEY so that all workers
+add to the same numbers.
+"""
+import logging
+import os
+import threading
+import time
+
+from common.sharding import node_clients
+from orders import ORDER_STATS_KEY
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two sweeps of the user indexes; 0 disables the reaper.
+# It only runs if orders expire, i.e. ORDER_TTL is set.
+REAPER_INTERVAL = float(os.environ.get("ORDER_REAPER_INTERVAL", 300))
+LOCK_KEY = "reaper:lock"
+SCAN_BATCH = 1000
+
+
+class OrderReaper:
+    def __init__(self, db, interval: float = REAPER_INTERVAL):
+        self.db = db
+        self.interval = interval
+
+    def sweep(self) -> int:
+        """Drop expired orders from all user indexes and return how many."""
+        reaped = 0
+        for index_key in self.db.scan_iter(match="user:*:orders", count=SCAN_BATCH):
+            reaped += self.sweep_index(index_key)
+        if reaped:
+            self.db.hincrby(ORDER_STATS_KEY, "expired_orders_reaped", reaped)
+        return reaped
+
+    def sweep_index(self, index_key) -> int:
+        reaped = 0
+        start = 0
+        while True:
+            order_ids = self.db.zrange(index_key, start, start + SCAN_BATCH - 1)
+            if not order_ids:
+                return reaped
+            pipe = self.db.pipeline(transaction=False)
+            for order_id in order_ids:
+                pipe.exists(f"order:{order_id.decode()}")
+            gone = [order_id for order_id, exists in zip(order_ids, pipe.execute()) if not exists]
+            if gone:
+                self.db.zrem(index_key, *gone)
+                reaped += len(gone)
+            start += len(order_ids) - len(gone)
+
+    def start(self) -> threading.Thread:
+        def work():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    if self.db.set(LOCK_KEY, os.getpid(), nx=True, ex=max(int(self.interval), 1)):
+                        reaped = self.sweep()
+                        if reaped:
+                            logger.info("Reaped %d expired orders from user indexes", reaped)
+                except Exception:
+                    logger.exception("Reaping expired orders failed")
+
+        thread = threading.Thread(target=work, name="order-reaper", daemon=True)
+        thread.start()
+        return thread
+
+
+def memory_stats(db) -> dict:
+    """Memory use of the order Redis, summed over its nodes, and reclaim counters."""
+    stats = {"used_memory": 0, "maxmemory": 0, "expired_keys": 0, "evicted_keys": 0}
+    for node in node_clients(db):
+        memory = node.info("memory")
+        counters = node.info("stats")
+        stats["used_memory"] += memory.get("used_memory", 0)
+        stats["maxmemory"] += memory.get("maxmemory", 0)
+        stats["expired_keys"] += counters.get("expired_keys", 0)
+        stats["evicted_keys"] += counters.get("evicted_keys", 0)
+    stats.update({key.decode(): int(value) for key, value in db.hgetall(ORDER_STATS_KEY).items()})
+    return stats
@@ -0,0 +1,418 @@
+"""Checkout saga with a durable step log and background compensation.
+
+A checkout is a saga of two steps on other services: reserve the basket in
+the stock service, then charge the user in the payment service
+(AsyncCheckoutSaga runs both at once). Every step is recorded in the order
+Redis before the request moves on:
+
+* ``saga:<id>``  hash with the saga's input, state and step outcomes
+* ``sagas:active``  sorted set of unfinished sagas, scored by last update
+* ``sagas:compensate``  list of sagas waiting for compensation
+* ``saga:log``  capped stream of every step, for auditing
+
+The request path only runs the forward steps. If a step fails after stock
+was reserved, the saga is queued for compensation and the request returns
+right away; a background worker then releases the stock and cancels the
+payment. The worker also picks up sagas that stopped making progress, e.g.
+because the pod running them was killed, and finishes or compensates them.
+
+Every call to another service carries an idempotency key derived from the
+saga id, so steps and compensations can safely be repeated after a crash.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+import httpx
+import requests
+
+from common.idempotency import IDEMPOTENCY_HEADER, PAYMENT_KEY_HEADER
+from orders import PAID_ORDERS_KEY, order_keys
+
+logger = logging.getLogger(__name__)
+
+# A saga that has not been updated for this many seconds is considered
+# abandoned by its worker and is recovered by the background worker
+SAGA_TIMEOUT = float(os.environ.get("SAGA_TIMEOUT", 30))
+# Finished sagas are kept this long for inspection
+SAGA_RETENTION = int(os.environ.get("SAGA_RETENTION", 7 * 24 * 3600))
+SAGA_LOG_MAXLEN = int(os.environ.get("SAGA_LOG_MAXLEN", 100000))
+
+ACTIVE_KEY = "sagas:active"
+QUEUE_KEY = "sagas:compensate"
+LOG_KEY = "saga:log"
+
+# Saga states
+STARTED = "STARTED"
+STOCK_RESERVED = "STOCK_RESERVED"
+COMPLETED = "COMPLETED"
+COMPENSATING = "COMPENSATING"
+ABORTED = "ABORTED"
+
+# Step outcomes; a step without an outcome may or may not have happened
+DONE = "done"
+FAILED = "failed"
+
+# KEYS[1]: saga key, KEYS[2]: active set, KEYS[3]: compensation queue
+# ARGV[1]: cutoff time, ARGV[2]: now, ARGV[3]: saga id
+# Queues an unfinished saga that was last updated before the cutoff.
+# Returns 1 if it was queued, 0 otherwise.
+RECOVER_SCRIPT = """
+local state = redis.call('HGET', KEYS[1], 'state')
+if not state or state == 'COMPLETED' or state == 'ABORTED' then
+    redis.call('ZREM', KEYS[2], ARGV[3])
+    return 0
+end
+local updated_at = tonumber(redis.call('HGET', KEYS[1], 'updated_at'))
+if updated_at > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'state', 'COMPENSATING', 'updated_at', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[3])
+redis.call('RPUSH', KEYS[3], ARGV[3])
+return 1
+"""
+
+
+def saga_key(saga_id):
+    return f"saga:{saga_id}"
+
+
+def result_key(saga_id):
+    """List holding the JSON [body, status] outcome of an asynchronous saga."""
+    return f"saga:{saga_id}:result"
+
+
+def claim_ttl(stock_client, payment_client, timeout: float = SAGA_TIMEOUT) -> int:
+    """Seconds a checkout keeps its idempotency key claimed.
+
+    A checkout answers within the timeouts of its two calls. If its worker
+    dies first, the saga worker recovers the saga after the saga timeout,
+    and the key may be tried again.
+    """
+    return math.ceil(stock_client.timeout + payment_client.timeout + timeout)
+
+
+def step_succeeded(response) -> bool:
+    """True if a step went through, False if the service refused it (4xx).
+
+    Any other status leaves the outcome unknown, e.g. a Redis error after
+    the script ran, and raises requests.HTTPError like a lost response.
+    """
+    if response.status_code == 200:
+        return True
+    if 400 <= response.status_code < 500:
+        return False
+    raise requests.HTTPError(
+        f"{response.status_code} from {response.url}", response=response
+    )
+
+
+class CheckoutSaga:
+    def __init__(self, db, stock_client, payment_client, timeout: float = SAGA_TIMEOUT):
+        self.db = db
+        self.stock_client = stock_client
+        self.payment_client = payment_client
+        self.timeout = timeout
+        self.recover_script = db.register_script(RECOVER_SCRIPT)
+
+    # Forward path, runs on the request
+
+    def run(self, saga_id, order_id, user_id, total_cost, quantities):
+        """Run the checkout saga and return the (body, status) of the response."""
+        self._record(saga_id, STARTED, {
+            "order_id": order_id,
+            "user_id": user_id,
+            "total_cost": total_cost,
+            "items": json.dumps(quantities),
+        })
+
+        # Reserve the whole basket in one call; nothing is subtracted if any item is short
+        if quantities:
+            try:
+                reserved = self._reserve_stock(saga_id, quantities)
+            except requests.RequestException:
+                logger.exception("Reserving stock for saga %s failed", saga_id)
+                self._record(saga_id, COMPENSATING, {}, compensate=True)
+                return {"error": "Stock reservation failed"}, 400
+            if not reserved:
+                self._finish(saga_id, ABORTED, {"stock": FAILED})
+                return {"error": "Not enough stock"}, 400
+            self._record(saga_id, STOCK_RESERVED, {"stock": DONE})
+
+        try:
+            paid = self._pay(saga_id, user_id, order_id, total_cost)
+        except requests.RequestException:
+            # The payment may have gone through; the worker cancels it
+            logger.exception("Payment for saga %s failed", saga_id)
+            self._record(saga_id, COMPENSATING, {}, compensate=True)
+            return {"error": "Payment failed"}, 400
+        if paid:
+            self._finish(saga_id, COMPLETED, {"payment": DONE}, order_id=order_id)
+            return {"status": "success"}, 200
+
+        if quantities:
+            self._record(saga_id, COMPENSATING, {"payment": FAILED}, compensate=True)
+        else:
+            self._finish(saga_id, ABORTED, {"payment": FAILED})
+        return {"error": "Payment failed"}, 400
+
+    def status(self, saga_id):
+        """Return the state and, once known, the outcome of a saga."""
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hget(saga_key(saga_id), "state")
+        pipe.lindex(result_key(saga_id), 0)
+        state, outcome = pipe.execute()
+        if state is None:
+            return None
+        status = {"saga_id": saga_id, "state": state.decode()}
+        if outcome is not None:
+            status["result"], status["status"] = json.loads(outcome)
+        return status
+
+    # Background path
+
+    def resolve(self, saga_id):
+        """Finish or compensate a saga that was queued for compensation."""
+        saga_data = self.db.hgetall(saga_key(saga_id))
+        saga = {key.decode(): value.decode() for key, value in saga_data.items()}
+        if not saga or saga["state"] in (COMPLETED, ABORTED):
+            self.db.zrem(ACTIVE_KEY, saga_id)
+            return
+
+        quantities = json.loads(saga["items"])
+        stock = saga.get("stock")
+        payment = saga.get("payment")
+        if payment == DONE and (stock == DONE or not quantities):
+            # Both steps went through but the worker died before recording
+            # the result: roll forward
+            self._finish(saga_id, COMPLETED, {}, order_id=saga["order_id"])
+            return
+
+        if payment != FAILED:
+            # Cancelling a payment that never happened is refused by the
+            # payment service, so an unknown outcome can be cancelled too:
+            # a payment still in flight is refused when it arrives after the
+            # cancellation. Only this saga's payment is cancelled, never a
+            # later one.
+            response = self.payment_client.post(
+                f"/cancel/{saga['user_id']}/{saga['order_id']}",
+                headers={PAYMENT_KEY_HEADER: f"{saga_id}:pay"},
+            )
+            if response.status_code >= 500:
+                raise RuntimeError(f"Cancelling payment of saga {saga_id} failed")
+
+        if quantities and stock != FAILED:
+            if stock != DONE:
+                # The outcome of the reservation is unknown. Repeating it with
+                # the same idempotency key either replays the earlier
+                # reservation or makes it now; both can then be released.
+                stock = DONE if self._reserve_stock(saga_id, quantities) else FAILED
+            if stock == DONE:
+                response = self.stock_client.post(
+                    "/add_batch", json=quantities,
+                    headers={IDEMPOTENCY_HEADER: f"{saga_id}:release"},
+                )
+                if response.status_code != 200:
+                    raise RuntimeError(f"Releasing stock of saga {saga_id} failed")
+
+        self._finish(saga_id, ABORTED, {"compensated": "True"})
+
+    def recover(self) -> int:
+        """Queue sagas that have not made progress within the timeout."""
+        now = time.time()
+        cutoff = now - self.timeout
+        recovered = 0
+        for saga_id in self.db.zrangebyscore(ACTIVE_KEY, "-inf", cutoff):
+            saga_id = saga_id.decode()
+            recovered += self.recover_script(
+                keys=[saga_key(saga_id), ACTIVE_KEY, QUEUE_KEY],
+                args=[cutoff, now, saga_id],
+            )
+        return recovered
+
+    def start_worker(self, poll_interval: float = 1.0) -> threading.Thread:
+        """Run compensations and recovery in a daemon thread."""
+
+        def work():
+            next_recovery = 0
+            while True:
+                try:
+                    if time.monotonic() >= next_recovery:
+                        recovered = self.recover()
+                        if recovered:
+                            logger.info("Recovered %d stalled sagas", recovered)
+                        next_recovery = time.monotonic() + self.timeout / 2
+                    queued = self.db.blpop(QUEUE_KEY, timeout=poll_interval)
+                    if queued is not None:
+                        self.resolve(queued[1].decode())
+                except Exception:
+                    # The saga stays active and is queued again by recover()
+                    logger.exception("Saga worker failed")
+                    time.sleep(poll_interval)
+
+        thread = threading.Thread(target=work, name="saga-worker", daemon=True)
+        thread.start()
+        return thread
+
+    # Helpers
+
+    def _reserve_stock(self, saga_id, quantities):
+        response = self.stock_client.post(
+            "/subtract_batch", json=quantities,
+            headers={IDEMPOTENCY_HEADER: f"{saga_id}:reserve"},
+        )
+        return step_succeeded(response)
+
+    def _pay(self, saga_id, user_id, order_id, amount):
+        response = self.payment_client.post(
+            f"/pay/{user_id}/{order_id}/{amount}",
+            headers={IDEMPOTENCY_HEADER: f"{saga_id}:pay"},
+        )
+        return step_succeeded(response)
+
+    def _record(self, saga_id, state, fields, compensate=False):
+        pipe = self.db.pipeline(transaction=True)
+        queue_record(pipe, saga_id, state, fields, compensate)
+        pipe.execute()
+
+    def _finish(self, saga_id, state, fields, order_id=None):
+        pipe = self.db.pipeline(transaction=True)
+        queue_finish(pipe, saga_id, state, fields, order_id)
+        pipe.execute()
+
+
+class AsyncCheckoutSaga:
+    """The forward path of CheckoutSaga for the ASGI order service.
+
+    Stock is reserved and the payment made at the same time; if either step
+    is refused or its outcome is unknown, the saga is queued for
+    compensation of the other. It writes the same saga records, so failed
+    checkouts and stalled sagas are compensated by the worker of a
+    CheckoutSaga on a blocking connection to the same Redis (see
+    async_app.py).
+    """
+
+    def __init__(self, db, stock_client, payment_client):
+        self.db = db
+        self.stock_client = stock_client
+        self.payment_client = payment_client
+
+    async def run(self, saga_id, order_id, user_id, total_cost, quantities):
+        """Run the checkout saga and return the (body, status) of the response."""
+        await self._record(saga_id, STARTED, {
+            "order_id": order_id,
+            "user_id": user_id,
+            "total_cost": total_cost,
+            "items": json.dumps(quantities),
+        })
+
+        # Both steps are started at once; each returns DONE, FAILED, or None
+        # if its outcome is unknown
+        if quantities:
+            stock, payment = await asyncio.gather(
+                self._reserve_stock(saga_id, quantities),
+                self._pay(saga_id, user_id, order_id, total_cost),
+            )
+        else:
+            stock, payment = None, await self._pay(saga_id, user_id, order_id, total_cost)
+        fields = {name: outcome for name, outcome in (("stock", stock), ("payment", payment))
+                  if outcome is not None}
+
+        if payment == DONE and (stock == DONE or not quantities):
+            await self._finish(saga_id, COMPLETED, fields, order_id=order_id)
+            return {"status": "success"}, 200
+        if payment == FAILED and (stock == FAILED or not quantities):
+            await self._finish(saga_id, ABORTED, fields)
+        else:
+            # The worker undoes whichever step went through or may have
+            await self._record(saga_id, COMPENSATING, fields, compensate=True)
+
+        if stock == FAILED:
+            return {"error": "Not enough stock"}, 400
+        if quantities and stock is None:
+            return {"error": "Stock reservation failed"}, 400
+        return {"error": "Payment failed"}, 400
+
+    async def status(self, saga_id):
+        """See CheckoutSaga.status."""
+        async with self.db.pipeline(transaction=False) as pipe:
+            pipe.hget(saga_key(saga_id), "state")
+            pipe.lindex(result_key(saga_id), 0)
+            state, outcome = await pipe.execute()
+        if state is None:
+            return None
+        status = {"saga_id": saga_id, "state": state.decode()}
+        if outcome is not None:
+            status["result"], status["status"] = json.loads(outcome)
+        return status
+
+    async def _reserve_stock(self, saga_id, quantities):
+        try:
+            response = await self.stock_client.post(
+                "/subtract_batch", json=quantities,
+                headers={IDEMPOTENCY_HEADER: f"{saga_id}:reserve"},
+            )
+            return DONE if step_succeeded(response) else FAILED
+        except (httpx.HTTPError, requests.RequestException):
+            logger.exception("Reserving stock for saga %s failed", saga_id)
+            return None
+
+    async def _pay(self, saga_id, user_id, order_id, amount):
+        try:
+            response = await self.payment_client.post(
+                f"/pay/{user_id}/{order_id}/{amount}",
+                headers={IDEMPOTENCY_HEADER: f"{saga_id}:pay"},
+            )
+            return DONE if step_succeeded(response) else FAILED
+        except (httpx.HTTPError, requests.RequestException):
+            logger.exception("Payment for saga %s failed", saga_id)
+            return None
+
+    async def _record(self, saga_id, state, fields, compensate=False):
+        async with self.db.pipeline(transaction=True) as pipe:
+            queue_record(pipe, saga_id, state, fields, compensate)
+            await pipe.execute()
+
+    async def _finish(self, saga_id, state, fields, order_id=None):
+        async with self.db.pipeline(transaction=True) as pipe:
+            queue_finish(pipe, saga_id, state, fields, order_id)
+            await pipe.execute()
+
+
+def queue_record(pipe, saga_id, state, fields, compensate=False):
+    """Queue the commands recording a step of an unfinished saga on pipe."""
+    now = time.time()
+    pipe.hset(saga_key(saga_id), mapping={**fields, "state": state, "updated_at": now})
+    pipe.zadd(ACTIVE_KEY, {saga_id: now})
+    if compensate:
+        pipe.rpush(QUEUE_KEY, saga_id)
+    queue_log(pipe, saga_id, state, fields)
+
+
+def queue_finish(pipe, saga_id, state, fields, order_id=None):
+    """Queue the commands finishing a saga on pipe; with order_id, mark the order paid."""
+    now = time.time()
+    pipe.hset(saga_key(saga_id), mapping={**fields, "state": state, "updated_at": now})
+    pipe.expire(saga_key(saga_id), SAGA_RETENTION)
+    pipe.zrem(ACTIVE_KEY, saga_id)
+    if order_id is not None:
+        # Paid orders no longer expire; archive_orders.py picks them up
+        pipe.hset(f"order:{order_id}", "paid", "True")
+        for key in order_keys(order_id):
+            pipe.persist(key)
+        pipe.zadd(PAID_ORDERS_KEY, {order_id: now})
+    queue_log(pipe, saga_id, state, fields)
+
+
+def queue_log(pipe, saga_id, state, fields):
+    pipe.xadd(
+        LOG_KEY,
+        {"saga_id": saga_id, "state": state, **fields},
+        maxlen=SAGA_LOG_MAXLEN,
+        approximate=True,
+    )
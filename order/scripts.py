@@ -0,0 +1,107 @@
+"""Lua scripts run atomically inside the order Redis.
+
+Order lines are kept in a separate hash ``order:<id>:items`` that maps
+item_id -> quantity, so adding or removing a line only touches that line.
+"""
+
+# Orders written before the items hash existed keep their lines in the
+# ``items`` field as a Python list literal, e.g. "['1', '2', '1']".
+# This prelude moves such a list into the items hash the first time the
+# order is touched. It expects the order key in KEYS[1] and the items key
+# in KEYS[2].
+MIGRATE_PRELUDE = """
+local legacy = redis.call('HGET', KEYS[1], 'items')
+if legacy then
+    for item_id in string.gmatch(legacy, "'([^']*)'") do
+        redis.call('HINCRBY', KEYS[2], item_id, 1)
+    end
+    redis.call('HDEL', KEYS[1], 'items')
+end
+"""
+
+# KEYS[1]: order key, KEYS[2]: order items key
+# Returns 1 if a legacy list was migrated, 0 otherwise.
+MIGRATE_ITEMS = """
+if redis.call('HEXISTS', KEYS[1], 'items') == 0 then
+    return 0
+end
+""" + MIGRATE_PRELUDE + """
+return 1
+"""
+
+# Unpaid orders expire a while after their last change, see orders.ORDER_TTL.
+# This epilogue restarts the expiry of both keys of an unpaid order. It
+# expects the order key in KEYS[1], the items key in KEYS[2] and the TTL in
+# seconds, 0 for none, in the local ttl.
+REFRESH_TTL = """
+if ttl > 0 and redis.call('HGET', KEYS[1], 'paid') ~= 'True' then
+    redis.call('EXPIRE', KEYS[1], ttl)
+    redis.call('EXPIRE', KEYS[2], ttl)
+end
+"""
+
+# KEYS[1]: order key, KEYS[2]: order items key
+# ARGV[1]: item_id, ARGV[2]: quantity, ARGV[3]: unit price, ARGV[4]: TTL
+# Returns the new quantity of the line, or -1 if the order does not exist.
+ADD_ITEM = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+""" + MIGRATE_PRELUDE + """
+local quantity = redis.call('HINCRBY', KEYS[2], ARGV[1], tonumber(ARGV[2]))
+redis.call('HINCRBY', KEYS[1], 'total_cost', tonumber(ARGV[2]) * tonumber(ARGV[3]))
+local ttl = tonumber(ARGV[4])
+""" + REFRESH_TTL + """
+return quantity
+"""
+
+# KEYS[1]: order key, KEYS[2]: order items key
+# ARGV[1]: item_id, ARGV[2]: unit price, ARGV[3]: TTL
+# Removes one unit of the item. Returns the remaining quantity of the line,
+# -1 if the order does not exist or -2 if the item is not in the order.
+REMOVE_ITEM = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+""" + MIGRATE_PRELUDE + """
+local quantity = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+if quantity <= 0 then
+    return -2
+end
+if quantity == 1 then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('HINCRBY', KEYS[2], ARGV[1], -1)
+end
+redis.call('HINCRBY', KEYS[1], 'total_cost', -tonumber(ARGV[2]))
+local ttl = tonumber(ARGV[3])
+""" + REFRESH_TTL + """
+return quantity - 1
+"""
+
+
+# KEYS[1]: user orders index, ARGV[1]: max score or '+inf',
+# ARGV[2]: order id to continue after or '', ARGV[3]: limit
+# Returns up to limit + 1 orders, newest first, as a flat list
+# {order_id, score, ...}. Orders with the same score are listed in reverse
+# order of their ids, so the cursor's id orders them unambiguously.
+LIST_ORDERS = """
+local limit = tonumber(ARGV[3])
+local skip = 0
+if ARGV[2] ~= '' then
+    skip = redis.call('ZCOUNT', KEYS[1], ARGV[1], ARGV[1])
+end
+local entries = redis.call(
+    'ZREVRANGEBYSCORE', KEYS[1], ARGV[1], '-inf', 'WITHSCORES', 'LIMIT', 0, limit + 1 + skip
+)
+local page = {}
+for i = 1, #entries, 2 do
+    local seen = ARGV[2] ~= '' and tonumber(entries[i + 1]) == tonumber(ARGV[1])
+        and entries[i] >= ARGV[2]
+    if not seen and #page < 2 * (limit + 1) then
+        page[#page + 1] = entries[i]
+        page[#page + 1] = entries[i + 1]
+    end
+end
+return page
+"""
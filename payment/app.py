@@ -1,16 +1,39 @@
 import os
 import atexit
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request, stream_with_context
 import redis
 
+import scripts
+from common.buckets import EntityLayout, bucket_stats
+from common.bulk import chunks, parse_id_list, stream_json_object
+from common.idempotency import IDEMPOTENCY_HEADER, PAYMENT_KEY_HEADER, IdempotentScript
+from common.ids import make_generator, public_id
+from common import profiling, tracing
+from common.metrics import instrument_flask, instrument_redis
+from common.sharding import connect
+
 app = Flask("payment-service")
+# Request, Redis and outbound call timings, served at /metrics
+instrument_flask(app)
+instrument_redis()
+# Spans of requests that carry the order service's trace headers, with TRACE_SINK
+tracing.instrument_flask(app)
+# Collapsed-stack profiles of sampled requests, with PROFILING=1 (see /admin/profile)
+profiling.instrument_flask(app)
+
+# Most users a single bulk create may make, and how many are written per pipeline
+BATCH_CREATE_LIMIT = int(os.environ.get("BATCH_CREATE_LIMIT", 100000))
+PIPELINE_CHUNK = 1000
+
+# A plain redis.Redis, or a ShardedRedis if REDIS_NODES lists several nodes
+db = connect()
+
+# With ID_SCHEME=compact new users get compact ids instead of the user_id counter
+id_generator = make_generator(db)
 
-db: redis.Redis = redis.Redis(
-    host=os.environ["REDIS_HOST"],
-    port=int(os.environ["REDIS_PORT"]),
-    password=os.environ["REDIS_PASSWORD"],
-    db=int(os.environ["REDIS_DB"]),
-)
+# Users are user:<id> hashes, or packed into bucket hashes with
+# STORAGE_LAYOUT=buckets; users.ref() gives the key and field prefix of one
+users = EntityLayout("user")
 
 
 def close_db_connection():
@@ -19,68 +42,153 @@ def close_db_connection():
 
 atexit.register(close_db_connection)
 
+# Credit mutations run at most once per Idempotency-Key header when given one
+add_credit_script = IdempotentScript(db, scripts.ADD_CREDIT, "add_funds")
+remove_credit_script = IdempotentScript(db, scripts.REMOVE_CREDIT, "pay")
+cancel_payment_script = db.register_script(scripts.CANCEL_PAYMENT)
+
+
+def preload_scripts():
+    # Scripts are called with EVALSHA; loading them up front saves the
+    # NOSCRIPT retry on the first call of each one.
+    try:
+        for script in (*add_credit_script.scripts, *remove_credit_script.scripts,
+                       cancel_payment_script):
+            db.script_load(script.script)
+    except redis.exceptions.ConnectionError:
+        # Redis is not up yet; redis-py loads each script on first use instead
+        pass
+
+
+preload_scripts()
+
+
+def order_record_key(user_id, order_id):
+    # Named after the user, so that it lives on the user's node when the
+    # keyspace is sharded and the payment scripts can update both at once
+    return users.key_of(user_id, f"order:{order_id}")
+
 
 @app.post("/create_user")
 def create_user():
-    user_id = db.incr("user_id")
-    user_key = f"user:{user_id}"
-    db.hmset(user_key, {"credit": 0})
+    user_id = id_generator.next_id() if id_generator else db.incr("user_id")
+    user_key, prefix = users.ref(user_id)
+    db.hset(user_key, f"{prefix}credit", 0)
     return jsonify({"user_id": user_id}), 200
 
 
+@app.post("/batch_create_users/<count>/<credit>")
+def batch_create_users(count: int, credit: int):
+    """Create count users and return the first and last of their consecutive ids."""
+    count, credit = int(count), int(credit)
+    if not 0 < count <= BATCH_CREATE_LIMIT:
+        return jsonify({"error": f"Count must be between 1 and {BATCH_CREATE_LIMIT}"}), 400
+    last_id = db.incrby("user_id", count)
+    first_id = last_id - count + 1
+    for chunk_start in range(first_id, last_id + 1, PIPELINE_CHUNK):
+        pipe = db.pipeline(transaction=False)
+        for user_id in range(chunk_start, min(chunk_start + PIPELINE_CHUNK, last_id + 1)):
+            user_key, prefix = users.ref(user_id)
+            pipe.hset(user_key, f"{prefix}credit", credit)
+        pipe.execute()
+    return jsonify({"first_id": first_id, "last_id": last_id}), 200
+
+
+@app.get("/stats/buckets")
+def user_bucket_stats():
+    return jsonify(bucket_stats(db, users)), 200
+
+
 @app.get("/find_user/<user_id>")
 def find_user(user_id: str):
-    user_key = f"user:{user_id}"
-    user_data = db.hgetall(user_key)
-    if not user_data:
+    user_key, prefix = users.ref(user_id)
+    credit = db.hget(user_key, f"{prefix}credit")
+    if credit is None:
         return jsonify({"error": "User not found"}), 400
-    return jsonify({"user_id": int(user_id), "credit": int(user_data[b"credit"])}), 200
+    return jsonify({"user_id": public_id(user_id), "credit": int(credit)}), 200
+
+
+@app.post("/find_user_batch")
+def find_users():
+    """Look up a JSON list of user ids; streams {user_id: {user_id, credit} or null}."""
+    user_ids = parse_id_list(request.get_json(silent=True))
+    if user_ids is None:
+        return jsonify({"error": "Expected a list of user ids"}), 400
+
+    def lookups():
+        for batch in chunks(user_ids):
+            pipe = db.pipeline(transaction=False)
+            for user_id in batch:
+                user_key, prefix = users.ref(user_id)
+                pipe.hget(user_key, f"{prefix}credit")
+            yield [
+                (user_id, None if credit is None else {"user_id": public_id(user_id), "credit": int(credit)})
+                for user_id, credit in zip(batch, pipe.execute())
+            ]
+
+    return Response(stream_with_context(stream_json_object(lookups())), mimetype="application/json")
 
 
 @app.post("/add_funds/<user_id>/<amount>")
 def add_credit(user_id: str, amount: int):
-    user_key = f"user:{user_id}"
-    if not db.exists(user_key):
+    user_key, prefix = users.ref(user_id)
+    result = add_credit_script(
+        keys=[user_key],
+        args=[int(amount), prefix],
+        key=request.headers.get(IDEMPOTENCY_HEADER),
+    )
+    if result == -1:
         return jsonify({"error": "User not found"}), 400
-    db.hincrby(user_key, "credit", int(amount))
     return jsonify({"done": True}), 200
 
 
 @app.post("/pay/<user_id>/<order_id>/<amount>")
 def remove_credit(user_id: str, order_id: str, amount: int):
-    user_key = f"user:{user_id}"
-    order_key = f"order:{order_id}"
-    current_credit = int(db.hget(user_key, "credit"))
-
-    if current_credit < int(amount):
+    user_key, prefix = users.ref(user_id)
+    order_key = order_record_key(user_id, order_id)
+    payment_key = request.headers.get(IDEMPOTENCY_HEADER)
+    result = remove_credit_script(
+        keys=[user_key, order_key],
+        args=[int(amount), payment_key or "", prefix],
+        key=payment_key,
+    )
+    if result == -1:
+        return jsonify({"error": "User not found"}), 400
+    if result == -2:
         return jsonify({"error": "Insufficient credit"}), 400
-
-    db.hincrby(user_key, "credit", -int(amount))
-    db.hset(order_key, "paid", "True")
+    if result == scripts.PAYMENT_CANCELLED:
+        return jsonify({"error": "Payment cancelled"}), 400
+    if result == scripts.ORDER_ALREADY_PAID:
+        return jsonify({"error": "Order already paid"}), 400
     return jsonify({"status": "success"}), 200
 
 
-@app.post("/cancel/<user_id>/<order_id>")
-def cancel_payment(user_id: str, order_id: str):
-    user_key = f"user:{user_id}"
-    order_key = f"order:{order_id}"
+def cancel_payment(user_key, order_key, payment_key, prefix):
+    """Run CANCEL_PAYMENT; a payment with payment_key that has not run yet is refused when it does."""
+    keys = [user_key, order_key]
+    if payment_key:
+        keys.append(remove_credit_script.record_key(keys, payment_key))
+    return cancel_payment_script(keys=keys, args=[payment_key, prefix, remove_credit_script.ttl])
 
-    order_data = db.hgetall(order_key)
-    if not order_data:
-        return jsonify({"error": "Order not found"}), 400
 
-    if order_data[b"paid"] == b"True":
-        db.hset(order_key, "paid", "False")
-        total_cost = int(order_data[b"total_cost"])
-        db.hincrby(user_key, "credit", total_cost)
-        return jsonify({"status": "success"}), 200
-    else:
+@app.post("/cancel/<user_id>/<order_id>")
+def cancel_order_payment(user_id: str, order_id: str):
+    user_key, prefix = users.ref(user_id)
+    order_key = order_record_key(user_id, order_id)
+    # Only cancel the payment made with this key, if given, so that a late
+    # compensation cannot refund a later successful payment of the order
+    payment_key = request.headers.get(PAYMENT_KEY_HEADER, "")
+    result = cancel_payment(user_key, order_key, payment_key, prefix)
+    if result == -1:
+        return jsonify({"error": "Order not found"}), 400
+    if result == -2:
         return jsonify({"error": "Payment already cancelled"}), 400
+    return jsonify({"status": "success"}), 200
 
 
 @app.get("/status/<user_id>/<order_id>")
 def payment_status(user_id: str, order_id: str):
-    order_key = f"order:{order_id}"
+    order_key = order_record_key(user_id, order_id)
 
     order_data = db.hgetall(order_key)
     if not order_data:
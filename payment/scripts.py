@@ -0,0 +1,72 @@
+"""Lua scripts run atomically inside the payment Redis.
+
+Each script does its read-check-write in a single round trip, so no other
+request can change the user's credit between the check and the write.
+
+A user is addressed by a key and a field prefix (see common/buckets.py):
+its own hash and "", or the bucket holding it and "<user_id>:". Its credit
+is the field ``<prefix>credit``.
+"""
+
+# KEYS[1]: user key, ARGV[1]: amount, ARGV[2]: field prefix
+# Returns the new credit, or -1 if the user does not exist.
+ADD_CREDIT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[2] .. 'credit') == 0 then
+    return -1
+end
+return redis.call('HINCRBY', KEYS[1], ARGV[2] .. 'credit', tonumber(ARGV[1]))
+"""
+
+# KEYS[1]: user key, KEYS[2]: order key
+# ARGV[1]: amount, ARGV[2]: idempotency key of the payment or "", ARGV[3]: field prefix
+# Returns the new credit, -1 if the user does not exist, -2 if the credit
+# is insufficient or -4 if the order is already paid. On success the order is
+# marked as paid and the amount and key are recorded so that the payment can
+# be cancelled later. A replay of a payment with the same idempotency key
+# never gets here, so an order paid before was paid by another payment, e.g.
+# a concurrent checkout of the same order with another key.
+REMOVE_CREDIT = """
+local credit = redis.call('HGET', KEYS[1], ARGV[3] .. 'credit')
+if not credit then
+    return -1
+end
+if redis.call('HGET', KEYS[2], 'paid') == 'True' then
+    return -4
+end
+if tonumber(credit) < tonumber(ARGV[1]) then
+    return -2
+end
+local new_credit = redis.call('HINCRBY', KEYS[1], ARGV[3] .. 'credit', -tonumber(ARGV[1]))
+redis.call('HSET', KEYS[2], 'paid', 'True', 'total_cost', ARGV[1], 'payment_key', ARGV[2])
+return new_credit
+"""
+
+# KEYS[1]: user key, KEYS[2]: order key, KEYS[3]: idempotency record of the
+# payment to cancel (only with ARGV[1])
+# ARGV[1]: idempotency key of the payment to cancel, or "" for any payment,
+# ARGV[2]: field prefix, ARGV[3]: TTL of the idempotency record
+# Refunds a paid order. Returns the new credit, -1 if the order is unknown
+# or -2 if it is not paid (never paid, already cancelled, or paid by a
+# payment with another key).
+# A payment that has not run yet, e.g. one still in flight when its caller
+# timed out, cannot be refunded; its idempotency record is set to
+# PAYMENT_CANCELLED instead, so that it is refused when it arrives.
+CANCEL_PAYMENT = """
+if ARGV[1] ~= '' and redis.call('SET', KEYS[3], '-3', 'NX', 'EX', ARGV[3]) then
+    return -2
+end
+local order = redis.call('HMGET', KEYS[2], 'paid', 'total_cost', 'payment_key')
+if not order[1] then
+    return -1
+end
+if order[1] ~= 'True' or (ARGV[1] ~= '' and order[3] ~= ARGV[1]) then
+    return -2
+end
+redis.call('HSET', KEYS[2], 'paid', 'False')
+return redis.call('HINCRBY', KEYS[1], ARGV[2] .. 'credit', tonumber(order[2]))
+"""
+
+# What a payment replays when it was cancelled before it ran
+PAYMENT_CANCELLED = -3
+# What REMOVE_CREDIT returns for an order that is already paid
+ORDER_ALREADY_PAID = -4
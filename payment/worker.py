@@ -0,0 +1,50 @@
+"""Payment worker for the messaging checkout mode.
+
+Consumes pay and cancel commands from the commands:payment stream as a
+member of the "payment" consumer group and replies on replies:order. Run
+one or more next to the payment service:
+
+    BUS_REDIS_HOST=order-db python worker.py
+"""
+import logging
+
+import scripts
+from app import cancel_payment, order_record_key, remove_credit_script, users
+from common.streams import (
+    ORDER_REPLIES, PAYMENT_COMMANDS, StreamConsumer, bus_connection, publish
+)
+
+bus = bus_connection()
+
+PAY_ERRORS = {
+    -1: "User not found",
+    -2: "Insufficient credit",
+    scripts.PAYMENT_CANCELLED: "Payment cancelled",
+    scripts.ORDER_ALREADY_PAID: "Order already paid",
+}
+CANCEL_ERRORS = {-1: "Order not found", -2: "Payment already cancelled"}
+
+
+def handle_command(command):
+    user_key, prefix = users.ref(command["user_id"])
+    keys = [user_key, order_record_key(command["user_id"], command["order_id"])]
+    if command["type"] == "pay":
+        # The key of the payment is recorded so that it can be cancelled
+        result = remove_credit_script(
+            keys=keys, args=[int(command["amount"]), command["key"], prefix], key=command["key"]
+        )
+        error = PAY_ERRORS.get(result)
+    else:
+        result = cancel_payment(*keys, command["key"], prefix)
+        error = CANCEL_ERRORS.get(result)
+    publish(bus, ORDER_REPLIES, {
+        "saga_id": command["saga_id"],
+        "step": command["type"],
+        "ok": "0" if error else "1",
+        "error": error or "",
+    })
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    StreamConsumer(bus, PAYMENT_COMMANDS, "payment", handle_command).run_forever()
@@ -1,16 +1,53 @@
 import os
 import atexit
-from flask import Flask, jsonify
+import logging
+import random
+import threading
+import time
+from flask import Flask, Response, jsonify, request, stream_with_context
 import redis
 
+import scripts
+from common.buckets import EntityLayout, bucket_stats
+from common.bulk import chunks, parse_id_list, stream_json_object
+from common.channels import PRICE_CHANNEL
+from common.idempotency import IDEMPOTENCY_HEADER, IdempotentScript
+from common.ids import make_generator
+from common import profiling, tracing
+from common.metrics import instrument_flask, instrument_redis
+from common.sharding import connect, group_by_node
+
 app = Flask("stock-service")
+# Request, Redis and outbound call timings, served at /metrics
+instrument_flask(app)
+instrument_redis()
+# Spans of requests that carry the order service's trace headers, with TRACE_SINK
+tracing.instrument_flask(app)
+# Collapsed-stack profiles of sampled requests, with PROFILING=1 (see /admin/profile)
+profiling.instrument_flask(app)
+
+# Hot items can keep their stock on several counters (see scripts.py).
+# STOCK_SHARDS is the shard count of new items; 0 keeps them unsharded.
+STOCK_SHARDS = int(os.environ.get("STOCK_SHARDS", 0))
+SHARDED_ITEMS_KEY = "items:sharded"
+# Seconds between two passes that even out the shards of sharded items
+REBALANCE_INTERVAL = float(os.environ.get("STOCK_REBALANCE_INTERVAL", 5))
+
+# Most items a single bulk create may make, and how many are written per pipeline
+BATCH_CREATE_LIMIT = int(os.environ.get("BATCH_CREATE_LIMIT", 100000))
+PIPELINE_CHUNK = 1000
+
+logger = logging.getLogger("stock-service")
 
-db: redis.Redis = redis.Redis(
-    host=os.environ["REDIS_HOST"],
-    port=int(os.environ["REDIS_PORT"]),
-    password=os.environ["REDIS_PASSWORD"],
-    db=int(os.environ["REDIS_DB"]),
-)
+# A plain redis.Redis, or a ShardedRedis if REDIS_NODES lists several nodes
+db = connect()
+
+# With ID_SCHEME=compact new items get compact ids instead of the item_id counter
+id_generator = make_generator(db)
+
+# Items are item:<id> hashes, or packed into bucket hashes with
+# STORAGE_LAYOUT=buckets; items.ref() gives the key and field prefix of one
+items = EntityLayout("item")
 
 
 def close_db_connection():
@@ -19,45 +56,280 @@ def close_db_connection():
 
 atexit.register(close_db_connection)
 
+# Stock mutations run at most once per Idempotency-Key header when given one
+add_stock_script = IdempotentScript(db, scripts.ADD_STOCK, "add")
+subtract_stock_script = IdempotentScript(db, scripts.SUBTRACT_STOCK, "subtract")
+subtract_batch_script = IdempotentScript(db, scripts.SUBTRACT_BATCH, "subtract_batch")
+add_batch_script = IdempotentScript(db, scripts.ADD_BATCH, "add_batch")
+set_price_script = db.register_script(scripts.SET_PRICE)
+shard_stock_script = db.register_script(scripts.SHARD_STOCK)
+find_item_script = db.register_script(scripts.FIND_ITEM)
+rebalance_script = db.register_script(scripts.REBALANCE_STOCK)
+
+
+def preload_scripts():
+    # Scripts are called with EVALSHA; loading them up front saves the
+    # NOSCRIPT retry on the first call of each one.
+    try:
+        for script in (*add_stock_script.scripts, *subtract_stock_script.scripts,
+                       *subtract_batch_script.scripts, *add_batch_script.scripts,
+                       set_price_script, shard_stock_script, find_item_script,
+                       rebalance_script):
+            db.script_load(script.script)
+    except redis.exceptions.ConnectionError:
+        # Redis is not up yet; redis-py loads each script on first use instead
+        pass
+
+
+preload_scripts()
+
+
+def shard_seed():
+    """Where a subtract starts taking stock on sharded items."""
+    return random.getrandbits(16)
+
+
+def iter_batches(iterable, size):
+    batch = []
+    for element in iterable:
+        batch.append(element)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def rebalance_shards() -> int:
+    """Even out the shards of all sharded items and return how many there are."""
+    rebalanced = 0
+    for batch in iter_batches(db.sscan_iter(SHARDED_ITEMS_KEY, count=500), 500):
+        pipe = db.pipeline(transaction=False)
+        for item_id in batch:
+            item_key, prefix = items.ref(item_id.decode())
+            rebalance_script(keys=[item_key], args=[prefix], client=pipe)
+        pipe.execute()
+        rebalanced += len(batch)
+    return rebalanced
+
+
+def start_rebalancer() -> threading.Thread:
+    def work():
+        while True:
+            time.sleep(REBALANCE_INTERVAL)
+            try:
+                rebalance_shards()
+            except Exception:
+                logger.exception("Rebalancing stock shards failed")
+
+    thread = threading.Thread(target=work, name="stock-rebalancer", daemon=True)
+    thread.start()
+    return thread
+
+
+if REBALANCE_INTERVAL > 0:
+    start_rebalancer()
+
+
+def parse_batch(batch):
+    if not isinstance(batch, dict) or not batch:
+        return None
+    try:
+        return [(str(item_id), int(amount)) for item_id, amount in batch.items()]
+    except (TypeError, ValueError):
+        return None
+
+
+def run_batch_script(script, batch, idempotency_key=None):
+    """Run a batch script; returns None, or (status, item_id) of the item that failed it.
+
+    With a sharded Redis the items of a batch may live on several nodes. The
+    batch then runs as one script per node, and the parts that went through
+    are undone when a later part fails, so that it still applies as a whole.
+    """
+    parts = group_by_node(db, [items.ref(item_id)[0] for item_id, _ in batch])
+    if len(parts) == 1:
+        return run_batch_part(script, batch, idempotency_key)
+
+    undo_script = add_batch_script if script is subtract_batch_script else subtract_batch_script
+    for n, (node_name, indices) in enumerate(parts):
+        part_key = f"{idempotency_key}:{node_name}" if idempotency_key else None
+        failure = run_batch_part(script, [batch[i] for i in indices], part_key)
+        if failure is None:
+            continue
+        for done_name, done_indices in parts[:n]:
+            undo_key = f"{idempotency_key}:{done_name}:undo" if idempotency_key else None
+            if run_batch_part(undo_script, [batch[i] for i in done_indices], undo_key):
+                logger.error("Undoing part of a batch on %s failed", done_name)
+        return failure
+    return None
+
+
+def run_batch_part(script, batch, idempotency_key):
+    item_ids = [item_id for item_id, _ in batch]
+    refs = [items.ref(item_id) for item_id in item_ids]
+    result = script(
+        keys=[item_key for item_key, _ in refs],
+        args=[*(amount for _, amount in batch), shard_seed(), *(prefix for _, prefix in refs)],
+        key=idempotency_key,
+    )
+    status = int(result[0])
+    if status == 0:
+        return None
+    return status, item_ids[int(result[1]) - 1]
+
 
 @app.post("/item/create/<price>")
 def create_item(price: int):
-    item_id = db.incr("item_id")
-    item_key = f"item:{item_id}"
-    db.hmset(item_key, {"price": price, "stock": 0})
+    item_id = id_generator.next_id() if id_generator else db.incr("item_id")
+    item_key, prefix = items.ref(item_id)
+    if STOCK_SHARDS > 1:
+        # The shard counters start out missing, which reads as 0
+        db.hset(item_key, mapping={f"{prefix}price": price, f"{prefix}shards": STOCK_SHARDS})
+        db.sadd(SHARDED_ITEMS_KEY, item_id)
+    else:
+        db.hset(item_key, mapping={f"{prefix}price": price, f"{prefix}stock": 0})
     return jsonify({"item_id": item_id}), 200
 
 
+@app.post("/item/batch_create/<count>/<stock>/<price>")
+def batch_create_items(count: int, stock: int, price: int):
+    """Create count items and return the first and last of their consecutive ids."""
+    count, stock, price = int(count), int(stock), int(price)
+    if not 0 < count <= BATCH_CREATE_LIMIT:
+        return jsonify({"error": f"Count must be between 1 and {BATCH_CREATE_LIMIT}"}), 400
+    last_id = db.incrby("item_id", count)
+    first_id = last_id - count + 1
+    for batch in iter_batches(range(first_id, last_id + 1), PIPELINE_CHUNK):
+        pipe = db.pipeline(transaction=False)
+        for item_id in batch:
+            item_key, prefix = items.ref(item_id)
+            if STOCK_SHARDS > 1:
+                pipe.hset(item_key, mapping={f"{prefix}price": price, f"{prefix}shards": STOCK_SHARDS})
+                share, rest = divmod(stock, STOCK_SHARDS)
+                for shard in range(STOCK_SHARDS):
+                    pipe.set(items.key_of(item_id, f"stock:{shard}"), share + (shard < rest))
+                pipe.sadd(SHARDED_ITEMS_KEY, item_id)
+            else:
+                pipe.hset(item_key, mapping={f"{prefix}price": price, f"{prefix}stock": stock})
+        pipe.execute()
+    return jsonify({"first_id": first_id, "last_id": last_id}), 200
+
+
+@app.post("/item/shard/<item_id>/<shards>")
+def shard_item(item_id: str, shards: int):
+    """Spread the stock of an item over the given number of counters; 1 merges them."""
+    shards = int(shards)
+    item_key, prefix = items.ref(item_id)
+    stock = shard_stock_script(keys=[item_key], args=[shards, prefix])
+    if stock == -1:
+        return jsonify({"error": "Item not found"}), 400
+    # Kept apart from the item, which may live on another node; the
+    # rebalancer skips items in the set that are not sharded
+    if shards > 1:
+        db.sadd(SHARDED_ITEMS_KEY, item_id)
+    else:
+        db.srem(SHARDED_ITEMS_KEY, item_id)
+    return jsonify({"stock": stock, "shards": max(shards, 1)}), 200
+
+
+@app.post("/item/price/<item_id>/<price>")
+def set_price(item_id: str, price: int):
+    item_key, prefix = items.ref(item_id)
+    if set_price_script(keys=[item_key], args=[int(price), PRICE_CHANNEL, item_id, prefix]) == -1:
+        return jsonify({"error": "Item not found"}), 400
+    return jsonify({"done": True}), 200
+
+
+@app.get("/stats/buckets")
+def item_bucket_stats():
+    return jsonify(bucket_stats(db, items)), 200
+
+
 @app.get("/find/<item_id>")
 def find_item(item_id: str):
-    item_key = f"item:{item_id}"
-    item_data = db.hgetall(item_key)
-    if not item_data:
+    item_key, prefix = items.ref(item_id)
+    # A script, so that the shards of a sharded item are summed consistently
+    item_data = find_item_script(keys=[item_key], args=[prefix])
+    if item_data == -1:
         return jsonify({"error": "Item not found"}), 400
-    return (
-        jsonify({"stock": int(item_data[b"stock"]), "price": int(item_data[b"price"])}),
-        200,
-    )
+    price, stock = item_data
+    return jsonify({"stock": stock, "price": price}), 200
+
+
+@app.post("/find_batch")
+def find_items():
+    """Look up a JSON list of item ids; streams {item_id: {stock, price} or null}."""
+    item_ids = parse_id_list(request.get_json(silent=True))
+    if item_ids is None:
+        return jsonify({"error": "Expected a list of item ids"}), 400
+
+    def lookups():
+        for batch in chunks(item_ids):
+            pipe = db.pipeline(transaction=False)
+            for item_id in batch:
+                item_key, prefix = items.ref(item_id)
+                find_item_script(keys=[item_key], args=[prefix], client=pipe)
+            yield [
+                (item_id, None if item_data == -1 else {"stock": item_data[1], "price": item_data[0]})
+                for item_id, item_data in zip(batch, pipe.execute())
+            ]
+
+    return Response(stream_with_context(stream_json_object(lookups())), mimetype="application/json")
 
 
 @app.post("/add/<item_id>/<amount>")
 def add_stock(item_id: str, amount: int):
-    item_key = f"item:{item_id}"
-    if not db.exists(item_key):
+    item_key, prefix = items.ref(item_id)
+    result = add_stock_script(
+        keys=[item_key],
+        args=[int(amount), prefix],
+        key=request.headers.get(IDEMPOTENCY_HEADER),
+    )
+    if result == -1:
         return jsonify({"error": "Item not found"}), 400
-    db.hincrby(item_key, "stock", int(amount))
     return jsonify({"done": True}), 200
 
 
 @app.post("/subtract/<item_id>/<amount>")
 def remove_stock(item_id: str, amount: int):
-    item_key = f"item:{item_id}"
-    if not db.exists(item_key):
+    item_key, prefix = items.ref(item_id)
+    result = subtract_stock_script(
+        keys=[item_key],
+        args=[int(amount), shard_seed(), prefix],
+        key=request.headers.get(IDEMPOTENCY_HEADER),
+    )
+    if result == -1:
         return jsonify({"error": "Item not found"}), 400
-
-    current_stock = int(db.hget(item_key, "stock"))
-    if current_stock < int(amount):
+    if result == -2:
         return jsonify({"error": "Insufficient stock"}), 400
+    return jsonify({"done": True}), 200
+
 
-    db.hincrby(item_key, "stock", -int(amount))
-    return jsonify({"done": True}), 200
\ No newline at end of file
+@app.post("/subtract_batch")
+def remove_stock_batch():
+    batch = parse_batch(request.get_json(silent=True))
+    if batch is None:
+        return jsonify({"error": "Expected a non-empty {item_id: amount} object"}), 400
+
+    failure = run_batch_script(
+        subtract_batch_script, batch, request.headers.get(IDEMPOTENCY_HEADER)
+    )
+    if failure is not None:
+        status, item_id = failure
+        error = "Item not found" if status == 1 else "Insufficient stock"
+        return jsonify({"error": error, "item_id": item_id}), 400
+    return jsonify({"done": True}), 200
+
+
+@app.post("/add_batch")
+def add_stock_batch():
+    batch = parse_batch(request.get_json(silent=True))
+    if batch is None:
+        return jsonify({"error": "Expected a non-empty {item_id: amount} object"}), 400
+
+    failure = run_batch_script(add_batch_script, batch, request.headers.get(IDEMPOTENCY_HEADER))
+    if failure is not None:
+        _, item_id = failure
+        return jsonify({"error": "Item not found", "item_id": item_id}), 400
+    return jsonify({"done": True}), 200
@@ -0,0 +1,229 @@
+"""Lua scripts run atomically inside the stock Redis.
+
+Each script does its read-check-write in a single round trip, so no other
+request can change the item between the check and the write.
+
+An item is addressed by a key and a field prefix (see common/buckets.py):
+its own hash and "", or the bucket holding it and "<item_id>:". Its fields
+are the prefix followed by ``price`` and ``stock``. The scripts take the
+prefixes as their last arguments, one per key.
+
+The stock of an item is its ``stock`` field, unless the item is sharded:
+then it has a ``shards`` field K instead, and the stock is spread over the
+counters ``<key>:<prefix>stock:0`` .. ``<key>:<prefix>stock:K-1``.
+A subtract starts at the shard picked by its ``seed`` argument and only
+reads the other shards when that one runs short. The scripts derive the
+shard keys from the item key; with a sharded Redis they live on the item's
+node (see common/sharding.py).
+"""
+
+# Functions shared by the stock scripts; prepended to their bodies
+STOCK_LIB = """
+-- The field prefix of each key, passed as the last arguments
+local PREFIXES = {}
+for i = #KEYS, 1, -1 do
+    PREFIXES[i] = table.remove(ARGV)
+end
+
+local function shard_key(key, prefix, shards, i)
+    return key .. ':' .. prefix .. 'stock:' .. (i % shards)
+end
+
+local function total_stock(key, prefix, shards)
+    if shards == 0 then
+        return tonumber(redis.call('HGET', key, prefix .. 'stock'))
+    end
+    local total = 0
+    for i = 0, shards - 1 do
+        total = total + tonumber(redis.call('GET', shard_key(key, prefix, shards, i)) or 0)
+    end
+    return total
+end
+
+-- Returns the shard count, or nil if the item does not exist
+local function item_shards(key, prefix)
+    local fields = redis.call('HMGET', key, prefix .. 'price', prefix .. 'shards')
+    if not fields[1] then
+        return nil
+    end
+    return tonumber(fields[2] or 0)
+end
+
+local function has_stock(key, prefix, shards, amount, seed)
+    if shards > 0
+            and tonumber(redis.call('GET', shard_key(key, prefix, shards, seed)) or 0) >= amount then
+        return true
+    end
+    return total_stock(key, prefix, shards) >= amount
+end
+
+-- Takes amount, which must be available, starting at the seed's shard and
+-- borrowing from the next ones while it runs short
+local function take_stock(key, prefix, shards, amount, seed)
+    if shards == 0 then
+        return redis.call('HINCRBY', key, prefix .. 'stock', -amount)
+    end
+    for i = seed, seed + shards - 1 do
+        if amount == 0 then
+            break
+        end
+        local shard = shard_key(key, prefix, shards, i)
+        local take = math.min(tonumber(redis.call('GET', shard) or 0), amount)
+        if take > 0 then
+            redis.call('DECRBY', shard, take)
+            amount = amount - take
+        end
+    end
+end
+
+-- Spreads amount evenly over the shards
+local function put_stock(key, prefix, shards, amount)
+    if shards == 0 then
+        return redis.call('HINCRBY', key, prefix .. 'stock', amount)
+    end
+    local share = math.floor(amount / shards)
+    local rest = amount - share * shards
+    for i = 0, shards - 1 do
+        local part = share
+        if i < rest then
+            part = part + 1
+        end
+        if part ~= 0 then
+            redis.call('INCRBY', shard_key(key, prefix, shards, i), part)
+        end
+    end
+end
+"""
+
+# KEYS[1]: item key, ARGV[1]: amount, ARGV[2]: field prefix
+# Returns 1, or -1 if the item does not exist.
+ADD_STOCK = STOCK_LIB + """
+local shards = item_shards(KEYS[1], PREFIXES[1])
+if not shards then
+    return -1
+end
+put_stock(KEYS[1], PREFIXES[1], shards, tonumber(ARGV[1]))
+return 1
+"""
+
+# KEYS[1]: item key, ARGV[1]: amount, ARGV[2]: seed, ARGV[3]: field prefix
+# Returns 1, -1 if the item does not exist or -2 if it is short.
+SUBTRACT_STOCK = STOCK_LIB + """
+local shards = item_shards(KEYS[1], PREFIXES[1])
+if not shards then
+    return -1
+end
+local amount, seed = tonumber(ARGV[1]), tonumber(ARGV[2])
+if not has_stock(KEYS[1], PREFIXES[1], shards, amount, seed) then
+    return -2
+end
+take_stock(KEYS[1], PREFIXES[1], shards, amount, seed)
+return 1
+"""
+
+# Checks every item of the batch before touching any of them, so the whole
+# batch is applied or refused in a single atomic step.
+# KEYS: item keys, ARGV: amounts (same order), the seed and the field prefixes
+# Returns {0} on success, {1, i} if item i is missing, {2, i} if item i is short.
+SUBTRACT_BATCH = STOCK_LIB + """
+local seed = tonumber(table.remove(ARGV))
+local shards = {}
+for i, key in ipairs(KEYS) do
+    shards[i] = item_shards(key, PREFIXES[i])
+    if not shards[i] then
+        return {1, i}
+    end
+    if not has_stock(key, PREFIXES[i], shards[i], tonumber(ARGV[i]), seed) then
+        return {2, i}
+    end
+end
+for i, key in ipairs(KEYS) do
+    take_stock(key, PREFIXES[i], shards[i], tonumber(ARGV[i]), seed)
+end
+return {0}
+"""
+
+# KEYS: item keys, ARGV: amounts (same order), the seed, which is unused:
+# added stock is spread over all shards, and the field prefixes
+# Returns {0} on success, {1, i} if item i is missing.
+ADD_BATCH = STOCK_LIB + """
+table.remove(ARGV)
+local shards = {}
+for i, key in ipairs(KEYS) do
+    shards[i] = item_shards(key, PREFIXES[i])
+    if not shards[i] then
+        return {1, i}
+    end
+end
+for i, key in ipairs(KEYS) do
+    put_stock(key, PREFIXES[i], shards[i], tonumber(ARGV[i]))
+end
+return {0}
+"""
+
+# KEYS[1]: item key, ARGV[1]: shard count, ARGV[2]: field prefix
+# Moves the stock of an item onto the given number of shards, or back into
+# its hash if the count is 0 or 1. Returns the stock, or -1 if the item does
+# not exist.
+SHARD_STOCK = STOCK_LIB + """
+local key, prefix = KEYS[1], PREFIXES[1]
+local shards = item_shards(key, prefix)
+if not shards then
+    return -1
+end
+local stock = total_stock(key, prefix, shards)
+for i = 0, shards - 1 do
+    redis.call('DEL', shard_key(key, prefix, shards, i))
+end
+local new_shards = tonumber(ARGV[1])
+if new_shards <= 1 then
+    redis.call('HDEL', key, prefix .. 'shards')
+    redis.call('HSET', key, prefix .. 'stock', stock)
+else
+    redis.call('HDEL', key, prefix .. 'stock')
+    redis.call('HSET', key, prefix .. 'shards', new_shards)
+    put_stock(key, prefix, new_shards, stock)
+end
+return stock
+"""
+
+# KEYS[1]: item key, ARGV[1]: field prefix
+# Returns the price and stock of an item, or -1 if it does not exist.
+FIND_ITEM = STOCK_LIB + """
+local key, prefix = KEYS[1], PREFIXES[1]
+local shards = item_shards(key, prefix)
+if not shards then
+    return -1
+end
+return {tonumber(redis.call('HGET', key, prefix .. 'price')), total_stock(key, prefix, shards)}
+"""
+
+# KEYS[1]: item key, ARGV[1]: field prefix
+# Spreads the stock of a sharded item evenly over its shards again.
+# Returns the stock, or -1 if the item is missing or not sharded.
+REBALANCE_STOCK = STOCK_LIB + """
+local key, prefix = KEYS[1], PREFIXES[1]
+local shards = item_shards(key, prefix)
+if not shards or shards == 0 then
+    return -1
+end
+local stock = total_stock(key, prefix, shards)
+for i = 0, shards - 1 do
+    redis.call('SET', shard_key(key, prefix, shards, i), 0)
+end
+put_stock(key, prefix, shards, stock)
+return stock
+"""
+
+# KEYS[1]: item key, ARGV[1]: new price, ARGV[2]: price channel, ARGV[3]: item_id,
+# ARGV[4]: field prefix
+# Returns 1, or -1 if the item does not exist. Subscribers on the channel
+# (the order service's price cache) receive the item_id.
+SET_PRICE = """
+if redis.call('HEXISTS', KEYS[1], ARGV[4] .. 'price') == 0 then
+    return -1
+end
+redis.call('HSET', KEYS[1], ARGV[4] .. 'price', ARGV[1])
+redis.call('PUBLISH', ARGV[2], ARGV[3])
+return 1
+"""
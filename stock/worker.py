@@ -0,0 +1,44 @@
+"""Stock worker for the messaging checkout mode.
+
+Consumes reserve and release commands from the commands:stock stream as a
+member of the "stock" consumer group and replies on replies:order. Run one
+or more next to the stock service:
+
+    BUS_REDIS_HOST=order-db python worker.py
+"""
+import json
+import logging
+
+from app import (
+    add_batch_script, subtract_batch_script, parse_batch, run_batch_script
+)
+from common.streams import (
+    ORDER_REPLIES, STOCK_COMMANDS, StreamConsumer, bus_connection, publish
+)
+
+bus = bus_connection()
+
+COMMAND_SCRIPTS = {
+    "reserve": subtract_batch_script,
+    "release": add_batch_script,
+}
+
+
+def handle_command(command):
+    reply = {"saga_id": command["saga_id"], "step": command["type"], "ok": "1", "error": ""}
+    batch = parse_batch(json.loads(command["items"]))
+    if batch is None:
+        reply.update(ok="0", error="Invalid items")
+    else:
+        script = COMMAND_SCRIPTS[command["type"]]
+        failure = run_batch_script(script, batch, command["key"])
+        if failure is not None:
+            status, item_id = failure
+            error = "Item not found" if status == 1 else "Insufficient stock"
+            reply.update(ok="0", error=f"{error}: {item_id}")
+    publish(bus, ORDER_REPLIES, reply)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    StreamConsumer(bus, STOCK_COMMANDS, "stock", handle_command).run_forever()
@@ -0,0 +1,350 @@
+"""Open-loop load generator for the scenarios of scenarios.py.
+
+Locust's users wait for every response and then think for 1-3 seconds, so
+when the services slow down the load drops with them and the queueing
+delay never shows up in the latencies. This generator starts scenarios on
+a fixed schedule instead: the k-th scenario is due at start + k/rate,
+whether or not the earlier ones have finished. The scenario mix follows
+the locust weights, and the scenario rate is set so that the requests add
+up to --rate per second.
+
+The latency of the first request of a scenario is measured from when the
+scenario was due, not from when it was sent, so the time a request waited
+because the generator or the connection pool was behind is counted (no
+coordinated omission). Later requests of a scenario depend on the earlier
+responses and are due when the previous one finished.
+
+The schedule is split over --processes processes, each with its own event
+loop, aiohttp session and slice of the schedule, and their histograms are
+merged at the end:
+
+    python open_loop.py --rate 10000 --duration 60 --processes 8 --out hgrm
+
+With --pool-items the locust scenarios are replaced by the skewed ones of
+scenarios.py: orders and lookups of items and users created up front,
+picked with the Zipf skews, read ratio and basket sizes of workload.py.
+
+prints a summary per request name and writes the percentile distribution
+of each, in the .hgrm format of HdrHistogram's outputPercentileDistribution,
+which the HdrHistogram plotter reads. "schedule lag" is how late the
+generator started scenarios; if its p99 grows, add processes.
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+
+import workload as workloads
+from scenarios import SCENARIOS, State, add_pool_arguments, pool_steps, skewed_scenarios
+from workload import Workload
+
+# Latencies are recorded in microseconds
+UNIT_MS = 1000
+SCHEDULE_LAG = "schedule lag"
+ALL = "all requests"
+
+
+class Histogram:
+    """A log-linear histogram of positive integers, like HdrHistogram.
+
+    Values below 2**bits are counted exactly; above, every power of two is
+    split into 2**(bits-1) buckets, so a value is off by less than
+    1/2**(bits-1) (0.8% with the default 8 bits) whatever its magnitude.
+    The counts are kept per bucket index, so histograms add up exactly.
+    """
+
+    def __init__(self, bits: int = 8, counts: dict = None, max_value: int = 0):
+        self.bits = bits
+        self.counts = Counter(counts or {})
+        self.total = sum(self.counts.values())
+        self.max = max_value
+
+    def index(self, value: int) -> int:
+        if value < 1 << self.bits:
+            return value
+        shift = value.bit_length() - self.bits
+        return (1 << self.bits) + (shift - 1) * (1 << (self.bits - 1)) + (value >> shift) - (1 << (self.bits - 1))
+
+    def highest(self, index: int) -> int:
+        """The largest value counted in a bucket."""
+        if index < 1 << self.bits:
+            return index
+        shift, offset = divmod(index - (1 << self.bits), 1 << (self.bits - 1))
+        shift += 1
+        return (((1 << (self.bits - 1)) + offset + 1) << shift) - 1
+
+    def record(self, value: int):
+        value = max(int(value), 0)
+        self.counts[self.index(value)] += 1
+        self.total += 1
+        self.max = max(self.max, value)
+
+    def add(self, other: "Histogram"):
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> int:
+        """The value at or below which a q (0-100) percent of the values are."""
+        if not self.total:
+            return 0
+        rank = max(math.ceil(q / 100 * self.total), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.highest(index), self.max)
+        return self.max
+
+    def mean(self) -> float:
+        if not self.total:
+            return 0.0
+        return sum(self.highest(index) * count for index, count in self.counts.items()) / self.total
+
+    def to_dict(self) -> dict:
+        return {"bits": self.bits, "counts": dict(self.counts), "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        return cls(data["bits"], {int(index): count for index, count in data["counts"].items()}, data["max"])
+
+    def percentile_distribution(self, unit: float = UNIT_MS, ticks_per_half: int = 5) -> str:
+        """The distribution in the text format of HdrHistogram's outputPercentileDistribution."""
+        lines = [f"{'Value':>12} {'Percentile':>14} {'TotalCount':>10} {'1/(1-Percentile)':>14}", ""]
+        percentiles = []
+        reporting = 0.0
+        while reporting < 100.0 - 1e-9:
+            percentiles.append(reporting)
+            # Halve the distance to 100% every ticks_per_half lines
+            halves = int(math.log2(100.0 / (100.0 - reporting))) + 1
+            reporting += (100.0 / (2 ** halves)) / ticks_per_half
+            if len(percentiles) > 1000 or 100.0 - reporting < 100.0 / max(self.total, 1):
+                break
+        percentiles.append(100.0)
+        for q in percentiles:
+            value = self.percentile(q) / unit
+            count = max(math.ceil(q / 100 * self.total), 1) if self.total else 0
+            inverse = f"{1 / (1 - q / 100):14.2f}" if q < 100.0 else ""
+            lines.append(f"{value:12.3f} {q / 100:14.12f} {count:10d} {inverse}".rstrip())
+        mean = self.mean() / unit
+        deviation = math.sqrt(sum((self.highest(index) / unit - mean) ** 2 * count
+                                  for index, count in self.counts.items()) / max(self.total, 1))
+        lines.append(f"#[Mean    = {mean:12.3f}, StdDeviation   = {deviation:12.3f}]")
+        lines.append(f"#[Max     = {self.max / unit:12.3f}, Total count    = {self.total:12d}]")
+        lines.append(f"#[Buckets = {len(self.counts):12d}, SubBuckets     = {1 << self.bits:12d}]")
+        return "\n".join(lines) + "\n"
+
+
+class Results:
+    def __init__(self):
+        self.histograms = defaultdict(Histogram)
+        self.statuses = defaultdict(Counter)
+        self.failures = Counter()
+        self.scenarios = Counter()
+        self.abandoned = Counter()
+
+    def record(self, name: str, status, micros: int):
+        self.histograms[name].record(micros)
+        self.histograms[ALL].record(micros)
+        self.statuses[name][str(status)] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "histograms": {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            "statuses": {name: dict(statuses) for name, statuses in self.statuses.items()},
+            "failures": dict(self.failures),
+            "scenarios": dict(self.scenarios),
+            "abandoned": dict(self.abandoned),
+        }
+
+    def add(self, data: dict):
+        for name, histogram in data["histograms"].items():
+            self.histograms[name].add(Histogram.from_dict(histogram))
+        for name, statuses in data["statuses"].items():
+            self.statuses[name].update(statuses)
+        self.failures.update(data["failures"])
+        self.scenarios.update(data["scenarios"])
+        self.abandoned.update(data["abandoned"])
+
+
+class Response:
+    """What a scenario step sees of an aiohttp response."""
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+async def run_scenario(session, scenario, due: float, results: Results, measured: bool):
+    state = State()
+    if measured:
+        results.scenarios[scenario.name] += 1
+    for step in scenario.steps:
+        requests = step(state)
+        response = None
+        while True:
+            try:
+                request = requests.send(response)
+            except StopIteration:
+                break
+            try:
+                async with session.request(request.method, request.url) as reply:
+                    response = Response(reply.status, await reply.text())
+                status = response.status_code
+                failure = request.check(response)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                status, failure = "error", type(error).__name__
+            finished = time.perf_counter()
+            if measured:
+                results.record(request.name, status, int((finished - due) * 1_000_000))
+            # The next request is due now
+            due = finished
+            if failure is not None:
+                requests.close()
+                if measured:
+                    results.failures[f"{request.name}: {' '.join(failure.split())[:80]}"] += 1
+                    results.abandoned[scenario.name] += 1
+                return
+
+
+async def generate(rate: float, duration: float, warmup: float, process: int, processes: int,
+                   max_in_flight: int, seed: int, workload: dict = None, item_ids: list = None,
+                   user_ids: list = None) -> dict:
+    """Run this process's share of the schedule; returns its Results as a dict.
+
+    With workload (the keyword arguments of a Workload) the scenarios are
+    skewed_scenarios() over item_ids and user_ids, else SCENARIOS.
+    """
+    rng = random.Random(seed + process)
+    scenarios = SCENARIOS
+    if workload is not None:
+        scenarios = skewed_scenarios(Workload(**workload), item_ids, user_ids)
+    weights = [scenario.weight for scenario in scenarios]
+    requests_per_scenario = sum(s.requests * s.weight for s in scenarios) / sum(weights)
+    # Scenarios per second of this process; the processes take turns
+    interval = processes * requests_per_scenario / rate
+    results = Results()
+    tasks = set()
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = time.perf_counter() + process * interval / processes
+        k = 0
+        while True:
+            due = start + k * interval
+            if due - start >= duration:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            measured = due - start >= warmup
+            if measured:
+                results.histograms[SCHEDULE_LAG].record(int(max(time.perf_counter() - due, 0) * 1_000_000))
+            scenario = rng.choices(scenarios, weights)[0]
+            task = asyncio.ensure_future(run_scenario(session, scenario, due, results, measured))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            k += 1
+        if tasks:
+            await asyncio.wait(tasks)
+    return results.to_dict()
+
+
+async def create_pool(arguments) -> State:
+    """Create the items and users of the skewed scenarios."""
+    state = State()
+    requests = pool_steps(state, arguments)
+    response = None
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                request = requests.send(response)
+            except StopIteration:
+                return state
+            async with session.request(request.method, request.url) as reply:
+                response = Response(reply.status, await reply.text())
+            failure = request.check(response)
+            if failure is not None:
+                raise RuntimeError(f"{request.url} failed: {failure}")
+
+
+def run_process(arguments: dict) -> dict:
+    return asyncio.run(generate(**arguments))
+
+
+def summary(results: Results, elapsed: float) -> str:
+    lines = [f"{'name':45} {'count':>9} {'rps':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+             f"{'p99.9 ms':>9} {'max ms':>9}  statuses"]
+    for name in sorted(results.histograms, key=lambda name: (name in (ALL, SCHEDULE_LAG), name)):
+        histogram = results.histograms[name]
+        percentiles = " ".join(f"{histogram.percentile(q) / UNIT_MS:9.2f}" for q in (50, 90, 99, 99.9))
+        statuses = ",".join(f"{status}:{count}" for status, count in sorted(results.statuses[name].items()))
+        lines.append(f"{name:45} {histogram.total:9d} {histogram.total / elapsed:8.1f} {percentiles} "
+                     f"{histogram.max / UNIT_MS:9.2f}  {statuses}")
+    if results.failures:
+        lines.append("\nFailures:")
+        lines.extend(f"{count:9d}  {failure}" for failure, count in results.failures.most_common())
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, required=True, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to start scenarios for")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds at the start that are not measured")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="generator processes")
+    parser.add_argument("--max-in-flight", type=int, default=1000,
+                        help="most requests in flight per process; more wait, counted in their latency")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="directory to write a .hgrm file per request name to")
+    add_pool_arguments(parser)
+    workloads.add_arguments(parser)
+    arguments = parser.parse_args()
+
+    pool = {}
+    if arguments.pool_items:
+        state = asyncio.run(create_pool(arguments))
+        pool = {"item_ids": state.item_ids, "user_ids": state.user_ids}
+        print(f"Created {len(state.item_ids)} items and {len(state.user_ids)} users, "
+              f"{workloads.from_arguments(arguments)}")
+    shares = [
+        {"rate": arguments.rate, "duration": arguments.duration, "warmup": arguments.warmup,
+         "process": process, "processes": arguments.processes, "max_in_flight": arguments.max_in_flight,
+         "seed": arguments.seed, **pool}
+        for process in range(arguments.processes)
+    ]
+    if arguments.pool_items:
+        for process, share in enumerate(shares):
+            share["workload"] = workloads.options(arguments, seed_offset=process)
+    started = time.perf_counter()
+    with multiprocessing.Pool(arguments.processes) as pool:
+        shares = pool.map(run_process, shares)
+    elapsed = time.perf_counter() - started
+
+    results = Results()
+    for share in shares:
+        results.add(share)
+    measured = max(arguments.duration - arguments.warmup, 1e-9)
+    print(f"Target {arguments.rate:.0f} requests/s for {measured:.0f} s, "
+          f"{arguments.processes} processes, finished in {elapsed:.1f} s")
+    print(summary(results, measured))
+    if arguments.out:
+        os.makedirs(arguments.out, exist_ok=True)
+        for name, histogram in results.histograms.items():
+            file_name = name.strip("/").replace("/", "_").replace("[", "").replace("]", "").replace(" ", "_")
+            with open(os.path.join(arguments.out, f"{file_name}.hgrm"), "w") as out:
+                out.write(histogram.percentile_distribution())
+
+
+if __name__ == "__main__":
+    main()
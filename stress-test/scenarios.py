@@ -0,0 +1,257 @@
+"""The stress test scenarios, shared by locustfile.py and open_loop.py.
+
+A scenario is a weighted sequence of steps run with one State: the items,
+user and order it created so far. A step is a generator function of the
+state that yields a Request for every call it makes and is sent back the
+response, so that the same steps can be driven by locust's blocking
+client and by an asyncio one. A response only needs status_code, text
+and json(). A step is not sent a response that failed its check; the
+runners abandon the scenario then.
+
+SCENARIOS create fresh items and users every time. skewed_scenarios()
+instead orders and looks up items and users created up front by
+populate(), picked by a Workload (workload.py), to load the hot keys.
+"""
+import json
+import os
+import random
+from typing import Callable, List, NamedTuple, Optional
+
+# replace the example urls and ports with the appropriate ones
+with open(os.path.join('..', 'urls.json')) as f:
+    urls = json.load(f)
+    ORDER_URL = urls['ORDER_URL']
+    PAYMENT_URL = urls['PAYMENT_URL']
+    STOCK_URL = urls['STOCK_URL']
+
+
+def expect_success(response) -> Optional[str]:
+    """Return why the response is a failure, or None if it is not."""
+    if response.status_code >= 400:
+        return response.text or f"HTTP {response.status_code}"
+    return None
+
+
+def expect_json(response) -> Optional[str]:
+    failure = expect_success(response)
+    if failure is not None:
+        return failure
+    try:
+        response.json()
+    except ValueError:
+        return "SERVER ERROR"
+    return None
+
+
+def expect_no_server_error(response) -> Optional[str]:
+    """For requests that may be refused, e.g. a checkout of a sold-out item."""
+    if response.status_code >= 500:
+        return response.text or f"HTTP {response.status_code}"
+    return None
+
+
+def expect_client_error(reason: str) -> Callable:
+    def check(response) -> Optional[str]:
+        return None if 400 <= response.status_code < 500 else reason
+    return check
+
+
+class Request(NamedTuple):
+    method: str
+    url: str
+    # The url with the ids and numbers replaced, to group the statistics by
+    name: str
+    check: Callable = expect_success
+
+
+class State:
+    def __init__(self):
+        self.item_ids: List[str] = []
+        self.user_id = ""
+        self.order_id = ""
+
+
+def create_item(state):
+    price = random.uniform(1.0, 10.0)
+    response = yield Request("POST", f"{STOCK_URL}/stock/item/create/{price}", "/stock/item/create/[price]",
+                             expect_json)
+    state.item_ids.append(response.json()['item_id'])
+
+
+def add_stock(state, item_idx: int):
+    stock_to_add = random.randint(100, 1000)
+    yield Request("POST", f"{STOCK_URL}/stock/add/{state.item_ids[item_idx]}/{stock_to_add}",
+                  "/stock/add/[item_id]/[number]")
+
+
+def create_user(state):
+    response = yield Request("POST", f"{PAYMENT_URL}/payment/create_user", "/payment/create_user", expect_json)
+    state.user_id = response.json()['user_id']
+
+
+def add_balance_to_user(state):
+    balance_to_add: float = random.uniform(10000.0, 100000.0)
+    yield Request("POST", f"{PAYMENT_URL}/payment/add_funds/{state.user_id}/{balance_to_add}",
+                  "/payment/add_funds/[user_id]/[amount]")
+
+
+def create_order(state):
+    response = yield Request("POST", f"{ORDER_URL}/orders/create/{state.user_id}", "/orders/create/[user_id]",
+                             expect_json)
+    state.order_id = response.json()['order_id']
+
+
+def add_item_to_order(state, item_idx: int):
+    yield Request("POST", f"{ORDER_URL}/orders/addItem/{state.order_id}/{state.item_ids[item_idx]}",
+                  "/orders/addItem/[order_id]/[item_id]")
+
+
+def remove_item_from_order(state, item_idx: int):
+    yield Request("DELETE", f"{ORDER_URL}/orders/removeItem/{state.order_id}/{state.item_ids[item_idx]}",
+                  "/orders/removeItem/[order_id]/[item_id]")
+
+
+def checkout_order(state):
+    yield Request("POST", f"{ORDER_URL}/orders/checkout/{state.order_id}", "/orders/checkout/[order_id]")
+
+
+def checkout_order_that_is_supposed_to_fail(state, reason: int):
+    message = "This was supposed to fail: " + ("Not enough stock" if reason == 0 else "Not enough credit")
+    yield Request("POST", f"{ORDER_URL}/orders/checkout/{state.order_id}", "/orders/checkout/[order_id]",
+                  expect_client_error(message))
+
+
+def make_items_stock_zero(state, item_idx: int):
+    response = yield Request("GET", f"{STOCK_URL}/stock/find/{state.item_ids[item_idx]}", "/stock/find/[item_id]",
+                             expect_json)
+    stock_to_subtract = response.json()['stock']
+    yield Request("POST", f"{STOCK_URL}/stock/subtract/{state.item_ids[item_idx]}/{stock_to_subtract}",
+                  "/stock/subtract/[item_id]/[number]")
+
+
+def step(function, *args, requests: float = 1):
+    """A step running function(state, *args), which makes this many requests (on average)."""
+    def run(state):
+        return function(state, *args)
+    run.__name__ = function.__name__
+    run.requests = requests
+    return run
+
+
+class Scenario(NamedTuple):
+    name: str
+    description: str
+    # Relative frequency among the scenarios
+    weight: float
+    steps: tuple
+
+    @property
+    def requests(self) -> float:
+        return sum(s.requests for s in self.steps)
+
+
+SCENARIOS = (
+    Scenario("LoadTest1", "Scenario where a stock admin creates an item and adds stock to it", 5, (
+        step(create_item), step(add_stock, 0),
+    )),
+    Scenario("LoadTest2", "Scenario where a user checks out an order with one item inside that an admin has added "
+                          "stock to before", 30, (
+        step(create_item), step(add_stock, 0), step(create_user), step(add_balance_to_user),
+        step(create_order), step(add_item_to_order, 0), step(checkout_order),
+    )),
+    Scenario("LoadTest3", "Scenario where a user checks out an order with two items inside that an admin has added "
+                          "stock to before", 25, (
+        step(create_item), step(add_stock, 0), step(create_item), step(add_stock, 1), step(create_user),
+        step(add_balance_to_user), step(create_order), step(add_item_to_order, 0), step(add_item_to_order, 1),
+        step(checkout_order),
+    )),
+    Scenario("LoadTest4", "Scenario where a user adds an item to an order, regrets it and removes it and then adds "
+                          "it back and checks out", 20, (
+        step(create_item), step(add_stock, 0), step(create_user), step(add_balance_to_user), step(create_order),
+        step(add_item_to_order, 0), step(remove_item_from_order, 0), step(add_item_to_order, 0),
+        step(checkout_order),
+    )),
+    Scenario("LoadTest5", "Scenario that is supposed to fail because the second item does not have enough stock", 10, (
+        step(create_item), step(add_stock, 0), step(create_item), step(add_stock, 1), step(create_user),
+        step(add_balance_to_user), step(create_order), step(add_item_to_order, 0), step(add_item_to_order, 1),
+        step(make_items_stock_zero, 1, requests=2), step(checkout_order_that_is_supposed_to_fail, 0),
+    )),
+    Scenario("LoadTest6", "Scenario that is supposed to fail because the user does not have enough credit", 10, (
+        step(create_item), step(add_stock, 0), step(create_user), step(create_order), step(add_item_to_order, 0),
+        step(checkout_order_that_is_supposed_to_fail, 1),
+    )),
+)
+
+
+# Most items or users the bulk create endpoints make per request
+BATCH_CREATE_LIMIT = 100000
+
+
+def populate(state, items: int, stock: int, price: int, users: int, credit: int):
+    """Create the items and users of skewed_scenarios() into state.item_ids and state.user_ids."""
+    state.user_ids = []
+    for start in range(0, items, BATCH_CREATE_LIMIT):
+        count = min(BATCH_CREATE_LIMIT, items - start)
+        response = yield Request("POST", f"{STOCK_URL}/stock/item/batch_create/{count}/{stock}/{price}",
+                                 "/stock/item/batch_create/[count]/[stock]/[price]", expect_json)
+        state.item_ids.extend(range(response.json()['first_id'], response.json()['last_id'] + 1))
+    for start in range(0, users, BATCH_CREATE_LIMIT):
+        count = min(BATCH_CREATE_LIMIT, users - start)
+        response = yield Request("POST", f"{PAYMENT_URL}/payment/batch_create_users/{count}/{credit}",
+                                 "/payment/batch_create_users/[count]/[credit]", expect_json)
+        state.user_ids.extend(range(response.json()['first_id'], response.json()['last_id'] + 1))
+
+
+def add_pool_arguments(parser):
+    """Add the options of populate() to an argparse (or locust) parser; --pool-items 0 keeps SCENARIOS."""
+    parser.add_argument("--pool-items", type=int, default=0,
+                        help="run the skewed scenarios over this many items created up front")
+    parser.add_argument("--pool-users", type=int, default=10000, help="users created up front")
+    parser.add_argument("--pool-stock", type=int, default=1000000, help="starting stock of each item")
+    parser.add_argument("--pool-price", type=int, default=1, help="price of each item")
+    parser.add_argument("--pool-credit", type=int, default=1000000, help="starting credit of each user")
+
+
+def pool_steps(state, arguments):
+    """populate() with the options of add_pool_arguments()."""
+    return populate(state, arguments.pool_items, arguments.pool_stock, arguments.pool_price,
+                    arguments.pool_users, arguments.pool_credit)
+
+
+def skewed_scenarios(workload, item_ids: list, user_ids: list) -> tuple:
+    """Scenarios over existing items and users picked by workload.
+
+    A checkout orders a basket for a picked user, which may be refused for
+    lack of stock or credit; a read looks up a picked item or user. They
+    are weighted so that workload.read_ratio of the scenarios are reads.
+    """
+    def find_hot_item(state):
+        yield Request("GET", f"{STOCK_URL}/stock/find/{workload.item(item_ids)}", "/stock/find/[item_id]")
+
+    def find_hot_user(state):
+        yield Request("GET", f"{PAYMENT_URL}/payment/find_user/{workload.user(user_ids)}",
+                      "/payment/find_user/[user_id]")
+
+    def create_order_for_hot_user(state):
+        state.user_id = workload.user(user_ids)
+        yield from create_order(state)
+
+    def add_basket_to_order(state):
+        for item_id in workload.basket(item_ids):
+            yield Request("POST", f"{ORDER_URL}/orders/addItem/{state.order_id}/{item_id}",
+                          "/orders/addItem/[order_id]/[item_id]")
+
+    def checkout_hot_order(state):
+        yield Request("POST", f"{ORDER_URL}/orders/checkout/{state.order_id}", "/orders/checkout/[order_id]",
+                      expect_no_server_error)
+
+    reads = workload.read_ratio
+    return (
+        Scenario("HotItemRead", "A user looks up an item, hot ones more often", reads / 2, (step(find_hot_item),)),
+        Scenario("HotUserRead", "A user looks up their account, hot users more often", reads / 2,
+                 (step(find_hot_user),)),
+        Scenario("HotCheckout", "A user, hot ones more often, checks out a basket of items, hot ones more often",
+                 1 - reads, (step(create_order_for_hot_user),
+                             step(add_basket_to_order, requests=workload.mean_basket_size),
+                             step(checkout_hot_order))),
+    )
@@ -0,0 +1,124 @@
+"""Skewed workload model for the load and consistency tests.
+
+Real traffic is not uniform: a few items sell far more than the rest and
+a few users order far more often, and those keys are where Redis
+serializes (every subtract of one item runs on one key). A Workload picks
+items and users from existing id lists with a Zipf distribution, the
+rank-k id (the k-th in the list, from 0) with a probability proportional
+to 1/(k+1)**skew: 0 is uniform, 1 is the classic Zipf law where the top
+1% of 10000 items get about half the picks, and higher is hotter still.
+It also decides how many items an order holds and whether an operation
+is a read or a write.
+
+open_loop.py, locustfile.py and consistency-test/run_consistency_test.py
+take the same options, see add_arguments():
+
+    --item-skew 1.1 --user-skew 0.8 --read-ratio 0.5 --basket 1-5
+"""
+import bisect
+import itertools
+import random
+from array import array
+
+
+class Zipf:
+    """Draws ranks 0..n-1 with probability proportional to 1/(rank+1)**skew."""
+
+    def __init__(self, n: int, skew: float):
+        self.n = n
+        self.skew = skew
+        # Cumulative weights; 8 bytes per rank
+        self.cumulative = None if skew == 0 else array(
+            'd', itertools.accumulate(1 / (rank + 1) ** skew for rank in range(n)))
+
+    def sample(self, rng: random.Random) -> int:
+        if self.cumulative is None:
+            return rng.randrange(self.n)
+        return min(bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1]), self.n - 1)
+
+
+def parse_basket(spec: str):
+    """Return (sample(rng) -> basket size, mean size) of "N", "A-B" (uniform) or "geometric:MEAN"."""
+    if spec.startswith("geometric:"):
+        mean = float(spec.split(":", 1)[1])
+        if mean < 1:
+            raise ValueError("The mean basket size must be at least 1")
+        p = 1 / mean
+
+        def geometric(rng: random.Random) -> int:
+            # Sizes 1, 2, ... with P(k) = (1-p)**(k-1) * p
+            size = 1
+            while rng.random() > p:
+                size += 1
+            return size
+        return geometric, mean
+    if "-" in spec:
+        low, high = map(int, spec.split("-", 1))
+        return (lambda rng: rng.randint(low, high)), (low + high) / 2
+    size = int(spec)
+    return (lambda rng: size), size
+
+
+class Workload:
+    def __init__(self, item_skew: float = 0.0, user_skew: float = 0.0, read_ratio: float = 0.0,
+                 basket: str = "1", seed: int = None):
+        if not 0 <= read_ratio < 1:
+            raise ValueError("The read ratio must be at least 0 and below 1")
+        self.item_skew = item_skew
+        self.user_skew = user_skew
+        self.read_ratio = read_ratio
+        self.basket_spec = basket
+        self.basket_size, self.mean_basket_size = parse_basket(basket)
+        self.rng = random.Random(seed)
+        # (id list length, skew) -> Zipf
+        self._zipfs = {}
+
+    def _pick(self, ids, skew: float):
+        zipf = self._zipfs.get((len(ids), skew))
+        if zipf is None:
+            zipf = self._zipfs[len(ids), skew] = Zipf(len(ids), skew)
+        return ids[zipf.sample(self.rng)]
+
+    def item(self, item_ids):
+        return self._pick(item_ids, self.item_skew)
+
+    def user(self, user_ids):
+        return self._pick(user_ids, self.user_skew)
+
+    def basket(self, item_ids) -> list:
+        """The items of an order, each picked on its own (an item can be in it twice)."""
+        return [self.item(item_ids) for _ in range(self.basket_size(self.rng))]
+
+    def is_read(self) -> bool:
+        return self.rng.random() < self.read_ratio
+
+    def reads_per_write(self) -> float:
+        return self.read_ratio / (1 - self.read_ratio)
+
+    def __repr__(self):
+        return (f"Workload(item_skew={self.item_skew}, user_skew={self.user_skew}, "
+                f"read_ratio={self.read_ratio}, basket={self.basket_spec!r})")
+
+
+def add_arguments(parser):
+    """Add the workload options to an argparse (or locust) parser."""
+    parser.add_argument("--item-skew", type=float, default=0.0,
+                        help="Zipf skew of the items picked; 0 is uniform")
+    parser.add_argument("--user-skew", type=float, default=0.0,
+                        help="Zipf skew of the users picked; 0 is uniform")
+    parser.add_argument("--read-ratio", type=float, default=0.0,
+                        help="fraction of the operations that are lookups instead of orders")
+    parser.add_argument("--basket", default="1",
+                        help='items per order: "N", "A-B" (uniform) or "geometric:MEAN"')
+    parser.add_argument("--workload-seed", type=int, default=None, help="seed of the workload's picks")
+
+
+def options(arguments, seed_offset: int = 0) -> dict:
+    """The keyword arguments of a Workload from parsed options, e.g. to send to another process."""
+    seed = None if arguments.workload_seed is None else arguments.workload_seed + seed_offset
+    return {"item_skew": arguments.item_skew, "user_skew": arguments.user_skew,
+            "read_ratio": arguments.read_ratio, "basket": arguments.basket, "seed": seed}
+
+
+def from_arguments(arguments, seed_offset: int = 0) -> Workload:
+    return Workload(**options(arguments, seed_offset))
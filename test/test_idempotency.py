@@ -0,0 +1,43 @@
+import os
+import sys
+import unittest
+
+import fakeredis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.idempotency import PENDING, IdempotencyStore  # noqa: E402
+
+
+class TestIdempotencyStore(unittest.TestCase):
+
+    def setUp(self):
+        self.db = fakeredis.FakeRedis()
+        self.store = IdempotencyStore(self.db, "checkout", ttl=3600, claim_ttl=40)
+
+    def ttl(self, key):
+        return self.db.ttl(self.store._key(key))
+
+    def test_claim(self):
+        self.assertIsNone(self.store.begin("k"))
+        self.assertEqual(self.store.begin("k"), PENDING)
+        self.store.complete("k", 200, {"status": "success"})
+        self.assertEqual(self.store.begin("k"), (200, {"status": "success"}))
+        self.store.release("k")
+        self.assertIsNone(self.store.begin("k"))
+
+    def test_claim_is_short_lived(self):
+        # A claim whose worker died expires with the attempt, not the outcome
+        self.store.begin("k")
+        self.assertTrue(0 < self.ttl("k") <= 40)
+        self.store.complete("k", 400, {"error": "Payment failed"})
+        self.assertGreater(self.ttl("k"), 40)
+
+    def test_claim_ttl_defaults_to_ttl(self):
+        store = IdempotencyStore(self.db, "checkout", ttl=3600)
+        store.begin("other")
+        self.assertGreater(self.db.ttl(store._key("other")), 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
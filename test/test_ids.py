@@ -0,0 +1,102 @@
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+import fakeredis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import ids  # noqa: E402
+from common.ids import ID_LENGTH, IdGenerator, decode, encode, parse_id, public_id  # noqa: E402
+
+
+class TestIds(unittest.TestCase):
+
+    def test_base62_round_trip(self):
+        for number in (0, 1, 61, 62, 3843, 3844, 2 ** 40 + 7, 2 ** 64 - 1):
+            self.assertEqual(len(encode(number)), ID_LENGTH)
+            self.assertEqual(decode(encode(number)), number)
+
+    def test_ids_sort_by_creation(self):
+        generator = IdGenerator(3, shard=2)
+        generated = [generator.next_id() for _ in range(5000)]
+        self.assertEqual(generated, sorted(generated))
+        self.assertEqual(len(set(generated)), len(generated))
+        self.assertEqual(generated, sorted(generated, key=decode))
+
+    def test_parse_id(self):
+        generator = IdGenerator(200, shard=5)
+        with mock.patch.object(IdGenerator, "_now", return_value=ids.EPOCH_MS + 1234):
+            first, second = generator.next_id(), generator.next_id()
+        self.assertEqual(parse_id(first), {"time_ms": ids.EPOCH_MS + 1234, "shard": 5, "worker": 200, "sequence": 0})
+        self.assertEqual(parse_id(second)["sequence"], 1)
+
+    def test_full_millisecond_waits_for_the_next(self):
+        generator = IdGenerator(1)
+        clock = iter([ids.EPOCH_MS + 10] * (1 << ids.SEQUENCE_BITS) + [ids.EPOCH_MS + 10, ids.EPOCH_MS + 11])
+        with mock.patch.object(IdGenerator, "_now", side_effect=lambda: next(clock)):
+            generated = [generator.next_id() for _ in range((1 << ids.SEQUENCE_BITS) + 1)]
+        self.assertEqual(parse_id(generated[-2])["time_ms"], ids.EPOCH_MS + 10)
+        self.assertEqual(parse_id(generated[-1]), {"time_ms": ids.EPOCH_MS + 11, "shard": 0, "worker": 1, "sequence": 0})
+        self.assertEqual(generated, sorted(generated))
+
+    def test_clock_going_back_keeps_the_order(self):
+        generator = IdGenerator(1)
+        clock = iter([ids.EPOCH_MS + 50, ids.EPOCH_MS + 40])
+        with mock.patch.object(IdGenerator, "_now", side_effect=lambda: next(clock)):
+            first, second = generator.next_id(), generator.next_id()
+        self.assertLess(first, second)
+
+    def test_out_of_range(self):
+        with self.assertRaises(ValueError):
+            IdGenerator(1, shard=1 << ids.SHARD_BITS)
+        with self.assertRaises(ValueError):
+            IdGenerator(1 << ids.WORKER_BITS).next_id()
+        with self.assertRaises(RuntimeError):
+            IdGenerator(None).next_id()
+
+    def test_public_id(self):
+        self.assertEqual(public_id("42"), 42)
+        compact = IdGenerator(1).next_id()
+        self.assertEqual(public_id(compact), compact)
+
+
+class TestWorkerClaim(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(ids, "ID_SCHEME", "compact")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        os.environ.pop("WORKER_ID", None)
+
+    def test_legacy_scheme(self):
+        with mock.patch.object(ids, "ID_SCHEME", "legacy"):
+            self.assertIsNone(ids.make_generator(fakeredis.FakeRedis()))
+
+    def test_claimed_on_first_use(self):
+        db = fakeredis.FakeRedis()
+        first, second = ids.make_generator(db), ids.make_generator(db)
+        self.assertIsNone(db.get(ids.WORKERS_KEY))
+        self.assertEqual(parse_id(first.next_id())["worker"], 0)
+        self.assertEqual(parse_id(second.next_id())["worker"], 1)
+        self.assertEqual(db.get(ids.WORKERS_KEY), b"2")
+
+    def test_worker_id_from_the_environment(self):
+        with mock.patch.dict(os.environ, {"WORKER_ID": "9"}):
+            generator = ids.make_generator(fakeredis.FakeRedis())
+        self.assertEqual(parse_id(generator.next_id())["worker"], 9)
+
+    def test_claimed_asynchronously(self):
+        db = fakeredis.aioredis.FakeRedis()
+        generator = ids.make_generator()
+        generator.set_worker(asyncio.run(ids.claim_worker_async(db)))
+        self.assertEqual(parse_id(generator.next_id())["worker"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
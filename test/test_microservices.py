@@ -1,4 +1,5 @@
 import unittest
+import uuid
 
 import utils as tu
 
@@ -34,6 +35,95 @@ class TestMicroservices(unittest.TestCase):
         stock_after_subtract: int = tu.find_item(item_id)['stock']
         self.assertEqual(stock_after_subtract, 35)
 
+    def test_stock_batch(self):
+        item_id1: str = tu.create_item(5)['item_id']
+        item_id2: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id1, 10)))
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id2, 1)))
+
+        # Test /stock/subtract_batch refuses the whole batch if one item is short
+        over_subtract_response = tu.subtract_stock_batch({item_id1: 5, item_id2: 2})
+        self.assertTrue(tu.status_code_is_failure(over_subtract_response))
+        self.assertEqual(tu.find_item(item_id1)['stock'], 10)
+        self.assertEqual(tu.find_item(item_id2)['stock'], 1)
+
+        subtract_response = tu.subtract_stock_batch({item_id1: 5, item_id2: 1})
+        self.assertTrue(tu.status_code_is_success(subtract_response))
+        self.assertEqual(tu.find_item(item_id1)['stock'], 5)
+        self.assertEqual(tu.find_item(item_id2)['stock'], 0)
+
+    def test_batch_create(self):
+        # Test /stock/item/batch_create/<count>/<stock>/<price>
+        items: dict = tu.batch_create_items(3, 7, 2)
+        self.assertEqual(items['last_id'] - items['first_id'], 2)
+        for item_id in range(items['first_id'], items['last_id'] + 1):
+            self.assertEqual(tu.find_item(item_id), {'stock': 7, 'price': 2})
+
+        # Test /payment/batch_create_users/<count>/<credit>
+        users: dict = tu.batch_create_users(3, 9)
+        self.assertEqual(users['last_id'] - users['first_id'], 2)
+        for user_id in range(users['first_id'], users['last_id'] + 1):
+            self.assertEqual(tu.find_user(user_id)['credit'], 9)
+
+    def test_batch_find(self):
+        items: dict = tu.batch_create_items(2, 4, 3)
+        item_ids = [items['first_id'], items['last_id']]
+        users: dict = tu.batch_create_users(2, 6)
+        user_ids = [users['first_id'], users['last_id']]
+
+        # Test /stock/find_batch; unknown ids map to None
+        found_items: dict = tu.find_items(item_ids + ['missing'])
+        self.assertEqual(found_items[str(item_ids[0])], {'stock': 4, 'price': 3})
+        self.assertEqual(found_items[str(item_ids[1])], {'stock': 4, 'price': 3})
+        self.assertIsNone(found_items['missing'])
+
+        # Test /payment/find_user_batch
+        found_users: dict = tu.find_users(user_ids + ['missing'])
+        self.assertEqual(found_users[str(user_ids[1])], {'user_id': user_ids[1], 'credit': 6})
+        self.assertIsNone(found_users['missing'])
+
+    def test_sharded_stock(self):
+        item_id: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 10)))
+
+        # Test /stock/item/shard/<item_id>/<shards> keeps the stock
+        self.assertTrue(tu.status_code_is_success(tu.shard_item(item_id, 4)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 10)
+
+        # Subtracts borrow from the other shards, but never oversell
+        for _ in range(10):
+            self.assertTrue(tu.status_code_is_success(tu.subtract_stock(item_id, 1)))
+        self.assertTrue(tu.status_code_is_failure(tu.subtract_stock(item_id, 1)))
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 3)))
+        self.assertTrue(tu.status_code_is_failure(tu.subtract_stock_batch({item_id: 4})))
+        self.assertTrue(tu.status_code_is_success(tu.subtract_stock_batch({item_id: 3})))
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+
+        self.assertTrue(tu.status_code_is_success(tu.shard_item(item_id, 1)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 0)
+
+    def test_idempotency(self):
+        item_id: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 10)))
+
+        # Replaying a subtraction with the same key does not subtract again
+        key = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_success(tu.subtract_stock(item_id, 3, key)))
+        self.assertTrue(tu.status_code_is_success(tu.subtract_stock(item_id, 3, key)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 7)
+
+        user_id: str = tu.create_user()['user_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 20)))
+        order_id: str = tu.create_order(user_id)['order_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id)))
+
+        # Replaying a checkout with the same key charges and subtracts once
+        key = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_success(tu.checkout_order(order_id, key).status_code))
+        self.assertTrue(tu.status_code_is_success(tu.checkout_order(order_id, key).status_code))
+        self.assertEqual(tu.find_item(item_id)['stock'], 6)
+        self.assertEqual(tu.find_user(user_id)['credit'], 15)
+
     def test_payment(self):
         # Test /payment/pay/<user_id>/<order_id>
         user: dict = tu.create_user()
@@ -74,6 +164,78 @@ class TestMicroservices(unittest.TestCase):
         credit_after_payment: int = tu.find_user(user_id)['credit']
         self.assertEqual(credit_after_payment, 5)
 
+    def test_user_orders(self):
+        user_id: str = tu.create_user()['user_id']
+        order_ids = [tu.create_order(user_id)['order_id'] for _ in range(3)]
+
+        # Test /orders/user/<user_id> pages through all orders once
+        first_page: dict = tu.list_user_orders(user_id, limit=2)
+        self.assertEqual(len(first_page['orders']), 2)
+        self.assertIsNotNone(first_page['next_cursor'])
+        second_page: dict = tu.list_user_orders(user_id, cursor=first_page['next_cursor'], limit=2)
+        self.assertEqual(len(second_page['orders']), 1)
+        self.assertIsNone(second_page['next_cursor'])
+        listed = [order['order_id'] for order in first_page['orders'] + second_page['orders']]
+        self.assertEqual(sorted(listed), sorted(order_ids))
+
+        # Removed orders leave the index
+        self.assertTrue(tu.status_code_is_success(tu.remove_order(order_ids[0])))
+        listed = [order['order_id'] for order in tu.list_user_orders(user_id)['orders']]
+        self.assertEqual(sorted(listed), sorted(order_ids[1:]))
+
+    def test_memory_stats(self):
+        # Test /orders/stats/memory
+        stats: dict = tu.order_memory_stats()
+        for field in ('used_memory', 'maxmemory', 'expired_keys', 'evicted_keys'):
+            self.assertIn(field, stats)
+
+        # Test /<service>/stats/buckets: with STORAGE_LAYOUT=buckets, full
+        # buckets must fit hash-max-listpack-entries and stay listpacks
+        tu.batch_create_items(3, 1, 1)
+        tu.batch_create_users(3, 1)
+        for service in ('stock', 'payment'):
+            stats = tu.bucket_stats(service)
+            if stats['layout'] != 'buckets':
+                continue
+            if stats['hash_max_listpack_entries'] is not None:
+                self.assertGreaterEqual(stats['hash_max_listpack_entries'], stats['fields_per_bucket'])
+            self.assertTrue(stats['encodings'])
+            self.assertEqual(set(stats['encodings']), {'listpack'})
+
+    def test_metrics(self):
+        # Test /<service>/metrics after a request to each service
+        tu.create_item(5)
+        tu.create_user()
+        tu.create_order(tu.create_user()['user_id'])
+        for service, route in (('stock', '/item/create/<price>'), ('payment', '/create_user'),
+                               ('orders', '/create/<user_id>')):
+            metrics: str = tu.service_metrics(service)
+            self.assertIn(f'http_requests_total{{method="POST",route="{route}",status="200"}}', metrics)
+            self.assertIn('redis_command_duration_seconds_count', metrics)
+
+    def test_redis_round_trip_budgets(self):
+        # Test that the hot paths stay within their Redis round trips
+        user_id: str = tu.create_user()['user_id']
+        tu.add_credit_to_user(user_id, 100)
+        item_id: str = tu.create_item(5)['item_id']
+        tu.add_stock(item_id, 10)
+        order_id: str = tu.create_order(user_id)['order_id']
+        budgets = (
+            ('GET', f'/stock/find/{item_id}', 1),
+            ('POST', f'/stock/subtract/{item_id}/1', 1),
+            ('GET', f'/payment/find_user/{user_id}', 1),
+            ('POST', f'/orders/create/{user_id}', 1),
+            ('POST', f'/orders/addItem/{order_id}/{item_id}', 2),
+            ('GET', f'/orders/find/{order_id}', 1),
+            # Includes the calls to stock and payment
+            ('POST', f'/orders/checkout/{order_id}', 8),
+        )
+        for method, path, budget in budgets:
+            round_trips = tu.redis_round_trips(method, path)
+            if round_trips is None:
+                self.skipTest("Run the services with docker-compose.test.yml to check Redis round trips")
+            self.assertLessEqual(round_trips, budget, path)
+
     def test_order(self):
         # Test /payment/pay/<user_id>/<order_id>
         user: dict = tu.create_user()
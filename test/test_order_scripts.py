@@ -0,0 +1,80 @@
+import os
+import sys
+import unittest
+
+import fakeredis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "order")]
+
+import scripts  # noqa: E402
+from migrate_items import migrate  # noqa: E402
+from orders import decode_order, order_keys, order_to_json  # noqa: E402
+
+
+class TestLegacyMigration(unittest.TestCase):
+    """Orders written before the items hash keep their lines in an ``items`` list."""
+
+    def setUp(self):
+        self.db = fakeredis.FakeRedis()
+        self.keys = order_keys("o1")
+        # An order in the old format: two of item 1 and one of item 2
+        self.db.hset(self.keys[0], mapping={
+            "order_id": "o1", "paid": "False", "user_id": "u1", "total_cost": 30,
+            "items": "['1', '2', '1']",
+        })
+
+    def items(self):
+        return {key.decode(): int(value) for key, value in self.db.hgetall(self.keys[1]).items()}
+
+    def test_migrate_items(self):
+        migrate_items = self.db.register_script(scripts.MIGRATE_ITEMS)
+        self.assertEqual(migrate_items(keys=self.keys), 1)
+        self.assertEqual(self.items(), {"1": 2, "2": 1})
+        self.assertFalse(self.db.hexists(self.keys[0], "items"))
+        self.assertEqual(self.db.hget(self.keys[0], "total_cost"), b"30")
+        # Already migrated
+        self.assertEqual(migrate_items(keys=self.keys), 0)
+        self.assertEqual(self.items(), {"1": 2, "2": 1})
+
+    def test_add_item_migrates_first(self):
+        add_item = self.db.register_script(scripts.ADD_ITEM)
+        self.assertEqual(add_item(keys=self.keys, args=["2", 1, 10, 0]), 2)
+        self.assertEqual(self.items(), {"1": 2, "2": 2})
+        self.assertFalse(self.db.hexists(self.keys[0], "items"))
+        self.assertEqual(self.db.hget(self.keys[0], "total_cost"), b"40")
+
+    def test_remove_item_migrates_first(self):
+        remove_item = self.db.register_script(scripts.REMOVE_ITEM)
+        self.assertEqual(remove_item(keys=self.keys, args=["2", 10, 0]), 0)
+        self.assertEqual(self.items(), {"1": 2})
+        self.assertFalse(self.db.hexists(self.keys[0], "items"))
+        self.assertEqual(self.db.hget(self.keys[0], "total_cost"), b"20")
+        self.assertEqual(remove_item(keys=self.keys, args=["3", 10, 0]), -2)
+
+    def test_empty_legacy_list(self):
+        self.db.hset(self.keys[0], "items", "[]")
+        migrate_items = self.db.register_script(scripts.MIGRATE_ITEMS)
+        self.assertEqual(migrate_items(keys=self.keys), 1)
+        self.assertEqual(self.items(), {})
+        self.assertFalse(self.db.hexists(self.keys[0], "items"))
+
+    def test_decode_before_and_after(self):
+        before = order_to_json(*decode_order(self.db.hgetall(self.keys[0]), self.db.hgetall(self.keys[1])))
+        self.db.register_script(scripts.MIGRATE_ITEMS)(keys=self.keys)
+        after = order_to_json(*decode_order(self.db.hgetall(self.keys[0]), self.db.hgetall(self.keys[1])))
+        self.assertEqual(sorted(before["items"]), ["1", "1", "2"])
+        self.assertEqual(before, after)
+
+    def test_migrate_all_orders(self):
+        self.db.hset("order:o2", mapping={"order_id": "o2", "paid": "False", "user_id": "u1",
+                                          "total_cost": 0})
+        self.db.hset("order:o2:items", "1", 1)
+        self.assertEqual(migrate(self.db), 1)
+        self.assertEqual(self.items(), {"1": 2, "2": 1})
+        self.assertEqual(self.db.hgetall("order:o2:items"), {b"1": b"1"})
+        self.assertEqual(migrate(self.db), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import importlib.util
+import os
+import sys
+import unittest
+
+import fakeredis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common.idempotency import IdempotentScript  # noqa: E402
+
+# Loaded under its own name; the order service has a scripts module too
+spec = importlib.util.spec_from_file_location("payment_scripts", os.path.join(ROOT, "payment", "scripts.py"))
+scripts = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(scripts)
+
+USER_KEY = "user:1"
+ORDER_KEY = "user:1:order:o1"
+
+
+class TestPaymentScripts(unittest.TestCase):
+
+    def setUp(self):
+        self.db = fakeredis.FakeRedis()
+        self.db.hset(USER_KEY, "credit", 100)
+        self.pay_script = IdempotentScript(self.db, scripts.REMOVE_CREDIT, "pay")
+        self.cancel_script = self.db.register_script(scripts.CANCEL_PAYMENT)
+
+    def pay(self, key, amount=30):
+        return self.pay_script(keys=[USER_KEY, ORDER_KEY], args=[amount, key, ""], key=key)
+
+    def cancel(self, key):
+        keys = [USER_KEY, ORDER_KEY, self.pay_script.record_key([USER_KEY, ORDER_KEY], key)]
+        return self.cancel_script(keys=keys, args=[key, "", self.pay_script.ttl])
+
+    def credit(self):
+        return int(self.db.hget(USER_KEY, "credit"))
+
+    def test_cancel_refunds_the_payment(self):
+        self.assertEqual(self.pay("s1:pay"), 70)
+        self.assertEqual(self.cancel("s1:pay"), 100)
+        self.assertEqual(self.cancel("s1:pay"), -2)
+        # A replayed payment does not charge again
+        self.assertEqual(self.pay("s1:pay"), 70)
+        self.assertEqual(self.credit(), 100)
+
+    def test_cancel_before_the_payment_refuses_it(self):
+        self.assertEqual(self.cancel("s1:pay"), -2)
+        self.assertEqual(self.pay("s1:pay"), scripts.PAYMENT_CANCELLED)
+        self.assertEqual(self.credit(), 100)
+        # Other payments of the order are not affected
+        self.assertEqual(self.pay("s2:pay"), 70)
+
+    def test_paid_order_is_not_paid_again(self):
+        # Two checkouts of the order with different keys
+        self.assertEqual(self.pay("s1:pay"), 70)
+        self.assertEqual(self.pay("s2:pay"), scripts.ORDER_ALREADY_PAID)
+        self.assertEqual(self.credit(), 70)
+        # Once refunded, it can be paid again
+        self.assertEqual(self.cancel("s1:pay"), 100)
+        self.assertEqual(self.pay("s3:pay"), 70)
+
+    def test_cancel_only_refunds_its_payment(self):
+        self.assertEqual(self.pay("s2:pay"), 70)
+        self.assertEqual(self.cancel("s1:pay"), -2)
+        self.assertEqual(self.credit(), 70)
+
+
+if __name__ == '__main__':
+    unittest.main()
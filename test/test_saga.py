@@ -0,0 +1,321 @@
+import asyncio
+import json
+import os
+import sys
+import time
+import unittest
+
+import fakeredis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "order")]
+
+import saga as sagas  # noqa: E402
+from saga import AsyncCheckoutSaga, CheckoutSaga  # noqa: E402
+
+
+class Response:
+    def __init__(self, status_code: int, url: str = ""):
+        self.status_code = status_code
+        self.url = url
+
+
+class FakeStock:
+    """The stock service's batch endpoints, replaying by idempotency key.
+
+    errors_after_commit makes the next calls commit and then answer 500,
+    like a Redis error after the script ran.
+    """
+
+    def __init__(self, stock: dict):
+        self.stock = dict(stock)
+        self.outcomes = {}
+        self.errors_after_commit = 0
+
+    def post(self, path, json=None, headers=None):
+        key = headers["Idempotency-Key"]
+        if key not in self.outcomes:
+            sign = -1 if path == "/subtract_batch" else 1
+            if all(self.stock[item] + sign * amount >= 0 for item, amount in json.items()):
+                for item, amount in json.items():
+                    self.stock[item] += sign * amount
+                self.outcomes[key] = 200
+            else:
+                self.outcomes[key] = 400
+        if self.errors_after_commit:
+            self.errors_after_commit -= 1
+            return Response(500, path)
+        return Response(self.outcomes[key], path)
+
+
+class FakePayment:
+    """The payment service's pay and cancel endpoints for one user."""
+
+    def __init__(self, credit: int):
+        self.credit = credit
+        self.payments = {}
+        # Keys of payments that were cancelled before they ran
+        self.blocked = set()
+        self.errors_after_commit = 0
+
+    def post(self, path, headers=None):
+        if path.startswith("/pay/"):
+            key = headers["Idempotency-Key"]
+            amount = int(path.rsplit("/", 1)[1])
+            if key not in self.payments and key not in self.blocked and amount <= self.credit:
+                self.credit -= amount
+                self.payments[key] = amount
+            status = 200 if key in self.payments else 400
+        else:
+            key = headers["Payment-Idempotency-Key"]
+            amount = self.payments.pop(key, None)
+            if amount is not None:
+                self.credit += amount
+            else:
+                self.blocked.add(key)
+            status = 200 if amount is not None else 400
+        if self.errors_after_commit:
+            self.errors_after_commit -= 1
+            return Response(500, path)
+        return Response(status, path)
+
+
+class AsyncClient:
+    """An async client of a fake service that logs when each call starts and ends."""
+
+    def __init__(self, service, calls: list):
+        self.service = service
+        self.calls = calls
+
+    async def post(self, path, **kwargs):
+        self.calls.append(("start", path.split("/")[1]))
+        await asyncio.sleep(0)
+        self.calls.append(("end", path.split("/")[1]))
+        return self.service.post(path, **kwargs)
+
+
+class TestCheckoutSaga(unittest.TestCase):
+
+    def setUp(self):
+        self.db = fakeredis.FakeRedis()
+        self.stock = FakeStock({"1": 5, "2": 5})
+        self.payment = FakePayment(100)
+        self.saga = CheckoutSaga(self.db, self.stock, self.payment, timeout=10)
+
+    def run_saga(self, saga_id="s1", total_cost=30, quantities=None):
+        quantities = {"1": 2, "2": 1} if quantities is None else quantities
+        return self.saga.run(saga_id, "o1", "u1", total_cost, quantities)
+
+    def state(self, saga_id="s1"):
+        return self.db.hget(sagas.saga_key(saga_id), "state").decode()
+
+    def resolve_queued(self):
+        while True:
+            queued = self.db.lpop(sagas.QUEUE_KEY)
+            if queued is None:
+                return
+            self.saga.resolve(queued.decode())
+
+    def test_success(self):
+        self.assertEqual(self.run_saga(), ({"status": "success"}, 200))
+        self.assertEqual(self.state(), sagas.COMPLETED)
+        self.assertEqual(self.stock.stock, {"1": 3, "2": 4})
+        self.assertEqual(self.payment.credit, 70)
+        self.assertEqual(self.db.hget("order:o1", "paid"), b"True")
+        self.assertEqual(self.db.zcard(sagas.ACTIVE_KEY), 0)
+
+    def test_stock_refused(self):
+        self.assertEqual(self.run_saga(quantities={"1": 6})[1], 400)
+        self.assertEqual(self.state(), sagas.ABORTED)
+        self.assertEqual(self.db.llen(sagas.QUEUE_KEY), 0)
+        self.assertEqual(self.payment.credit, 100)
+
+    def test_payment_refused_releases_stock(self):
+        self.assertEqual(self.run_saga(total_cost=1000)[1], 400)
+        self.assertEqual(self.state(), sagas.COMPENSATING)
+        self.resolve_queued()
+        self.assertEqual(self.state(), sagas.ABORTED)
+        self.assertEqual(self.stock.stock, {"1": 5, "2": 5})
+        self.assertEqual(self.payment.credit, 100)
+
+    def test_stock_error_after_commit_releases_stock(self):
+        self.stock.errors_after_commit = 1
+        self.assertEqual(self.run_saga()[1], 400)
+        # The reservation went through, but the saga cannot know it
+        self.assertEqual(self.state(), sagas.COMPENSATING)
+        self.assertIsNone(self.db.hget(sagas.saga_key("s1"), "stock"))
+        self.resolve_queued()
+        self.assertEqual(self.state(), sagas.ABORTED)
+        self.assertEqual(self.stock.stock, {"1": 5, "2": 5})
+        self.assertEqual(self.payment.credit, 100)
+
+    def test_payment_error_after_commit_refunds(self):
+        self.payment.errors_after_commit = 1
+        self.assertEqual(self.run_saga()[1], 400)
+        self.assertEqual(self.state(), sagas.COMPENSATING)
+        self.assertIsNone(self.db.hget(sagas.saga_key("s1"), "payment"))
+        self.resolve_queued()
+        self.assertEqual(self.state(), sagas.ABORTED)
+        self.assertEqual(self.stock.stock, {"1": 5, "2": 5})
+        self.assertEqual(self.payment.credit, 100)
+
+    def test_payment_error_without_items_refunds(self):
+        self.payment.errors_after_commit = 1
+        self.assertEqual(self.run_saga(quantities={})[1], 400)
+        self.resolve_queued()
+        self.assertEqual(self.state(), sagas.ABORTED)
+        self.assertEqual(self.payment.credit, 100)
+
+    def test_late_payment_after_cancellation_is_refused(self):
+        # The pay request timed out on the client but is still in flight
+        real_post = self.payment.post
+        late = []
+
+        def timeout(path, headers=None):
+            late.append((path, headers))
+            raise sagas.requests.Timeout()
+
+        self.payment.post = timeout
+        self.assertEqual(self.run_saga()[1], 400)
+        self.payment.post = real_post
+        self.resolve_queued()
+        self.assertEqual(self.state(), sagas.ABORTED)
+        # The pay lands after the compensation
+        self.assertEqual(self.payment.post(*late[0]).status_code, 400)
+        self.assertEqual(self.payment.credit, 100)
+        self.assertEqual(self.stock.stock, {"1": 5, "2": 5})
+
+    def test_failed_compensation_stays_active(self):
+        self.payment.errors_after_commit = 2
+        self.run_saga()
+        queued = self.db.lpop(sagas.QUEUE_KEY).decode()
+        # The cancellation fails too; the saga is left for recover()
+        with self.assertRaises(RuntimeError):
+            self.saga.resolve(queued)
+        self.assertEqual(self.state(), sagas.COMPENSATING)
+        self.assertEqual(self.db.zcard(sagas.ACTIVE_KEY), 1)
+
+    def test_recover_stalled_saga(self):
+        # A worker reserved the stock and died before paying
+        self.saga._record("s1", sagas.STARTED, {
+            "order_id": "o1", "user_id": "u1", "total_cost": 30, "items": json.dumps({"1": 2}),
+        })
+        self.stock.post("/subtract_batch", json={"1": 2}, headers={"Idempotency-Key": "s1:reserve"})
+        self.assertEqual(self.saga.recover(), 0)
+
+        self.db.zadd(sagas.ACTIVE_KEY, {"s1": time.time() - 60})
+        self.db.hset(sagas.saga_key("s1"), "updated_at", time.time() - 60)
+        self.assertEqual(self.saga.recover(), 1)
+        self.assertEqual(self.state(), sagas.COMPENSATING)
+        self.resolve_queued()
+        self.assertEqual(self.state(), sagas.ABORTED)
+        self.assertEqual(self.stock.stock, {"1": 5, "2": 5})
+        self.assertEqual(self.db.zcard(sagas.ACTIVE_KEY), 0)
+
+    def test_recover_rolls_forward_paid_saga(self):
+        self.saga._record("s1", sagas.STOCK_RESERVED, {
+            "order_id": "o1", "user_id": "u1", "total_cost": 30, "items": json.dumps({"1": 2}),
+            "stock": sagas.DONE, "payment": sagas.DONE, "updated_at": 0,
+        })
+        self.db.zadd(sagas.ACTIVE_KEY, {"s1": 0})
+        self.db.hset(sagas.saga_key("s1"), "updated_at", 0)
+        self.assertEqual(self.saga.recover(), 1)
+        self.resolve_queued()
+        self.assertEqual(self.state(), sagas.COMPLETED)
+        self.assertEqual(self.db.hget("order:o1", "paid"), b"True")
+
+    def test_recover_drops_finished_sagas(self):
+        self.run_saga()
+        self.db.zadd(sagas.ACTIVE_KEY, {"s1": 0})
+        self.assertEqual(self.saga.recover(), 0)
+        self.assertEqual(self.db.zcard(sagas.ACTIVE_KEY), 0)
+
+
+class TestAsyncCheckoutSaga(unittest.TestCase):
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        self.db = fakeredis.FakeRedis(server=server)
+        self.stock = FakeStock({"1": 5, "2": 5})
+        self.payment = FakePayment(100)
+        self.calls = []
+        self.saga = AsyncCheckoutSaga(
+            fakeredis.aioredis.FakeRedis(server=server),
+            AsyncClient(self.stock, self.calls), AsyncClient(self.payment, self.calls),
+        )
+        # The blocking worker that compensates
+        self.worker = CheckoutSaga(self.db, self.stock, self.payment, timeout=10)
+
+    def run_saga(self, total_cost=30, quantities=None):
+        quantities = {"1": 2, "2": 1} if quantities is None else quantities
+        return asyncio.run(self.saga.run("s1", "o1", "u1", total_cost, quantities))
+
+    def record(self):
+        return {key.decode(): value.decode() for key, value in self.db.hgetall(sagas.saga_key("s1")).items()}
+
+    def resolve_queued(self):
+        while (queued := self.db.lpop(sagas.QUEUE_KEY)) is not None:
+            self.worker.resolve(queued.decode())
+
+    def test_steps_run_at_once(self):
+        self.assertEqual(self.run_saga(), ({"status": "success"}, 200))
+        # Both calls were sent before either answered
+        self.assertEqual([event for event, _ in self.calls], ["start", "start", "end", "end"])
+        saga = self.record()
+        self.assertEqual((saga["state"], saga["stock"], saga["payment"]), (sagas.COMPLETED, sagas.DONE, sagas.DONE))
+        self.assertEqual(self.db.hget("order:o1", "paid"), b"True")
+        self.assertEqual(self.stock.stock, {"1": 3, "2": 4})
+        self.assertEqual(self.payment.credit, 70)
+
+    def test_stock_refused_refunds_payment(self):
+        self.assertEqual(self.run_saga(quantities={"1": 6}), ({"error": "Not enough stock"}, 400))
+        saga = self.record()
+        self.assertEqual((saga["state"], saga["stock"], saga["payment"]), (sagas.COMPENSATING, sagas.FAILED, sagas.DONE))
+        self.resolve_queued()
+        self.assertEqual(self.record()["state"], sagas.ABORTED)
+        self.assertEqual(self.payment.credit, 100)
+        self.assertEqual(self.stock.stock, {"1": 5, "2": 5})
+
+    def test_payment_refused_releases_stock(self):
+        self.assertEqual(self.run_saga(total_cost=1000)[1], 400)
+        self.assertEqual(self.record()["stock"], sagas.DONE)
+        self.resolve_queued()
+        self.assertEqual(self.record()["state"], sagas.ABORTED)
+        self.assertEqual(self.stock.stock, {"1": 5, "2": 5})
+
+    def test_both_refused(self):
+        self.assertEqual(self.run_saga(total_cost=1000, quantities={"1": 6})[1], 400)
+        self.assertEqual(self.record()["state"], sagas.ABORTED)
+        self.assertEqual(self.db.llen(sagas.QUEUE_KEY), 0)
+
+    def test_unknown_payment_is_compensated(self):
+        self.payment.errors_after_commit = 1
+        self.assertEqual(self.run_saga(), ({"error": "Payment failed"}, 400))
+        saga = self.record()
+        self.assertEqual((saga["state"], saga["stock"]), (sagas.COMPENSATING, sagas.DONE))
+        self.assertNotIn("payment", saga)
+        self.resolve_queued()
+        self.assertEqual(self.record()["state"], sagas.ABORTED)
+        self.assertEqual(self.stock.stock, {"1": 5, "2": 5})
+        self.assertEqual(self.payment.credit, 100)
+
+    def test_unknown_stock_is_compensated(self):
+        self.stock.errors_after_commit = 1
+        self.assertEqual(self.run_saga(), ({"error": "Stock reservation failed"}, 400))
+        self.assertNotIn("stock", self.record())
+        self.resolve_queued()
+        self.assertEqual(self.record()["state"], sagas.ABORTED)
+        self.assertEqual(self.stock.stock, {"1": 5, "2": 5})
+        self.assertEqual(self.payment.credit, 100)
+
+    def test_no_items(self):
+        self.assertEqual(self.run_saga(quantities={})[1], 200)
+        self.assertEqual(self.calls, [("start", "pay"), ("end", "pay")])
+
+    def test_no_items_payment_refused(self):
+        self.assertEqual(self.run_saga(total_cost=1000, quantities={})[1], 400)
+        self.assertEqual(self.record()["state"], sagas.ABORTED)
+
+
+if __name__ == '__main__':
+    unittest.main()
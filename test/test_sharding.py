@@ -0,0 +1,151 @@
+import os
+import sys
+import unittest
+
+import fakeredis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.idempotency import IdempotentScript  # noqa: E402
+from common.reshard import move_keys  # noqa: E402
+from common.sharding import CrossNodeError, HashRing, ShardedRedis, routing_key  # noqa: E402
+
+NODES = ["redis-0:6379", "redis-1:6379", "redis-2:6379"]
+KEYS = [f"order:{i}" for i in range(10000)]
+
+
+def sharded_redis(names=NODES, servers=None) -> ShardedRedis:
+    servers = servers if servers is not None else {}
+    return ShardedRedis({
+        name: fakeredis.FakeRedis(server=servers.setdefault(name, fakeredis.FakeServer())) for name in names
+    })
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_same_nodes_same_ring(self):
+        ring, other = HashRing(NODES), HashRing(list(NODES))
+        self.assertTrue(all(ring.node_for(key) == other.node_for(key) for key in KEYS))
+
+    def test_keys_are_spread(self):
+        ring = HashRing(NODES)
+        counts = {node: 0 for node in NODES}
+        for key in KEYS:
+            counts[ring.node_for(key)] += 1
+        for count in counts.values():
+            self.assertGreater(count, len(KEYS) / len(NODES) * 0.7)
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        before = HashRing(NODES)
+        after = HashRing(NODES + ["redis-3:6379"])
+        moved = [key for key in KEYS if before.node_for(key) != after.node_for(key)]
+        self.assertTrue(all(after.node_for(key) == "redis-3:6379" for key in moved))
+        # About 1/4 of the keys move
+        self.assertLess(abs(len(moved) / len(KEYS) - 0.25), 0.1)
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        before = HashRing(NODES)
+        after = HashRing(NODES[:2])
+        for key in KEYS:
+            if before.node_for(key) != "redis-2:6379":
+                self.assertEqual(before.node_for(key), after.node_for(key))
+
+
+class TestRouting(unittest.TestCase):
+
+    def test_routing_key(self):
+        self.assertEqual(routing_key("order:5"), "order:5")
+        self.assertEqual(routing_key(b"order:5:items"), "order:5")
+        self.assertEqual(routing_key("user:7:orders"), "user:7")
+        self.assertEqual(routing_key("items:{12}:3:stock:0"), "12")
+        self.assertEqual(routing_key("item:{x}"), "x")
+        # Empty hash tags are ignored, like in Redis Cluster
+        self.assertEqual(routing_key("item:{}3"), "item:{}3")
+        self.assertIsNone(routing_key("saga:5"))
+        self.assertIsNone(routing_key("ids:workers"))
+
+    def test_hash_tags_share_a_node(self):
+        db = sharded_redis()
+        for i in range(100):
+            self.assertEqual(db.node_name_for(f"items:{{{i}}}"), db.node_name_for(f"items:{{{i}}}:{i}:stock:0"))
+            self.assertEqual(db.node_name_for(f"order:{i}"), db.node_name_for(f"order:{i}:items"))
+
+    def test_unrouted_keys_live_on_the_primary(self):
+        db = sharded_redis()
+        db.set("ids:workers", 1)
+        self.assertEqual(db.nodes[NODES[0]].get("ids:workers"), b"1")
+        self.assertEqual(db.node_name_for("saga:x"), NODES[0])
+
+    def test_commands_go_to_the_node_of_their_key(self):
+        db = sharded_redis()
+        for i in range(20):
+            db.hset(f"order:{i}", "paid", "False")
+        for i in range(20):
+            node = db.nodes[db.node_name_for(f"order:{i}")]
+            self.assertEqual(node.hget(f"order:{i}", "paid"), b"False")
+        self.assertEqual(db.exists(*(f"order:{i}" for i in range(20))), 20)
+        self.assertEqual(db.delete(*(f"order:{i}" for i in range(20))), 20)
+
+    def test_pipeline_keeps_the_order_of_results(self):
+        db = sharded_redis()
+        pipe = db.pipeline(transaction=False)
+        for i in range(20):
+            pipe.incrby(f"item:{i}", i)
+        self.assertEqual(pipe.execute(), list(range(20)))
+
+
+class TestShardedScript(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sharded_redis()
+        nodes = {}
+        for i in range(100):
+            nodes.setdefault(self.db.node_name_for(f"order:{i}"), f"order:{i}")
+        self.order_a, self.order_b = list(nodes.values())[:2]
+        self.script = self.db.register_script("return redis.call('INCR', KEYS[1])")
+
+    def test_runs_on_the_node_of_its_first_key(self):
+        self.assertEqual(self.script(keys=[self.order_a]), 1)
+        self.assertEqual(self.db.for_key(self.order_a).get(self.order_a), b"1")
+
+    def test_keys_of_one_entity_and_unrouted_keys(self):
+        self.assertEqual(self.script(keys=[self.order_a, f"{self.order_a}:items", "idempotency:x"]), 1)
+
+    def test_keys_on_different_nodes(self):
+        with self.assertRaises(CrossNodeError):
+            self.script(keys=[self.order_a, self.order_b])
+
+    def test_in_a_pipeline(self):
+        pipe = self.db.pipeline(transaction=False)
+        self.script(keys=[self.order_a], client=pipe)
+        self.script(keys=[self.order_b], client=pipe)
+        self.script(keys=[self.order_a], client=pipe)
+        self.assertEqual(pipe.execute(), [1, 1, 2])
+
+
+class TestReshard(unittest.TestCase):
+
+    def test_idempotency_records_move_with_their_entity(self):
+        servers = {}
+        old = sharded_redis(NODES[:2], servers)
+        new = sharded_redis(NODES + ["redis-3:6379"], servers)
+        items = [f"item:{i}" for i in range(40)]
+        for item in items:
+            old.hset(item, "stock", 10)
+            script = IdempotentScript(old, "return redis.call('HINCRBY', KEYS[1], 'stock', -1)", "subtract")
+            self.assertEqual(script(keys=[item], key=f"{item}:retry"), 9)
+            record = script.record_key([item], f"{item}:retry")
+            self.assertEqual(old.node_name_for(record), old.node_name_for(item))
+
+        moved, changed = move_keys(old, new)
+        self.assertGreater(moved.get("redis-3:6379", 0), 0)
+        self.assertEqual(changed, 0)
+        for item in items:
+            # A retry after the reshard replays instead of subtracting again
+            script = IdempotentScript(new, "return redis.call('HINCRBY', KEYS[1], 'stock', -1)", "subtract")
+            self.assertEqual(script(keys=[item], key=f"{item}:retry"), 9)
+            self.assertEqual(new.hget(item, "stock"), b"9")
+
+
+if __name__ == '__main__':
+    unittest.main()
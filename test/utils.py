@@ -10,16 +10,33 @@ def create_item(price: float) -> dict:
     return requests.post(f"{STOCK_URL}/stock/item/create/{price}").json()
 
 
+def batch_create_items(count: int, stock: int, price: int) -> dict:
+    return requests.post(f"{STOCK_URL}/stock/item/batch_create/{count}/{stock}/{price}").json()
+
+
 def find_item(item_id: str) -> dict:
     return requests.get(f"{STOCK_URL}/stock/find/{item_id}").json()
 
 
+def find_items(item_ids: list) -> dict:
+    return requests.post(f"{STOCK_URL}/stock/find_batch", json=item_ids).json()
+
+
 def add_stock(item_id: str, amount: int) -> int:
     return requests.post(f"{STOCK_URL}/stock/add/{item_id}/{amount}").status_code
 
 
-def subtract_stock(item_id: str, amount: int) -> int:
-    return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}").status_code
+def subtract_stock(item_id: str, amount: int, idempotency_key: str = None) -> int:
+    headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+    return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}", headers=headers).status_code
+
+
+def shard_item(item_id: str, shards: int) -> int:
+    return requests.post(f"{STOCK_URL}/stock/item/shard/{item_id}/{shards}").status_code
+
+
+def subtract_stock_batch(quantities: dict) -> int:
+    return requests.post(f"{STOCK_URL}/stock/subtract_batch", json=quantities).status_code
 
 
 ########################################################################################################################
@@ -33,6 +50,14 @@ def create_user() -> dict:
     return requests.post(f"{PAYMENT_URL}/payment/create_user").json()
 
 
+def find_users(user_ids: list) -> dict:
+    return requests.post(f"{PAYMENT_URL}/payment/find_user_batch", json=user_ids).json()
+
+
+def batch_create_users(count: int, credit: int) -> dict:
+    return requests.post(f"{PAYMENT_URL}/payment/batch_create_users/{count}/{credit}").json()
+
+
 def find_user(user_id: str) -> dict:
     return requests.get(f"{PAYMENT_URL}/payment/find_user/{user_id}").json()
 
@@ -44,10 +69,22 @@ def add_credit_to_user(user_id: str, amount: float) -> int:
 ########################################################################################################################
 #   ORDER MICROSERVICE FUNCTIONS
 ########################################################################################################################
+def order_memory_stats() -> dict:
+    return requests.get(f"{ORDER_URL}/orders/stats/memory").json()
+
+
+def bucket_stats(service: str) -> dict:
+    return requests.get(f"{STOCK_URL}/{service}/stats/buckets").json()
+
+
 def create_order(user_id: str) -> dict:
     return requests.post(f"{ORDER_URL}/orders/create/{user_id}").json()
 
 
+def remove_order(order_id: str) -> int:
+    return requests.delete(f"{ORDER_URL}/orders/remove/{order_id}").status_code
+
+
 def add_item_to_order(order_id: str, item_id: str) -> int:
     return requests.post(f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}").status_code
 
@@ -56,8 +93,28 @@ def find_order(order_id: str) -> dict:
     return requests.get(f"{ORDER_URL}/orders/find/{order_id}").json()
 
 
-def checkout_order(order_id: str) -> requests.Response:
-    return requests.post(f"{ORDER_URL}/orders/checkout/{order_id}")
+def list_user_orders(user_id: str, cursor: str = None, limit: int = None) -> dict:
+    params = {key: value for key, value in (("cursor", cursor), ("limit", limit)) if value}
+    return requests.get(f"{ORDER_URL}/orders/user/{user_id}", params=params).json()
+
+
+def checkout_order(order_id: str, idempotency_key: str = None) -> requests.Response:
+    headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+    return requests.post(f"{ORDER_URL}/orders/checkout/{order_id}", headers=headers)
+
+
+def service_metrics(service: str) -> str:
+    return requests.get(f"{ORDER_URL}/{service}/metrics").text
+
+
+def redis_round_trips(method: str, path: str):
+    """Redis round trips of a request, from the X-Redis-Round-Trips header.
+
+    None if the services run without REDIS_USAGE_HEADERS=1 (see docker-compose.test.yml).
+    """
+    response = requests.request(method, f"{ORDER_URL}{path}")
+    round_trips = response.headers.get("X-Redis-Round-Trips")
+    return None if round_trips is None else int(round_trips)
 
 
 ########################################################################################################################